@@ -9,6 +9,7 @@ do
 	start=`date +%s`
 	# Build the date part of the directory string
 	dtdir="$(TZ=UTC date +"%Y/%m/%d")"
+	ingest=""
 	# Loop over the types
 	for (( j=0; j<${length}; j++ ));
 	do
@@ -20,14 +21,28 @@ do
 			chmod 755 $dir
 		fi
 		# Download file
-		curl "${urls[$j]}" -s --create-dirs -o "$dir/${types[$j]}-$(TZ=UTC date +"%Y%m%dT%H%M%S.zip")" && chmod 0755 "${_}";
+		file="$dir/${types[$j]}-$(TZ=UTC date +"%Y%m%dT%H%M%S.zip")"
+		curl "${urls[$j]}" -s --create-dirs -o "$file" && chmod 0755 "$file";
+		if [ "${types[$j]}" == "gtfsrt" ] && [ -e "$file" ]; then
+			ingest="$file"
+		fi
 	done
+	# Optionally decode the gtfsrt snapshot into the day's ingest log (see gtfsrt_ingest.py). This runs in the
+	# background, after both downloads, so it doesn't hold up the sirivm snapshot or the next loop.
+	if [ -n "${BODSINGEST}" ] && [ -n "$ingest" ]; then
+		${BODSINGEST} ingest "$ingest" &
+	fi
 	# Get end time
 	end=`date +%s`
 	# Calculate the time to sleep for (30s - time taken)
 	wait=$((30-$((end-start))))
+	if [ $wait -lt 0 ]; then
+		wait=0
+	fi
 	if [ $v -eq 0 ]; then
 		sleep $wait
 	fi
 	((v++))
 done
+# Let the last ingest finish before the cron job exits
+wait
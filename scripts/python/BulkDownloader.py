@@ -1,13 +1,30 @@
 import os
-import requests
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta
 from zipfile import ZipFile
+try:
+    from scripts.python.download_utils import make_session, download_ranged
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    from download_utils import make_session, download_ranged
+    import metrics
+
+ARCHIVE_URL = "https://data.datalibrary.uk/transport/BODS-ARCHIVE/"
 
 class BulkDownloader():
-    def __init__(self, file_format:str):
+    def __init__(self, file_format:str, archive_url=ARCHIVE_URL, segments=8, session=None):
+        """
+        :param file_format: One of 'gtfsrt', 'sirivm' or 'timetables'.
+        :param archive_url: The root of the archive, e.g. a local server for testing.
+        :param segments: The number of HTTP Range segments to download each file in at once.
+        :param session: A requests.Session to share with other downloaders.
+        """
         self.file_format = file_format
-        self.archive_url = "https://data.datalibrary.uk/transport/BODS-ARCHIVE/"
+        self.archive_url = archive_url
+        self.segments = segments
+        self.session = session or make_session(pool_size=segments)
         self.ROOT = Path(__file__).cwd().resolve()
         self.allowed_formats = ['gtfsrt', 'sirivm', 'timetables']
         assert self.file_format in self.allowed_formats
@@ -39,17 +56,15 @@ class BulkDownloader():
         self.dirs[self.file_format].mkdir(exist_ok=True)
 
     def bulk_download(self, url: str) -> Path:
+        """
+        Download url into the temporary directory in parallel Range segments (see download_utils.download_ranged).
+        Interrupted downloads are resumed, and a zip that's already there is only kept if it's complete.
+        """
         download_location = self.TEMPDIR / url.split('/')[-1]
-        # print("download loc", download_location)
-        if Path(download_location).exists():
-            print(f"{download_location} already exists in the temporary directory. Skipping download.\n")
+        if download_ranged(self.session, url, download_location, segments=self.segments):
+            print(f"Downloaded {download_location}\n")
         else:
-            # NOTE the stream=True parameter below
-            with requests.get(url, stream=True) as r:
-                r.raise_for_status()
-                with open(download_location, 'wb') as f:
-                    for chunk in r.iter_content(chunk_size=8192): 
-                        f.write(chunk)
+            print(f"{download_location} already exists in the temporary directory. Skipping download.\n")
         
         return download_location
     
@@ -69,18 +84,60 @@ class BulkDownloader():
                     path = self.dirs[self.file_format]
                     with open(path / file_name, 'wb') as out_file:
                         out_file.write(content)
-                if i % (total // 10) == 0:
+                if i % max(total // 10, 1) == 0:
                     print(f"Unzipped {round(i*100 / total)}% of {total} files into {path}")
                 i += 1
 
-    def run(self, daysago=1):
+    def run(self, daysago=1, unzip=False):
+        """
+        Download a day's bulk zip to the temporary directory.
+
+        :param daysago: How many days ago to download.
+        :param unzip: Also extract the zip's members into the temporary directory. OperatorPerformance
+        can read the zip in place, so this is only needed if you want the individual files.
+        """
         full_download_url = self.create_url_for_given_day(daysago)
         self.create_temporary_directory()
-        download_location = self.bulk_download(full_download_url)
-        
-        #TODO move this to OperatorPerformance
-        self.unzip_bulk_download(download_location)
+        with metrics.stage("download", format=self.file_format):
+            download_location = self.bulk_download(full_download_url)
+
+        if unzip:
+            with metrics.stage("unzip", format=self.file_format) as stage:
+                self.unzip_bulk_download(download_location)
+                stage.count(bytes_read=os.path.getsize(download_location))
+
+def download_many(formats, days, workers=2, segments=8, unzip=False, archive_url=ARCHIVE_URL):
+    """
+    Download several days and/or formats at once, workers files at a time, sharing one connection pool.
+
+    :param formats: A list of formats, e.g. ['gtfsrt', 'timetables'].
+    :param days: A list of how many days ago to download, e.g. [1, 2, 3].
+    :param workers: The number of files to download at once.
+    :param segments: The number of Range segments per file.
+    """
+    session = make_session(pool_size=workers * segments)
+    def download(file_format, daysago):
+        BulkDownloader(file_format, archive_url=archive_url, segments=segments, session=session).run(daysago=daysago, unzip=unzip)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(download, file_format, daysago) for daysago in days for file_format in formats]
+        for future in futures:
+            future.result()
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--daysago", type=int, nargs="+", default=[1], help="How many days ago to download. Defaults to yesterday. Give more than one to download several days.")
+    parser.add_argument("-f", "--formats", nargs="+", default=['gtfsrt', 'timetables'], choices=['gtfsrt', 'sirivm', 'timetables'], help="Formats to download. Defaults to gtfsrt and timetables.")
+    parser.add_argument("-u", "--unzip", action='store_true', help="Extract the downloads into the temporary directory")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="Number of files to download at once. Defaults to 2.")
+    parser.add_argument("-s", "--segments", type=int, default=8, help="Number of parallel Range requests per file. Defaults to 8.")
+    parser.add_argument("--url", default=ARCHIVE_URL, help="Root URL of the archive. Defaults to the BODS archive.")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    return args
 
 if __name__ == "__main__":
-    BulkDownloader(file_format='gtfsrt').run()
-    BulkDownloader(file_format='timetables').run()
\ No newline at end of file
+    args = set_args()
+    with metrics.from_args("bulk_downloader", args):
+        download_many(args.formats, args.daysago, workers=args.workers, segments=args.segments, unzip=args.unzip, archive_url=args.url)
\ No newline at end of file
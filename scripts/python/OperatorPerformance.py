@@ -1,20 +1,42 @@
+import os
 import pandas as pd
+import polars as pl
 import shutil
 from pathlib import Path
-from operator import attrgetter
 from datetime import datetime
 from zipfile import ZipFile
 import sys
 import argparse
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 # from utils import ROOT, TEMPDIR, DIRS_DICT
 from scripts.python.utils import Fore, Style
-from scripts.python.gtfs_realtime_utils import get_gtfs_entities_from_directory
-from scripts.python.gtfs_utils import GTFSTimetable
+from scripts.python.gtfs_realtime_utils import iter_gtfsrt_batches
+from scripts.python.gtfs_utils import GTFSTimetable, open_zip_member
+from scripts.python import metrics
+
+# The columns of each timetable table that the performance calculation needs
+TIMETABLE_COLUMNS = {
+    'agency': ['agency_id', 'agency_name'],
+    'routes': ['route_id', 'agency_id'],
+    'trips': ['route_id', 'service_id', 'trip_id'],
+    'calendar': ['service_id', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday', 'start_date', 'end_date'],
+}
+ID_COLUMNS = ['agency_id', 'agency_name', 'route_id', 'service_id', 'trip_id']
+
+# Bins for the number of (deduplicated) realtime reports per trip, as (upper bound, label)
+COUNT_RANGES = [(10, '1-10'), (20, '11-20'), (50, '21-50'), (1000, '51-1000')]
+
+# The regions to report on
+REGIONS = ['north_east', 'north_west', 'yorkshire', 'east_anglia', 'east_midlands', 'west_midlands', 'south_east', 'south_west']
 
 class OperatorPerformance():
-    def __init__(self):
+    def __init__(self, args=None):
+        """
+        Arguments:
+            args: argparse.Namespace with date, unzip and engine (see _set_args). Defaults to the command line.
+        """
         self.ROOT = Path(__file__).cwd().resolve()
 
         self.TEMPDIR = self.ROOT / "temp"
@@ -25,7 +47,7 @@ class OperatorPerformance():
             'sirivm': self.TEMPDIR / 'sirivm',
             'timetables': self.TEMPDIR / 'timetables'
         }
-        self.args = self._set_args()
+        self.args = args if args is not None else self._set_args()
         pass
     
     def _set_args(self):
@@ -33,11 +55,19 @@ class OperatorPerformance():
         Parses and returns command-line arguments for the archive downloader script.
         Arguments:
             -d, --date: Start date as a string in 'YYYYmmdd' format.
+            --end: Last date, for the performance over a range of days from the archive (see performance_range).
+            -u, --unzip: Unzip the bulk downloads before reading them.
+            -e, --engine: 'polars' (default) or 'pandas'.
+            --metrics, --prom, --profile: see metrics.add_arguments.
         Returns:
             argparse.Namespace: Parsed command-line arguments.
         """
         parser = argparse.ArgumentParser()
         parser.add_argument("-d", "--date", required=False, help="Date string format 'YYYYmmdd'")
+        parser.add_argument("--end", required=False, help="Last date, format 'YYYYmmdd'. Reports every day from --date to --end in one CSV, from the deduplicated parquet files and timetables in ${BODSARCHIVE}.")
+        parser.add_argument("-u", "--unzip", action='store_true', help="Unzip the bulk downloads to the temporary directory first, rather than reading them in place")
+        parser.add_argument("-e", "--engine", choices=['polars', 'pandas'], default='polars', help="'polars' does every region in one pass; 'pandas' does one region at a time")
+        metrics.add_arguments(parser)
         args = parser.parse_args()
         return args
     
@@ -70,34 +100,38 @@ class OperatorPerformance():
                         out_path.mkdir(exist_ok=True)
                         with open(out_path / file_name, 'wb') as out_file:
                             out_file.write(content)
-                    if i % (total // 10) == 0:
+                    if i % max(total // 10, 1) == 0:
                         print(f"Unzipped {Fore.YELLOW}{round(i*100 / total)}%{Style.RESET_ALL} of {Fore.YELLOW}{total}{Style.RESET_ALL} files into {Fore.GREEN}{out_path}{Style.RESET_ALL}")
                     i += 1
 
+    def get_bulk_download_path(self, format:str) -> Path:
+        """The path to a bulk download (from BulkDownloader) for the given date."""
+        return self.TEMPDIR / f"{format}-{self.given_date_as_int}.zip"
+
+    def get_realtime_source(self) -> str:
+        """Where to read the snapshots from: the unzipped snapshots if there are any, otherwise the bulk download."""
+        if (Path(self.TEMPDIR / "gtfsrt")).exists():
+            return str(Path(self.TEMPDIR / "gtfsrt"))
+        elif self.get_bulk_download_path('gtfsrt').exists():
+            return str(self.get_bulk_download_path('gtfsrt'))
+        print("You don't appear to have the gtfsrt data for the date requested! You may need to download them using BulkDownloader first.")
+        sys.exit(0)
+
     def get_entities_as_df(self):
-        if not (Path(self.TEMPDIR / "gtfsrt")).exists():
-            print("You don't appear to have the gtfsrt data for the date requested! You may need to extract them using BulkDownloader first.")
-            sys.exit(0)
-        entities = get_gtfs_entities_from_directory(str(Path(self.TEMPDIR / "gtfsrt")))
-        print("Got entities as a list")
-        #TODO add lat, long, timestamp here. then drop duplicates before we do any counting
-        # print(entities[0])
-        getter = attrgetter('vehicle.trip.trip_id', 'vehicle.position.latitude', 'vehicle.position.longitude', 'vehicle.timestamp')
-        mapped_data = list(map(getter, entities))
-        # print("mapped_data", mapped_data[0])
-        # print("trip_ids", trip_ids)
-        print("Got all records")
-        # Define column names corresponding to the attributes
+        source = self.get_realtime_source()
+        # Read the entities in fixed-size batches and drop the duplicates in each as we go, so we only
+        # ever hold one batch of raw reports in memory.
+        # A duplicate is the same bus, at the same location, at the same time.
         column_names = ['trip_id', 'latitude', 'longitude', 'timestamp']
+        frames = []
+        for batch in iter_gtfsrt_batches(source, columns=column_names):
+            frames.append(batch.to_pandas().drop_duplicates(subset=column_names))
+        print("Got all records")
 
-        # Create the DataFrame
-        df = pd.DataFrame(mapped_data, columns=column_names)
-        # df = pd.DataFrame(data={'trip_id': trip_ids})
-        # print(df.head().to_csv())
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=column_names)
         print("Added to df")
         print("Dropping dupes")
-        # A duplicate is the same bus, at the same location, at the same time.
-        df = df.drop_duplicates(subset=['trip_id', 'latitude', 'longitude', 'timestamp'])
+        df = df.drop_duplicates(subset=column_names)
         print("Dropped dupes")
         self.df = df
         return df
@@ -109,12 +143,28 @@ class OperatorPerformance():
         print("Got unique trip_ids as a list")
         return unique_ids_realtime
     
-    def load_timetables(self, region:str, date:str):
-        if not (self.TEMPDIR / f"timetables/itm_{region}_gtfs_{date}.zip").exists():
-            print("You don't appear to have the timetables for the date requested! You may need to extract them using BulkDownloader first.")
-            sys.exit(0)
+    def open_timetable(self, region:str, date:str) -> GTFSTimetable:
+        """Open a region's timetable, either unzipped in the temporary directory or in place inside the bulk download."""
+        file_name = f"itm_{region}_gtfs_{date}.zip"
+        if (self.TEMPDIR / "timetables" / file_name).exists():
+            return GTFSTimetable(str(self.TEMPDIR / "timetables" / file_name), columns=TIMETABLE_COLUMNS)
 
-        timetable = GTFSTimetable(str(self.TEMPDIR / f"timetables/itm_{region}_gtfs_{date}.zip"))
+        bulk_download = self.get_bulk_download_path('timetables')
+        if bulk_download.exists():
+            zf = ZipFile(bulk_download)
+            for info in zf.infolist():
+                if Path(info.filename).name == file_name:
+                    # The member stays open, as the timetable's tables are read when first used.
+                    # The CRC and size identify its contents for the timetable cache without hashing it.
+                    return GTFSTimetable(open_zip_member(zf, info), columns=TIMETABLE_COLUMNS,
+                                         cache_key=f"crc-{info.CRC:08x}-{info.file_size}")
+            zf.close()
+
+        print("You don't appear to have the timetables for the date requested! You may need to download them using BulkDownloader first.")
+        sys.exit(0)
+
+    def load_timetables(self, region:str, date:str):
+        timetable = self.open_timetable(region, date)
 
         agency = timetable.dfs['agency']
         routes = timetable.dfs['routes']
@@ -178,20 +228,129 @@ class OperatorPerformance():
 
         return result
     
+    def get_trip_counts(self) -> pl.DataFrame:
+        """
+        Reduce the realtime data to the number of distinct reports (same bus, location and time) per trip_id.
+        This is done once, and is all the performance calculation needs from the realtime data.
+        """
+        column_names = ['trip_id', 'latitude', 'longitude', 'timestamp']
+        frames = [pl.from_arrow(batch).unique() for batch in iter_gtfsrt_batches(self.get_realtime_source(), columns=column_names)]
+        realtime = pl.concat(frames).unique() if frames else pl.DataFrame(schema={'trip_id': pl.String})
+        # trip_id is Categorical in the realtime data, so make it a String to join to the timetables
+        trip_counts = realtime.group_by('trip_id').len(name='count').with_columns(pl.col('trip_id').cast(pl.String))
+        print(f"Counted reports for {Fore.YELLOW}{len(trip_counts)}{Style.RESET_ALL} trip_ids")
+        return trip_counts
+
+    def load_timetable_tables(self, region:str, date:str) -> dict:
+        """Load the tables in TIMETABLE_COLUMNS from a region's timetable as polars DataFrames, with a region column."""
+        timetable = self.open_timetable(region, date)
+        tables = {}
+        for name, columns in TIMETABLE_COLUMNS.items():
+            df = pl.from_pandas(timetable.dfs[name][columns])
+            tables[name] = df.with_columns(
+                [pl.col(col).cast(pl.String) for col in columns if col in ID_COLUMNS] + [pl.lit(region).alias('region')]
+            )
+        return tables
+
+    def performance_for_all_regions(self, regions:list, date:str, trip_counts:pl.DataFrame) -> pl.DataFrame:
+        """
+        Calculate the same per-agency results as trip_id_occurences_per_agency, for every region in one pass.
+
+        The timetables of every region are loaded in parallel and combined, then joined to the realtime
+        counts per trip_id rather than to every realtime report.
+        """
+        with ThreadPoolExecutor(max_workers=len(regions)) as ex:
+            loaded = list(ex.map(lambda region: self.load_timetable_tables(region, date), regions))
+        tables = {name: pl.concat([t[name] for t in loaded], how='vertical_relaxed').lazy() for name in TIMETABLE_COLUMNS}
+        print("Loaded the timetables for all regions.")
+
+        # Start date of the route must be on the given day or earlier, end date is on the given day or after, and service must run on the given day of the week
+        timetable = (tables['agency']
+                     .join(tables['routes'], on=['region', 'agency_id'], how='inner')
+                     .join(tables['trips'], on=['region', 'route_id'], how='inner')
+                     .join(tables['calendar'], on=['region', 'service_id'], how='inner')
+                     .filter((pl.col('start_date') <= self.given_date_as_int) &
+                             (pl.col('end_date') >= self.given_date_as_int) &
+                             (pl.col(self.day_of_week) == 1))
+                     )
+        timetable_counts = timetable.group_by(['region', 'agency_name', 'agency_id']).len(name='timetable')
+
+        count_range = pl.when(pl.col('count') <= COUNT_RANGES[0][0]).then(pl.lit(COUNT_RANGES[0][1]))
+        for upper, label in COUNT_RANGES[1:]:
+            count_range = count_range.when(pl.col('count') <= upper).then(pl.lit(label))
+        real_counts = (timetable.select(['region', 'agency_id', 'agency_name', 'trip_id'])
+                       .join(trip_counts.lazy(), on='trip_id', how='inner')
+                       .group_by(['region', 'agency_id', 'agency_name', 'trip_id']).agg(pl.col('count').sum())
+                       .with_columns(count_range.alias('count_range'))
+                       .filter(pl.col('count_range').is_not_null())
+                       .group_by(['region', 'agency_id', 'count_range']).len()
+                       .collect()
+                       .pivot(on='count_range', index=['region', 'agency_id'], values='len')
+                       )
+        labels = [label for _, label in COUNT_RANGES]
+        real_counts = real_counts.with_columns([pl.lit(0, dtype=pl.UInt32).alias(label) for label in labels if label not in real_counts.columns])
+
+        result = (timetable_counts.collect()
+                  .join(real_counts, on=['region', 'agency_id'], how='inner')
+                  .with_columns(pl.col(labels).fill_null(0))
+                  .sort(['region', 'agency_name', 'agency_id'])
+                  .select(['region', 'agency_name', 'agency_id', 'timetable'] + labels)
+                  )
+        return result
+
+    def run_all_regions(self, regions:list, date:str):
+        """Calculate the performance for every region in one pass and save a CSV per region."""
+        with metrics.stage("realtime"):
+            trip_counts = self.get_trip_counts()
+        with metrics.stage("join") as stage:
+            result = self.performance_for_all_regions(regions, date, trip_counts)
+            stage.count(rows=len(result))
+        with metrics.stage("write") as stage:
+            for region in regions:
+                path = self.TEMPDIR / f"{date}_{region}_performance.csv"
+                result.filter(pl.col('region') == region).drop('region').write_csv(path)
+                stage.count(bytes_written=path.stat().st_size)
+
+    def run_range(self, regions:list, start:str, end:str):
+        """Calculate the performance for every region on every day from start to end, from the archive, and save it as one CSV."""
+        from scripts.python.performance_range import performance_for_range
+        result = performance_for_range(Path(os.environ['BODSARCHIVE']), regions, start, end)
+        with metrics.stage("write") as stage:
+            path = self.TEMPDIR / f"{start}-{end}_performance.csv"
+            result.write_csv(path)
+            stage.count(rows=len(result), bytes_written=path.stat().st_size)
+        print(f"Saved the performance for {start} to {end} to {Fore.MAGENTA}{path}{Style.RESET_ALL}")
+
     def cleanup(self):
-        shutil.rmtree(self.TEMPDIR / 'timetables')
-        shutil.rmtree(self.TEMPDIR / 'gtfsrt')
+        for format in ['timetables', 'gtfsrt']:
+            if (self.TEMPDIR / format).exists():
+                shutil.rmtree(self.TEMPDIR / format)
 
-    def run(self, regions=['north_east', 'north_west', 'yorkshire', 'east_anglia', 'east_midlands', 'west_midlands', 'south_east', 'south_west']):
+    def run(self, regions=REGIONS):
+        with metrics.from_args("operator_performance", self.args):
+            self.run_regions(regions)
+
+    def run_regions(self, regions:list):
         # Set all the dates we need from cmdline args
-        date = self.args.date if self.args.date else (datetime.now() - timedelta(days=1))
+        date = self.args.date if self.args.date else (datetime.now() - timedelta(days=1)).strftime("%Y%m%d")
+        if getattr(self.args, 'end', None):
+            self.run_range(regions, date, self.args.end)
+            return
         self.set_dates(date)
         
-        # Unzip the downloads to temporary directory
-        self.unzip_bulk_download()
+        # Optionally unzip the downloads to temporary directory. Otherwise they are read in place.
+        if self.args.unzip:
+            with metrics.stage("unzip"):
+                self.unzip_bulk_download()
+
+        if self.args.engine == 'polars':
+            self.run_all_regions(regions, date)
+            self.cleanup()
+            return
 
         # Load the entities into a dataframe
-        realtime_df = self.get_entities_as_df()
+        with metrics.stage("realtime"):
+            realtime_df = self.get_entities_as_df()
 
         # Get the trip_ids that appeared in the realtime data
         # realtime_ids = self.get_unique_trip_ids_as_list(realtime_df)
@@ -199,22 +358,25 @@ class OperatorPerformance():
         # TODO ALSO add a count of unique trip_ids. Then we join to timetable. We then have a number of gps points per trip.
         # TODO ADD total # gps points per operator. 
         for region in regions:
+            with metrics.stage("region", region=region):
         
-            # Load the timetable and filter down to given date
-            timetable_for_given_date = self.load_timetables(region, date)
+                # Load the timetable and filter down to given date
+                timetable_for_given_date = self.load_timetables(region, date)
 
-            # Filter the timetable down to the observed trip_ids' trips only
-            # filtered_timetable_based_on_observed_trip_ids = self.filter_timetables_by_trip_id(timetable_for_given_date, realtime_ids=realtime_ids)
+                # Filter the timetable down to the observed trip_ids' trips only
+                # filtered_timetable_based_on_observed_trip_ids = self.filter_timetables_by_trip_id(timetable_for_given_date, realtime_ids=realtime_ids)
             
-            # Calculate the number of trips for both real and timetable, per operator, on a given dat
-            # real = self.group(df=filtered_timetable_based_on_observed_trip_ids, rename_for_trip_id_col='real')
-            # timetable = self.group(df=timetable_for_given_date, rename_for_trip_id_col='timetable') 
+                # Calculate the number of trips for both real and timetable, per operator, on a given dat
+                # real = self.group(df=filtered_timetable_based_on_observed_trip_ids, rename_for_trip_id_col='real')
+                # timetable = self.group(df=timetable_for_given_date, rename_for_trip_id_col='timetable') 
 
-            # result_df = self.calculate_percentage_timetable_in_real(real, timetable)
+                # result_df = self.calculate_percentage_timetable_in_real(real, timetable)
 
-            result = self.trip_id_occurences_per_agency(timetable_for_given_date, realtime_df)
+                result = self.trip_id_occurences_per_agency(timetable_for_given_date, realtime_df)
 
-            result.to_csv(self.TEMPDIR / f"{date}_{region}_performance.csv", index=False)
+                path = self.TEMPDIR / f"{date}_{region}_performance.csv"
+                result.to_csv(path, index=False)
+                metrics.count(bytes_written=path.stat().st_size)
 
         self.cleanup()
     
@@ -1,9 +1,18 @@
 import argparse
-import requests
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
+import shutil
+from datetime import date, datetime, timedelta, timezone
 from pathlib import Path
-from bs4 import BeautifulSoup
-from time import sleep
+try:
+    from scripts.python.download_utils import RateLimiter, make_session, download_file
+    from scripts.python.archive_index import ArchiveIndex, parse_listing
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    from download_utils import RateLimiter, make_session, download_file
+    from archive_index import ArchiveIndex, parse_listing
+    import metrics
 
 class ArchiveDownloader:
     def __init__(self):
@@ -13,14 +22,14 @@ class ArchiveDownloader:
         Attributes:
             args: Parsed command-line arguments.
             format (str): Data format specified by the user.
-            start_year (int): Start year of the download range.
-            start_month (int): Start month of the download range.
-            start_day (int): Start day of the download range.
-            end_year (int): End year of the download range.
-            end_month (int): End month of the download range.
-            end_day (int): End day of the download range.
+            start_date (date): Start date of the download range.
+            end_date (date): End date of the download range (inclusive).
             base_url (str): Base URL for the BODS archive.
-            urls (list): List of URLs to download, generated from the date range and format.
+            days (list): Each calendar day in the range.
+            urls (list): List of URLs to download, one for each day in days.
+            session (requests.Session): Shared session, so connections are reused.
+            limiter (RateLimiter): Token bucket shared by every request (listings and files).
+            index (ArchiveIndex): Cache of listings and downloaded files, or None if turned off.
             OUTDIR (Path): Output directory for downloaded files.
         Steps:
             1. Parse and store command-line arguments.
@@ -32,25 +41,17 @@ class ArchiveDownloader:
         self.args = self._set_args()
 
         self.format = self.args.format
-        self.start_year, self.start_month, self.start_day = self.args.sd.split("/")
-        self.end_year, self.end_month, self.end_day = self.args.ed.split("/")
-
-        self.start_day = int(self.start_day)
-        self.start_month = int(self.start_month)
-        self.start_year = int(self.start_year)
-        self.end_day = int(self.end_day)
-        self.end_month = int(self.end_month)
-        self.end_year = int(self.end_year)
+        self.start_date = date(*map(int, self.args.sd.split("/")))
+        self.end_date = date(*map(int, self.args.ed.split("/")))
 
         self.base_url = "https://data.datalibrary.uk/transport/BODS-ARCHIVE"
-        self.urls = []
-        
-        for y in range(self.start_year, self.end_year + 1):
-            for m in range(self.start_month, self.end_month + 1):
-                for d in range(self.start_day, self.end_day + 1):
-                    # zfill needed to make the correct URL
-                    self.urls.append(f"{self.base_url}/{self.format}/{y}/{str(m).zfill(2)}/{str(d).zfill(2)}/")
-        
+        self.days = [self.start_date + timedelta(days=i) for i in range((self.end_date - self.start_date).days + 1)]
+        self.urls = [f"{self.base_url}/{self.format}/{day.strftime('%Y/%m/%d')}/" for day in self.days]
+
+        self.session = make_session(pool_size=self.args.workers)
+        self.limiter = RateLimiter(rate=self.args.rate)
+        self.index = None if self.args.no_index else ArchiveIndex(self.args.index)
+
         self.OUTDIR = Path(__file__).cwd() / self.args.outpath
         self.OUTDIR.mkdir(parents=True, exist_ok=True)
 
@@ -62,6 +63,11 @@ class ArchiveDownloader:
             -e, --ed: End date as a string in 'YYYY/mm/dd' format.
             -f, --format: Data format, either 'gtfsrt' or 'sirivm'.
             -o, --outpath: Output path to store downloads, relative to the current working directory.
+            -w, --workers: Number of files to download at once.
+            -r, --rate: Most requests per second to make.
+            --index: Path to the listing and download index.
+            --no-index: Don't use the index.
+            --metrics, --prom, --profile: see metrics.add_arguments.
         Returns:
             argparse.Namespace: Parsed command-line arguments.
         """
@@ -70,78 +76,122 @@ class ArchiveDownloader:
         parser.add_argument("-e", "--ed", default='2025/07/01', help="Date string format 'YYYY/mm/dd'")
         parser.add_argument("-f", "--format", default='gtfsrt', help='Either "gtfsrt" or "sirivm"')
         parser.add_argument("-o", "--outpath", default='data', help="Output path to store downloads. Relative to current working directory.")
+        parser.add_argument("-w", "--workers", type=int, default=4, help="Number of files to download at once. Defaults to 4.")
+        parser.add_argument("-r", "--rate", type=float, default=1.0, help="Most requests per second to make, across all workers. Defaults to 1.")
+        parser.add_argument("--index", help="Path to the listing and download index. Defaults to ${BODSCACHE}/archive-index.sqlite")
+        parser.add_argument("--no-index", action="store_true", help="Don't use the index: fetch every listing and don't record downloads.")
+        metrics.add_arguments(parser)
         args = parser.parse_args()
         return args
     
     def _fail_with_exception(self, e):
         print(f"Failed with exception: {e}")
 
-    def _links_from_url(self, url):
+    def _links_from_url(self, url, day):
         """
-        Fetches all links from the given URL, filters for GTFS-RT/SIRI zip files matching a specific pattern,
-        and downloads them to the output directory, respecting a rate limit of 1 request per second.
+        Gets the listing of a day's directory and filters for GTFS-RT/SIRI zip files matching a specific pattern.
+
+        Listings of days that finished more than a day ago don't change, so once indexed they are read from the
+        index without a request. Otherwise the request is conditional on the indexed ETag/Last-Modified.
         
         Args:
-            url (str): The URL of the webpage to scrape for GTFS-RT zip file links.
-        Side Effects:
-            - Downloads matching zip files to self.OUTDIR.
-            - Prints status messages for each link processed.
-            - Sleeps for just over 1 second between requests to respect rate limits.
+            url (str): The URL of the day's directory listing.
+            day (date): The day it lists.
+        Returns:
+            list: The file names to download from the page.
         Notes:
-            - Only files with names matching the pattern 'gtfsrt-YYYYMMDDTHHMMSS.zip' are downloaded.
+            - Only files with names matching the pattern 'gtfsrt-YYYYMMDDTHHMMSS.zip' are returned.
             - Non-matching links are skipped with a printed message.
         """
-        # Try to get the content of a given archive page.
-        try:
-            page_content = requests.get(url)
-        except Exception as e:
-            self._fail_with_exception(e)
-        
-        # Try to parse the archive page, grab the links to files, then get the files themselves.
-        try:
-            text_content = page_content.text
+        cached = self.index.get_listing(url) if self.index else None
+        if cached and cached[3]:
+            hrefs = cached[0]
+        else:
+            headers = {}
+            if cached and cached[1]:
+                headers["If-None-Match"] = cached[1]
+            if cached and cached[2]:
+                headers["If-Modified-Since"] = cached[2]
+            self.limiter.acquire()
+            page_content = self.session.get(url, headers=headers, timeout=60)
+            page_content.raise_for_status()
 
-            soup = BeautifulSoup(text_content, "html.parser")
-        
-            for atag in soup.find_all('a'):
-                href = atag.get("href")
-                href_str = str(href)
-                if not href_str.endswith(".zip"):
-                    # If its not a zip file.
-                    print(f"'{href}'", "is not a zip file.")
-                    
-                elif re.match(re.escape(self.format) + r"-[0-9]{8}T[0-9]{6}.zip", str(href)): # File name must be of form format-yyyymmddTHHMMSS.zip
-                    
-                    full_filepath = url + href # Build the full path for the GET request
-
-                    print("Downloading:", href, "\n")
-
-                    response = requests.get(full_filepath)
-                    
-                    if response.ok:
-                        # Save the file
-                        with open(self.OUTDIR / href, mode="wb") as file:
-                            file.write(response.content)
-                    else:
-                        print(f"Reponse not ok. Status code: {response.status_code}")
-
-                else:
-                    print(f"'{href}'", "is a zip file but not of the right name format. Skipping...\n")
-                
-                # Add this to ensure we obey the rate limit of 1req/s
-                sleep(1.05)
-            
-        except Exception as e:
-            self._fail_with_exception(e)
+            etag = page_content.headers.get("ETag")
+            last_modified = page_content.headers.get("Last-Modified")
+            if page_content.status_code == 304:
+                # A 304 needn't repeat the validators, so keep the indexed ones unless it sends new ones
+                hrefs = cached[0]
+                etag = etag or cached[1]
+                last_modified = last_modified or cached[2]
+            else:
+                hrefs = parse_listing(page_content.text)
+            if self.index:
+                final = day < datetime.now(timezone.utc).date() - timedelta(days=1)
+                self.index.put_listing(url, hrefs, etag, last_modified, final)
 
-    def run(self):
-        for url in self.urls:
+        pattern = re.compile(re.escape(self.format) + r"-[0-9]{8}T[0-9]{6}\.zip") # File name must be of form format-yyyymmddTHHMMSS.zip
+        files = []
+        for href in hrefs:
+            if not href.endswith(".zip"):
+                # If its not a zip file.
+                print(f"'{href}'", "is not a zip file.")
+            elif pattern.fullmatch(href):
+                files.append(href)
+            else:
+                print(f"'{href}'", "is a zip file but not of the right name format. Skipping...\n")
+        return files
+
+    def _download(self, url, href):
+        """
+        Downloads one file into self.OUTDIR, unless it is already there. A copy downloaded earlier (e.g. into
+        another output directory) is linked or copied instead of being fetched again. Partial downloads are
+        resumed. Only requests that are actually made count towards the rate limit.
+        """
+        path = self.OUTDIR / href
+        if path.exists():
+            print(f"'{href}' already downloaded. Skipping...")
+            metrics.count(skipped=1)
+            return
+
+        copy = self.index.find_local_copy(url + href) if self.index else None
+        if copy:
             try:
-                print(f"Downloading data for {url}\n")
-                self._links_from_url(url)
-            except Exception as e:
-                self._fail_with_exception(e)
+                os.link(copy, path)
+            except OSError:
+                shutil.copy2(copy, path)
+            print(f"'{href}' copied from {copy}")
+            return
+
+        meta = {}
+        download_file(self.session, url + href, path, limiter=self.limiter, meta=meta)
+        if self.index:
+            self.index.put_file(url + href, path, **meta)
+        print("Downloaded:", href)
+
+    def run(self):
+        """
+        Lists each day in turn and downloads its files on a pool of self.args.workers threads, so the next
+        day is listed while the last one's files download. Downloads that fail are counted as skipped.
+        """
+        with metrics.from_args("archive_downloader", self.args), metrics.stage("download", format=self.format), \
+                ThreadPoolExecutor(max_workers=self.args.workers) as pool:
+            futures = {}
+            for day, url in zip(self.days, self.urls):
+                try:
+                    print(f"Downloading data for {url}\n")
+                    for href in self._links_from_url(url, day):
+                        futures[pool.submit(self._download, url, href)] = href
+                except Exception as e:
+                    self._fail_with_exception(e)
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"'{futures[future]}'", end=" ")
+                    self._fail_with_exception(e)
+                    metrics.count(skipped=1)
 
 
 if __name__ == "__main__":
-    ArchiveDownloader().run()
\ No newline at end of file
+    ArchiveDownloader().run()
@@ -0,0 +1,417 @@
+"""
+Keep track of the archive's health: how many snapshots (or timetables) each day has, how big it is, and
+where snapshots are missing. This does what health.pl used to do with du, find, zip and zipinfo, without
+going over the whole archive every night.
+
+Day directories are read with os.scandir, and what is found is kept in a SQLite index with each
+directory's mtime. Adding or removing a file changes a directory's mtime, so a day is only read again if its
+mtime has changed, or if it's today. Days that are over and have no day zip get one, built in a pool of
+processes. Snapshots older than a type's keep_days are removed once they are in the day zip.
+
+It writes ${BODSARCHIVE}/free.txt, the days of space left on the archive's disk, and for each type:
+
+    total-bytes.txt     the size of the type's directory, as du -sb would give it
+    days.json           a row for each day, for health.pl's calendar charts (see day_row), and the days
+                        between the first and last that have no directory at all
+"""
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from zipfile import ZipFile, ZIP_STORED, BadZipFile
+from colorama import Fore, Style
+try:
+    from scripts.python.gtfsrt_container import timestamp_from_name
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    from gtfsrt_container import timestamp_from_name
+    import metrics
+
+# The types of data in the archive. Snapshots of the realtime feeds are removed from their directories after
+# keep_days, leaving the day zip. Files matching filepattern are what is counted for each day, and zipped up.
+TYPES = {
+    "gtfsrt": {"keep_days": 60},
+    "sirivm": {"keep_days": 60},
+    "timetables": {"filepattern": "*_gtfs_[0-9]*.zip"},
+}
+# A gap is this many seconds or more without a snapshot (archive.sh takes one every 30s)
+GAP_SECONDS = 300
+# Bytes the archive grows by each day, to turn free space into days
+BYTES_PER_DAY = 2 * 90e9 / 7
+
+def get_default_index_path() -> Path:
+    """The default location of the index, ${BODSCACHE}/archive-health.sqlite, or ~/.cache/bods-archive/archive-health.sqlite."""
+    return Path(os.environ.get("BODSCACHE", Path.home() / ".cache" / "bods-archive")) / "archive-health.sqlite"
+
+def human_bytes(size) -> str:
+    """A size in bytes as health.pl wrote it, e.g. 1.5 GB."""
+    if size > 1e12:
+        return f"{size / 1e12:0.2f} TB"
+    if size > 1e9:
+        return f"{size / 1e9:0.2f} GB"
+    if size > 1e6:
+        return f"{size / 1e6:0.1f} MB"
+    if size > 1e3:
+        return f"{size / 1e3:0.1f} kB"
+    return str(size)
+
+def tree_bytes(path) -> int:
+    """The apparent size of everything in a directory, including the directories, like du -sb."""
+    size = os.stat(path, follow_symlinks=False).st_size
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                size += tree_bytes(entry.path)
+            else:
+                size += entry.stat(follow_symlinks=False).st_size
+    return size
+
+def find_gaps(times:list, date:str, finished=True) -> dict:
+    """
+    When a day's first and last snapshots were taken, its longest stretch without one and how many stretches
+    of GAP_SECONDS or more there were. The start of the day counts as a snapshot, and so does the end if
+    the day is over.
+
+    :param times: The epoch seconds the snapshots were taken.
+    :param date: The day, as 'YYYYmmdd'.
+    :param finished: Whether the day is over.
+    """
+    start = int(datetime.strptime(date, "%Y%m%d").replace(tzinfo=timezone.utc).timestamp())
+    times = sorted(times)
+    points = [start] + times + ([start + 86400] if finished else [])
+    intervals = [b - a for a, b in zip(points, points[1:])]
+    clock = lambda t: datetime.fromtimestamp(t, timezone.utc).strftime("%H:%M:%S")
+    return {
+        "first": clock(times[0]) if times else None,
+        "last": clock(times[-1]) if times else None,
+        "max_gap": max(intervals, default=0),
+        "gaps": sum(interval >= GAP_SECONDS for interval in intervals),
+    }
+
+def scan_day(type:str, day_dir:str, date:str, today:str) -> dict:
+    """
+    Read a day's directory.
+
+    :param type: One of TYPES.
+    :param day_dir: The directory, ${BODSARCHIVE}/TYPE/YYYY/MM/DD.
+    :param date: The day, as 'YYYYmmdd'.
+    :param today: Today (UTC), as 'YYYYmmdd'.
+    :return: The day's row in the index: the directory's mtime, the files matching the type's pattern
+        (snapshots), the files counted for the day (the snapshots or, once they are removed, the members of
+        the day zip), the size of the directory and of the day zip (None if there isn't one), and for the
+        realtime types the gaps between snapshots (see find_gaps).
+    """
+    pattern = TYPES[type].get("filepattern", f"{type}-{date}T*.zip")
+    day_zip_name = f"{type}-{date}.zip"
+    stat = os.stat(day_dir)
+    row = {"date": date, "mtime_ns": stat.st_mtime_ns, "snapshots": 0, "files": 0, "dir_bytes": stat.st_size,
+           "day_zip_bytes": None, "first": None, "last": None, "max_gap": None, "gaps": None}
+    names = []
+    with os.scandir(day_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                row["dir_bytes"] += tree_bytes(entry.path)
+                continue
+            size = entry.stat(follow_symlinks=False).st_size
+            row["dir_bytes"] += size
+            if entry.name == day_zip_name:
+                row["day_zip_bytes"] = size
+            elif fnmatch.fnmatchcase(entry.name, pattern):
+                names.append(entry.name)
+    row["snapshots"] = row["files"] = len(names)
+
+    if not names and row["day_zip_bytes"] is not None:
+        try:
+            with ZipFile(os.path.join(day_dir, day_zip_name)) as zf:
+                names = [info.filename for info in zf.infolist() if not info.is_dir()]
+        except BadZipFile:
+            print(f"{Fore.RED}{day_zip_name} is corrupted{Style.RESET_ALL}")
+            metrics.count(corrupt=1)
+        row["files"] = len(names)
+    if "keep_days" in TYPES[type]:
+        times = [t for t in map(timestamp_from_name, names) if t is not None]
+        row.update(find_gaps(times, date, finished=date < today))
+    return row
+
+def build_day_zip(day_dir:str, day_zip:str, pattern:str) -> int:
+    """
+    Zip up a day's snapshots (the files matching pattern) into its day zip, and return its size. They are
+    already compressed, so they are stored as they are. This runs in a worker process.
+    """
+    names = sorted(name for name in os.listdir(day_dir) if fnmatch.fnmatchcase(name, pattern))
+    tmp = day_zip + ".tmp"
+    with ZipFile(tmp, "w", compression=ZIP_STORED) as zf:
+        for name in names:
+            zf.write(os.path.join(day_dir, name), arcname=name)
+    os.replace(tmp, day_zip)
+    return os.path.getsize(day_zip)
+
+def remove_snapshots(day_dir:str, day_zip:str, pattern:str) -> int:
+    """
+    Remove a day's snapshots that are in its day zip, and return how many were removed. Any that aren't in
+    the day zip are left where they are.
+    """
+    with ZipFile(day_zip) as zf:
+        zipped = {os.path.basename(name) for name in zf.namelist()}
+    removed = 0
+    for name in sorted(os.listdir(day_dir)):
+        if not fnmatch.fnmatchcase(name, pattern):
+            continue
+        if name in zipped:
+            os.remove(os.path.join(day_dir, name))
+            removed += 1
+        else:
+            print(f"{Fore.YELLOW}{name} isn't in {day_zip}, so it's been kept{Style.RESET_ALL}")
+    return removed
+
+def day_row(type:str, row:dict, today:str) -> dict:
+    """
+    A day's row for the calendar charts, with the fields health.pl used to build (date, files, value, bytes,
+    byteshuman and links), and the gaps.
+    """
+    date = row["date"]
+    path = f"{date[0:4]}/{date[4:6]}/{date[6:8]}"
+    size = row["day_zip_bytes"] or 0
+    links = []
+    # Once the snapshots have gone, there is only the day zip to link to
+    if row["snapshots"] or row["day_zip_bytes"] is None:
+        links.append(f'<a href="{path}/">Directory</a>')
+    if row["day_zip_bytes"] is not None and date < today:
+        links.append(f'<a href="{path}/{type}-{date}.zip">Download day</a> (<span class="size">{{{{ byteshuman }}}}</span>)')
+    return {
+        "date": f"{date[0:4]}-{date[4:6]}-{date[6:8]}",
+        "files": row["files"],
+        "value": f"{row['files']:,}",
+        "bytes": size,
+        "byteshuman": human_bytes(size),
+        "links": "\n".join(links),
+        "dir_bytes": row["dir_bytes"],
+        "first": row["first"],
+        "last": row["last"],
+        "max_gap": row["max_gap"],
+        "gaps": row["gaps"],
+    }
+
+def write_text(path:Path, text:str):
+    """Write a file atomically, as the web server may be reading it."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+class HealthIndex:
+    """What was found in each day directory of the archive, with the directory's mtime when it was read."""
+    def __init__(self, path=None):
+        """
+        :param path: The SQLite file. Defaults to get_default_index_path().
+        """
+        self.path = Path(path or get_default_index_path())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS days (
+                type_dir TEXT NOT NULL,
+                date TEXT NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                snapshots INTEGER NOT NULL,
+                files INTEGER NOT NULL,
+                dir_bytes INTEGER NOT NULL,
+                day_zip_bytes INTEGER,
+                first TEXT,
+                last TEXT,
+                max_gap INTEGER,
+                gaps INTEGER,
+                PRIMARY KEY (type_dir, date)
+            );
+        """)
+
+    def get_days(self, type_dir:str) -> dict:
+        """The rows of the days in a type's directory, by date."""
+        rows = self.db.execute("SELECT * FROM days WHERE type_dir = ?", (type_dir,))
+        return {row["date"]: {key: row[key] for key in row.keys() if key != "type_dir"} for row in rows}
+
+    def put_days(self, type_dir:str, rows:list, removed=()):
+        """Record the rows of a type's days, replacing any earlier ones, and forget the days that have been removed."""
+        with self.db:
+            self.db.executemany("DELETE FROM days WHERE type_dir = ? AND date = ?", [(type_dir, date) for date in removed])
+            self.db.executemany(
+                "INSERT OR REPLACE INTO days VALUES (:type_dir, :date, :mtime_ns, :snapshots, :files, :dir_bytes, :day_zip_bytes, :first, :last, :max_gap, :gaps)",
+                [{"type_dir": type_dir, **row} for row in rows],
+            )
+
+    def close(self):
+        self.db.close()
+
+class ArchiveHealth:
+    def __init__(self, archive=None, index=None, workers=None, zip_days=True, remove=True, full=False):
+        """
+        :param archive: The archive. Defaults to ${BODSARCHIVE}.
+        :param index: A HealthIndex. Defaults to the one at get_default_index_path().
+        :param workers: Processes to build day zips with. Defaults to the number of CPUs.
+        :param zip_days: Build the day zips that are missing.
+        :param remove: Remove snapshots older than each type's keep_days once they are in the day zip.
+        :param full: Read every day again, rather than only those that have changed.
+        """
+        self.archive = Path(archive or os.environ["BODSARCHIVE"]).resolve()
+        self.index = index or HealthIndex()
+        self.workers = workers
+        self.zip_days = zip_days
+        self.remove = remove
+        self.full = full
+        self.today = datetime.now(timezone.utc).strftime("%Y%m%d")
+
+    def walk(self, type_dir:Path) -> tuple:
+        """
+        Find the day directories of a type.
+
+        :return: A list of (date, path, mtime_ns) for each day, and the bytes in the type's directory that
+            aren't in a day directory (the year and month directories, and any other files).
+        """
+        days, other_bytes = [], 0
+        # Years, months and days are directories with 4, 2 and 2 digit names. Anything else is only counted.
+        def is_part(entry, digits):
+            return entry.is_dir(follow_symlinks=False) and len(entry.name) == digits and entry.name.isdigit()
+        other_bytes += os.stat(type_dir, follow_symlinks=False).st_size
+        with os.scandir(type_dir) as years:
+            for year in years:
+                if not is_part(year, 4):
+                    other_bytes += tree_bytes(year.path) if year.is_dir(follow_symlinks=False) else year.stat(follow_symlinks=False).st_size
+                    continue
+                other_bytes += year.stat(follow_symlinks=False).st_size
+                with os.scandir(year.path) as months:
+                    for month in months:
+                        if not is_part(month, 2):
+                            other_bytes += tree_bytes(month.path) if month.is_dir(follow_symlinks=False) else month.stat(follow_symlinks=False).st_size
+                            continue
+                        other_bytes += month.stat(follow_symlinks=False).st_size
+                        with os.scandir(month.path) as day_entries:
+                            for day in day_entries:
+                                if not is_part(day, 2):
+                                    other_bytes += tree_bytes(day.path) if day.is_dir(follow_symlinks=False) else day.stat(follow_symlinks=False).st_size
+                                    continue
+                                days.append((year.name + month.name + day.name, day.path, day.stat().st_mtime_ns))
+        return sorted(days), other_bytes
+
+    def update_type(self, type:str) -> list:
+        """
+        Bring the index of a type up to date, zip up its finished days and remove its old snapshots, then
+        write its total-bytes.txt and days.json.
+
+        :return: The rows of its days in the index.
+        """
+        type_dir = self.archive / type
+        if not type_dir.is_dir():
+            print(f"There is no {Fore.CYAN}{type_dir}{Style.RESET_ALL}")
+            return []
+        settings = TYPES[type]
+        known = self.index.get_days(str(type_dir))
+
+        with metrics.stage("index", type=type) as stage:
+            days, other_bytes = self.walk(type_dir)
+            paths, rows, changed = {}, {}, []
+            for date, path, mtime_ns in days:
+                paths[date] = path
+                row = known.get(date)
+                if self.full or row is None or row["mtime_ns"] != mtime_ns or date >= self.today:
+                    row = scan_day(type, path, date, self.today)
+                    changed.append(date)
+                rows[date] = row
+            stage.count(rows=len(changed), skipped=len(days) - len(changed))
+        print(f"{Fore.CYAN}{type}{Style.RESET_ALL}: {len(days)} days, {Fore.YELLOW}{len(changed)}{Style.RESET_ALL} read again")
+
+        to_zip = [date for date, row in rows.items() if self.zip_days and date < self.today and row["day_zip_bytes"] is None and row["snapshots"]]
+        if to_zip:
+            with metrics.stage("zip", type=type) as stage, ProcessPoolExecutor(max_workers=self.workers) as executor:
+                futures = {}
+                for date in to_zip:
+                    pattern = settings.get("filepattern", f"{type}-{date}T*.zip")
+                    futures[executor.submit(build_day_zip, paths[date], os.path.join(paths[date], f"{type}-{date}.zip"), pattern)] = date
+                for future in as_completed(futures):
+                    date = futures[future]
+                    try:
+                        stage.count(bytes_written=future.result(), rows=1)
+                    except Exception as e:
+                        print(f"{Fore.RED}Couldn't zip up {date}: {e}{Style.RESET_ALL}")
+                        metrics.count(corrupt=1)
+                        continue
+                    print(f"Created the zip archive for {Fore.GREEN}{date}{Style.RESET_ALL}")
+                    rows[date] = scan_day(type, paths[date], date, self.today)
+                    changed.append(date)
+
+        if self.remove and "keep_days" in settings:
+            recent = (datetime.now(timezone.utc) - timedelta(days=settings["keep_days"])).strftime("%Y%m%d")
+            to_remove = [date for date, row in rows.items() if date < recent and row["snapshots"] and row["day_zip_bytes"] is not None]
+            if to_remove:
+                with metrics.stage("remove", type=type) as stage:
+                    for date in to_remove:
+                        pattern = f"{type}-{date}T*.zip"
+                        removed = remove_snapshots(paths[date], os.path.join(paths[date], f"{type}-{date}.zip"), pattern)
+                        print(f"Removed {Fore.YELLOW}{removed}{Style.RESET_ALL} snapshots from {paths[date]}")
+                        stage.count(rows=removed)
+                        rows[date] = scan_day(type, paths[date], date, self.today)
+                        changed.append(date)
+
+        self.index.put_days(str(type_dir), [rows[date] for date in set(changed)], removed=set(known) - set(rows))
+        self.write_type(type, type_dir, rows, other_bytes)
+        return list(rows.values())
+
+    def write_type(self, type:str, type_dir:Path, rows:dict, other_bytes:int):
+        """Write a type's total-bytes.txt and days.json."""
+        total = other_bytes + sum(row["dir_bytes"] for row in rows.values())
+        print(f"Save {Fore.YELLOW}{type}{Style.RESET_ALL} size ({Fore.GREEN}{human_bytes(total)}{Style.RESET_ALL}) to {Fore.CYAN}{type_dir / 'total-bytes.txt'}{Style.RESET_ALL}")
+        write_text(type_dir / "total-bytes.txt", human_bytes(total))
+
+        dates = sorted(rows)
+        missing = []
+        if dates:
+            day, last = (datetime.strptime(date, "%Y%m%d").date() for date in (dates[0], dates[-1]))
+            while day < last:
+                if day.strftime("%Y%m%d") not in rows:
+                    missing.append(day.isoformat())
+                day += timedelta(days=1)
+        write_text(type_dir / "days.json", json.dumps({
+            "type": type,
+            "updated": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "total_bytes": total,
+            "days": [day_row(type, rows[date], self.today) for date in dates],
+            "missing": missing,
+        }, indent=1))
+
+    def write_free(self):
+        """Write free.txt: the days until the disk the archive is on is full, at BYTES_PER_DAY."""
+        days = int(shutil.disk_usage(self.archive).free / BYTES_PER_DAY)
+        write_text(self.archive / "free.txt", f"{days} days")
+
+    def run(self, types=None):
+        self.write_free()
+        for type in sorted(types or TYPES):
+            self.update_type(type)
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Index the archive's days, zip up finished days and write the health files.")
+    parser.add_argument("--archive", help="The archive. Defaults to ${BODSARCHIVE}.")
+    parser.add_argument("-t", "--types", nargs="+", choices=list(TYPES), help="Types to index. Defaults to all of them.")
+    parser.add_argument("-w", "--workers", type=int, help="Processes to build day zips with. Defaults to the number of CPUs.")
+    parser.add_argument("--index", help="Path to the index. Defaults to ${BODSCACHE}/archive-health.sqlite")
+    parser.add_argument("--full", action="store_true", help="Read every day again, not only those that have changed")
+    parser.add_argument("--no-zip", action="store_true", help="Don't build missing day zips")
+    parser.add_argument("--no-remove", action="store_true", help="Don't remove old snapshots")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    index = HealthIndex(args.index)
+    health = ArchiveHealth(archive=args.archive, index=index, workers=args.workers, zip_days=not args.no_zip,
+                           remove=not args.no_remove, full=args.full)
+    with metrics.from_args("archive_health", args):
+        health.run(args.types)
+    index.close()
@@ -0,0 +1,105 @@
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+
+HREF_PATTERN = re.compile(r'href="([^"?#]+)"', re.IGNORECASE)
+
+def get_default_index_path() -> Path:
+    """The default location of the index, ${BODSCACHE}/archive-index.sqlite, or ~/.cache/bods-archive/archive-index.sqlite."""
+    return Path(os.environ.get("BODSCACHE", Path.home() / ".cache" / "bods-archive")) / "archive-index.sqlite"
+
+def parse_listing(html:str) -> list:
+    """The hrefs in an archive directory listing, in order. A regex is enough for these generated pages."""
+    return HREF_PATTERN.findall(html)
+
+class ArchiveIndex:
+    """
+    A persistent record of the archive's directory listings and the files downloaded from it, so crawls
+    don't fetch what hasn't changed.
+
+    Listings of days that are over are final, so they are answered from the index without a request.
+    Listings of recent days are kept with their ETag and Last-Modified, to make conditional requests.
+    Downloaded files are recorded with their size, ETag, Last-Modified and local path, so a copy that is
+    already on disk somewhere else can be reused.
+    """
+    def __init__(self, path=None):
+        """
+        :param path: The SQLite file. Defaults to get_default_index_path().
+        """
+        self.path = Path(path or get_default_index_path())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # downloads run on several threads, so share one connection behind a lock
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS listings (
+                url TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                final INTEGER NOT NULL,
+                fetched_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS listing_entries (
+                listing_url TEXT NOT NULL REFERENCES listings(url),
+                href TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                PRIMARY KEY (listing_url, href)
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                url TEXT PRIMARY KEY,
+                name TEXT NOT NULL,
+                size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                local_path TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_name ON files(name);
+        """)
+
+    def get_listing(self, url:str):
+        """
+        :return: (hrefs, etag, last_modified, final) for a listing in the index, or None.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT etag, last_modified, final FROM listings WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            hrefs = [href for href, in self.db.execute("SELECT href FROM listing_entries WHERE listing_url = ? ORDER BY position", (url,))]
+        return hrefs, row[0], row[1], bool(row[2])
+
+    def put_listing(self, url:str, hrefs:list, etag=None, last_modified=None, final=False):
+        """Record a listing, replacing any earlier copy."""
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM listing_entries WHERE listing_url = ?", (url,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                (url, etag, last_modified, int(final), datetime.now(timezone.utc).isoformat()),
+            )
+            self.db.executemany("INSERT OR IGNORE INTO listing_entries VALUES (?, ?, ?)", [(url, href, i) for i, href in enumerate(hrefs)])
+
+    def put_file(self, url:str, local_path:Path, etag=None, last_modified=None):
+        """Record a file that has been downloaded to local_path."""
+        local_path = Path(local_path)
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                (url, local_path.name, local_path.stat().st_size, etag, last_modified, str(local_path.resolve())),
+            )
+
+    def find_local_copy(self, url:str):
+        """
+        :return: The path of a downloaded copy of url that is still on disk with the size it was downloaded
+            at, or None.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT size, local_path FROM files WHERE url = ?", (url,)).fetchone()
+        if row and row[1] and os.path.exists(row[1]) and os.path.getsize(row[1]) == row[0]:
+            return Path(row[1])
+        return None
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,412 @@
+"""
+Run jobs over a range of days, and keep a ledger of what was run, from which inputs, and what it made, so
+that history can be reprocessed without doing any day twice.
+
+Jobs:
+
+    csv         gtfsrt_to_csv for the day, into ${BODSARCHIVE}/csv/YYYY/
+    parquet     GTFSRT2Parquet().run for the day, into the day's directory
+    operator    OperatorPerformance for the day, from the day zip and the day's timetables, into
+                ${BODSARCHIVE}/operator-performance/YYYY/
+
+Each job's inputs are fingerprinted by their names, sizes and mtimes (reading them all would take as long
+as the jobs), along with the options that change its output. A day is skipped if the ledger has it done
+with the same fingerprint and its outputs are still there. The ledger is updated as each day starts and
+finishes, so a backfill that is stopped part way can be run again to carry on from where it was.
+
+Days run in a pool of processes, each in a fresh process with its own working directory and log. As well
+as the number of workers, what runs at once is limited by memory: each day's peak memory is estimated from
+its input size, using the memory per input byte the job needed on the biggest day it has done (or
+DEFAULT_MEMORY_RATIO until it has done one). Days are only started while the estimates of those running fit
+in --memory, but a day always runs if nothing else is running, however big it is. The estimates can be
+wrong: if a day's process is killed anyway (e.g. by the OOM killer), the days running with it are recorded
+as failed, and the backfill carries on with a new pool.
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from colorama import Fore, Style
+try:
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    import metrics
+
+JOBS = ["csv", "parquet", "operator"]
+# Peak memory per byte of input, for jobs that haven't run yet
+DEFAULT_MEMORY_RATIO = {"csv": 8, "parquet": 4, "operator": 2}
+
+def get_default_ledger_path() -> Path:
+    """The default location of the ledger, ${BODSCACHE}/backfill.sqlite, or ~/.cache/bods-archive/backfill.sqlite."""
+    return Path(os.environ.get("BODSCACHE", Path.home() / ".cache" / "bods-archive")) / "backfill.sqlite"
+
+def parse_date(value:str) -> str:
+    """A date as 'YYYYmmdd', from 'YYYYmmdd', 'YYYY-mm-dd' or 'YYYY/mm/dd'."""
+    return datetime.strptime(value.replace("-", "").replace("/", ""), "%Y%m%d").strftime("%Y%m%d")
+
+def get_available_memory() -> int:
+    """The bytes of memory available to start new processes with (MemAvailable on Linux, otherwise the free memory)."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+def day_dir(archive:Path, feed:str, date:str) -> Path:
+    return archive / feed / date[0:4] / date[4:6] / date[6:8]
+
+def get_regions(archive:Path, date:str) -> list:
+    """The regions in OperatorPerformance.REGIONS with a timetable in the archive for the day."""
+    from scripts.python.OperatorPerformance import REGIONS
+    timetables = day_dir(archive, "timetables", date)
+    return [region for region in REGIONS if (timetables / f"itm_{region}_gtfs_{date}.zip").exists()]
+
+def get_inputs(job:str, archive:Path, date:str, options:dict) -> list:
+    """The files a job reads for a day. It can't run if there aren't any."""
+    feed = "gtfsrt" if job == "operator" else options["feed"]
+    directory = day_dir(archive, feed, date)
+    if job == "csv":
+        # gtfs_realtime_utils.iter_gtfsrt_binaries reads every zip in the directory
+        return sorted(directory.glob("*.zip")) if directory.is_dir() else []
+    day_zip = directory / f"{feed}-{date}.zip"
+    if not day_zip.exists():
+        return []
+    if job == "parquet":
+        return [day_zip]
+    timetables = day_dir(archive, "timetables", date)
+    regions = get_regions(archive, date)
+    return [day_zip] + [timetables / f"itm_{region}_gtfs_{date}.zip" for region in regions] if regions else []
+
+def get_outputs(job:str, archive:Path, date:str, options:dict) -> list:
+    """The files a job makes for a day."""
+    if job == "csv":
+        from gtfsrt_to_csv import get_output_path
+        return [Path(get_output_path(f"{date[0:4]}/{date[4:6]}/{date[6:8]}", feed=options["feed"], archive=str(archive)))]
+    if job == "parquet":
+        return [day_dir(archive, options["feed"], date) / f"all_bus_locations_deduplicated_{date}.parquet"]
+    return [archive / "operator-performance" / date[0:4] / f"{date}_{region}_performance.csv" for region in get_regions(archive, date)]
+
+def get_params(job:str, options:dict) -> dict:
+    """The options that change a job's output."""
+    if job == "csv":
+        return {"feed": options["feed"], "delta": options["delta"]}
+    if job == "parquet":
+        return {"feed": options["feed"]}
+    return {}
+
+def fingerprint(paths:list, params:dict) -> tuple:
+    """
+    :return: A hash of the names, sizes and mtimes of the input files and the params, the files as
+        [name, size, mtime_ns], and their total size.
+    """
+    files = []
+    for path in paths:
+        stat = os.stat(path)
+        files.append([str(path), stat.st_size, stat.st_mtime_ns])
+    digest = hashlib.sha256(json.dumps([files, params], sort_keys=True).encode()).hexdigest()
+    return digest, files, sum(size for _, size, _ in files)
+
+def run_csv(archive:Path, date:str, options:dict, work:Path):
+    from gtfsrt_to_csv import convert
+    datestring = f"{date[0:4]}/{date[4:6]}/{date[6:8]}"
+    convert(datestring, str(get_outputs("csv", archive, date, options)[0]), feed=options["feed"],
+            delta=options["delta"], workers=options["decode_workers"])
+
+def run_parquet(archive:Path, date:str, options:dict, work:Path):
+    try:
+        from scripts.python.gtfsrt_to_parquet import GTFSRT2Parquet
+    except ModuleNotFoundError:
+        from gtfsrt_to_parquet import GTFSRT2Parquet
+    iso = datetime.strptime(date, "%Y%m%d").date().isoformat()
+    GTFSRT2Parquet().run(date=iso, workers=options["decode_workers"], buckets=options["buckets"], feed=options["feed"])
+
+def run_operator(archive:Path, date:str, options:dict, work:Path):
+    """OperatorPerformance's polars engine, reading the day zip and timetables in place through links in its temporary directory."""
+    from scripts.python.OperatorPerformance import OperatorPerformance
+    regions = get_regions(archive, date)
+    temp = work / "temp"
+    (temp / "timetables").mkdir(parents=True, exist_ok=True)
+    (temp / f"gtfsrt-{date}.zip").symlink_to(day_dir(archive, "gtfsrt", date) / f"gtfsrt-{date}.zip")
+    for region in regions:
+        name = f"itm_{region}_gtfs_{date}.zip"
+        (temp / "timetables" / name).symlink_to(day_dir(archive, "timetables", date) / name)
+    op = OperatorPerformance(args=argparse.Namespace(date=date, unzip=False, engine="polars"))
+    op.run_regions(regions)
+    out_dir = archive / "operator-performance" / date[0:4]
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for region in regions:
+        shutil.move(temp / f"{date}_{region}_performance.csv", out_dir / f"{date}_{region}_performance.csv")
+
+def run_task(job:str, archive:str, date:str, options:dict, work:str, log_path:str) -> dict:
+    """
+    Run a job for a day. This runs in its own worker process, in an empty working directory, with what it
+    prints going to log_path.
+
+    :return: Its stages (see metrics), how long it took and its peak memory.
+    """
+    archive, work = Path(archive), Path(work)
+    os.environ["BODSARCHIVE"] = str(archive)
+    # The stages are sent back to be recorded with the backfill's run, so this process doesn't write them
+    os.environ.pop("BODSMETRICS", None)
+    os.environ.pop("BODSPROM", None)
+    shutil.rmtree(work, ignore_errors=True)
+    work.mkdir(parents=True)
+    os.chdir(work)
+    run = metrics.start_run(f"backfill_{job}")
+    status = "error"
+    with open(log_path, "w") as log, contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            {"csv": run_csv, "parquet": run_parquet, "operator": run_operator}[job](archive, date, options, work)
+            status = "ok"
+        except SystemExit as e:
+            # The scripts exit when their inputs are missing, which would stop the pool
+            raise RuntimeError(f"{job} exited with {e.code}") from None
+        finally:
+            summary = metrics.finish_run(status)
+    os.chdir(work.parent)
+    shutil.rmtree(work, ignore_errors=True)
+    return {"stages": run.stages, "seconds": summary["seconds"], "peak_rss_bytes": summary["peak_rss_bytes"]}
+
+class Ledger:
+    """The latest run of each job for each day: its status, the fingerprint of its inputs and its outputs."""
+    def __init__(self, path=None):
+        """
+        :param path: The SQLite file. Defaults to get_default_ledger_path().
+        """
+        self.path = Path(path or get_default_ledger_path())
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                job TEXT NOT NULL,
+                date TEXT NOT NULL,
+                status TEXT NOT NULL,
+                fingerprint TEXT,
+                params TEXT,
+                inputs TEXT,
+                input_bytes INTEGER,
+                outputs TEXT,
+                started TEXT,
+                finished TEXT,
+                seconds REAL,
+                peak_rss_bytes INTEGER,
+                error TEXT,
+                log TEXT,
+                PRIMARY KEY (job, date)
+            );
+        """)
+
+    def get(self, job:str, date:str):
+        return self.db.execute("SELECT * FROM runs WHERE job = ? AND date = ?", (job, date)).fetchone()
+
+    def start(self, task:dict, log:str):
+        """Record that a day's job has started. If the backfill is killed, it stays 'running' and is run again next time."""
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO runs (job, date, status, fingerprint, params, inputs, input_bytes, started, log) VALUES (?, ?, 'running', ?, ?, ?, ?, ?, ?)",
+                (task["job"], task["date"], task["fingerprint"], json.dumps(task["params"]), json.dumps(task["inputs"]),
+                 task["input_bytes"], datetime.now(timezone.utc).isoformat(timespec="seconds"), log),
+            )
+
+    def finish(self, task:dict, status:str, outputs=None, seconds=None, peak_rss_bytes=None, error=None):
+        """Record how a day's job ended: 'done' with its outputs as [path, size], or 'failed' with the error."""
+        with self.db:
+            self.db.execute(
+                "UPDATE runs SET status = ?, outputs = ?, finished = ?, seconds = ?, peak_rss_bytes = ?, error = ? WHERE job = ? AND date = ?",
+                (status, json.dumps(outputs) if outputs is not None else None, datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                 seconds, peak_rss_bytes, error, task["job"], task["date"]),
+            )
+
+    def is_done(self, task:dict) -> bool:
+        """Whether a day's job has been done from the same inputs, and its outputs are still there as they were made."""
+        row = self.get(task["job"], task["date"])
+        if row is None or row["status"] != "done" or row["fingerprint"] != task["fingerprint"]:
+            return False
+        return all(os.path.exists(path) and os.path.getsize(path) == size for path, size in json.loads(row["outputs"]))
+
+    def memory_ratio(self, job:str) -> float:
+        """
+        The memory per byte of input a job needed on the biggest day it has done, or DEFAULT_MEMORY_RATIO if
+        it hasn't done one. Small days need more per byte, as the libraries take the same memory whatever
+        the day, so the biggest day is the best guess for the big ones.
+        """
+        row = self.db.execute("SELECT 1.0 * peak_rss_bytes / input_bytes FROM runs WHERE job = ? AND status = 'done' AND input_bytes > 0 AND peak_rss_bytes > 0 ORDER BY input_bytes DESC LIMIT 1", (job,)).fetchone()
+        return row[0] if row else DEFAULT_MEMORY_RATIO[job]
+
+    def summary(self, start:str, end:str) -> list:
+        """The number of days of each job in each status from start to end."""
+        return self.db.execute("SELECT job, status, COUNT(*) AS days FROM runs WHERE date BETWEEN ? AND ? GROUP BY job, status ORDER BY job, status", (start, end)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+class Backfill:
+    def __init__(self, jobs=JOBS, archive=None, ledger=None, workers=None, memory=None, workdir="backfill-work", force=False, **options):
+        """
+        :param jobs: The jobs to run, from JOBS.
+        :param archive: The archive. Defaults to ${BODSARCHIVE}.
+        :param ledger: A Ledger. Defaults to the one at get_default_ledger_path().
+        :param workers: The most days to run at once. Defaults to the number of CPUs.
+        :param memory: The bytes of memory the days running at once can use. Defaults to 80% of the memory available.
+        :param workdir: Where to make each day's working directory, and keep its log.
+        :param force: Run every day again, even if it's done.
+        :param options: feed ("gtfsrt" or "sirivm", for csv and parquet), delta (for csv), buckets (for
+            parquet) and decode_workers (processes for each day to decode with, for parquet and SIRI-VM csv).
+        """
+        self.jobs = [job for job in JOBS if job in jobs]
+        self.archive = Path(archive or os.environ["BODSARCHIVE"]).resolve()
+        self.ledger = ledger or Ledger()
+        self.workers = workers or os.cpu_count()
+        self.memory = memory or int(0.8 * get_available_memory())
+        self.workdir = Path(workdir).resolve()
+        self.force = force
+        self.options = {"feed": "gtfsrt", "delta": False, "buckets": None, "decode_workers": None, **options}
+
+    def plan(self, start:str, end:str) -> list:
+        """The days and jobs from start to end that need running, in order."""
+        tasks, done, missing = [], 0, 0
+        day, last = datetime.strptime(start, "%Y%m%d"), datetime.strptime(end, "%Y%m%d")
+        while day <= last:
+            date = day.strftime("%Y%m%d")
+            for job in self.jobs:
+                inputs = get_inputs(job, self.archive, date, self.options)
+                if not inputs:
+                    missing += 1
+                    continue
+                params = get_params(job, self.options)
+                digest, files, input_bytes = fingerprint(inputs, params)
+                task = {"job": job, "date": date, "fingerprint": digest, "params": params, "inputs": files, "input_bytes": input_bytes}
+                if not self.force and self.ledger.is_done(task):
+                    done += 1
+                    continue
+                tasks.append(task)
+            day += timedelta(days=1)
+        print(f"{Fore.YELLOW}{len(tasks)}{Style.RESET_ALL} to run, {Fore.GREEN}{done}{Style.RESET_ALL} already done and {missing} without inputs")
+        return tasks
+
+    def run(self, start:str, end:str, dry_run=False):
+        tasks = self.plan(start, end)
+        if dry_run:
+            for task in tasks:
+                print(f"{task['date']} {Fore.CYAN}{task['job']}{Style.RESET_ALL} ({task['input_bytes'] / 1e6:.1f} MB)")
+            return
+        (self.workdir / "logs").mkdir(parents=True, exist_ok=True)
+        ratios = {job: self.ledger.memory_ratio(job) for job in self.jobs}
+        pending, running = list(tasks), {}
+        failed = 0
+        # Each day gets a fresh process, so its peak memory is its own
+        executor = ProcessPoolExecutor(max_workers=self.workers, max_tasks_per_child=1)
+        try:
+            while pending or running:
+                broken = False
+                # Start days in order while there's a worker and memory for them
+                while pending and len(running) < self.workers:
+                    task = pending[0]
+                    estimate = task["input_bytes"] * ratios[task["job"]]
+                    if running and sum(r["estimate"] for r in running.values()) + estimate > self.memory:
+                        break
+                    log = self.workdir / "logs" / f"{task['job']}-{task['date']}.log"
+                    try:
+                        future = executor.submit(run_task, task["job"], str(self.archive), task["date"], self.options,
+                                                 str(self.workdir / f"{task['job']}-{task['date']}"), str(log))
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    pending.pop(0)
+                    self.ledger.start(task, str(log))
+                    running[future] = {**task, "estimate": estimate}
+                    print(f"Started {task['date']} {Fore.CYAN}{task['job']}{Style.RESET_ALL} (estimated {estimate / 1e9:.1f} GB)")
+
+                if not broken:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    broken = any(isinstance(future.exception(), BrokenProcessPool) for future in done)
+                # Once the pool is broken, every day still running in it fails too
+                for future in list(running) if broken else done:
+                    task = running.pop(future)
+                    if not self.finish(task, future):
+                        failed += 1
+                    else:
+                        ratios[task["job"]] = self.ledger.memory_ratio(task["job"])
+                if broken:
+                    print(f"{Fore.RED}A worker process died (e.g. killed when out of memory). Starting a new pool.{Style.RESET_ALL}")
+                    executor.shutdown(wait=True)
+                    executor = ProcessPoolExecutor(max_workers=self.workers, max_tasks_per_child=1)
+        finally:
+            executor.shutdown(wait=True)
+        print(f"Ran {len(tasks)} days' jobs: {Fore.GREEN}{len(tasks) - failed}{Style.RESET_ALL} done, {Fore.RED if failed else ''}{failed}{Style.RESET_ALL} failed")
+        return failed
+
+    def finish(self, task:dict, future) -> bool:
+        """Record a day's job in the ledger, and its stages in the current metrics run."""
+        try:
+            result = future.result()
+        except Exception as e:
+            self.ledger.finish(task, "failed", error=repr(e))
+            print(f"{Fore.RED}{task['date']} {task['job']} failed: {e!r}{Style.RESET_ALL} (see {self.ledger.get(task['job'], task['date'])['log']})")
+            return False
+        outputs = get_outputs(task["job"], self.archive, task["date"], self.options)
+        absent = [str(path) for path in outputs if not path.exists()]
+        if absent:
+            self.ledger.finish(task, "failed", seconds=result["seconds"], peak_rss_bytes=result["peak_rss_bytes"], error=f"Not written: {', '.join(absent)}")
+            print(f"{Fore.RED}{task['date']} {task['job']} didn't write {', '.join(absent)}{Style.RESET_ALL}")
+            return False
+        self.ledger.finish(task, "done", outputs=[[str(path), path.stat().st_size] for path in outputs],
+                           seconds=result["seconds"], peak_rss_bytes=result["peak_rss_bytes"])
+        run = metrics.current_run()
+        if run:
+            for stage in result["stages"]:
+                run.add_stage({**stage, "labels": {**stage["labels"], "pipeline": task["job"]}, "date": task["date"]})
+        print(f"Finished {task['date']} {Fore.CYAN}{task['job']}{Style.RESET_ALL} in {result['seconds']:.1f}s, peak {result['peak_rss_bytes'] / 1e9:.2f} GB")
+        return True
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Run jobs over a range of days, skipping the days already done from the same inputs.")
+    parser.add_argument("-s", "--start", required=True, help="First day, as 'YYYY/mm/dd', 'YYYY-mm-dd' or 'YYYYmmdd'")
+    parser.add_argument("-e", "--end", help="Last day. Defaults to the first.")
+    parser.add_argument("-j", "--jobs", nargs="+", choices=JOBS, default=JOBS, help="Jobs to run. Defaults to all of them.")
+    parser.add_argument("-w", "--workers", type=int, help="Most days to run at once. Defaults to the number of CPUs.")
+    parser.add_argument("-m", "--memory", type=float, help="GB of memory the days running at once can use. Defaults to 80%% of the memory available.")
+    parser.add_argument("--feed", choices=["gtfsrt", "sirivm"], default="gtfsrt", help="Feed for the csv and parquet jobs. Defaults to gtfsrt.")
+    parser.add_argument("--delta", action="store_true", help="Pass --delta to the csv job")
+    parser.add_argument("-b", "--buckets", type=int, help="Buckets for the parquet job to deduplicate in")
+    parser.add_argument("--decode-workers", type=int, help="Processes for each day to decode with (parquet, and SIRI-VM csv)")
+    parser.add_argument("--ledger", help="Path to the ledger. Defaults to ${BODSCACHE}/backfill.sqlite")
+    parser.add_argument("--workdir", default="backfill-work", help="Where to run each day and keep its log. Defaults to backfill-work.")
+    parser.add_argument("-f", "--force", action="store_true", help="Run days again even if they're done")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="List what would be run")
+    parser.add_argument("--status", action="store_true", help="Show how many days of each job are in each status, and exit")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    start = parse_date(args.start)
+    end = parse_date(args.end) if args.end else start
+    ledger = Ledger(args.ledger)
+    if args.status:
+        for row in ledger.summary(start, end):
+            print(f"{row['job']:>9} {row['status']:>8}: {row['days']}")
+        sys.exit(0)
+    backfill = Backfill(jobs=args.jobs, ledger=ledger, workers=args.workers,
+                        memory=int(args.memory * 1e9) if args.memory else None, workdir=args.workdir,
+                        force=args.force, feed=args.feed, delta=args.delta, buckets=args.buckets,
+                        decode_workers=args.decode_workers)
+    with metrics.from_args("backfill", args):
+        failed = backfill.run(start, end, dry_run=args.dry_run)
+    ledger.close()
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,236 @@
+"""
+Time the pipelines, stage by stage, on synthetic archives (see synthetic_archive) at several scales, and
+save the results as JSON so runs can be compared.
+
+Pipelines and their stages:
+
+    entities    decode (get_gtfs_entities_from_directory), frame (entities_to_dataframe),
+                dedupe (remove_duplicate_reports), write (the CSV)
+    csv         decode (iter_gtfsrt_batches), frame (batches_to_dataframe), dedupe, write
+    parquet     decode (GTFSRT2Parquet.stream_gtfsrt into part files), dedupe (read_and_combine, with the write)
+    wire        the same as parquet, decoded with gtfsrt_wire in processes
+    operator    decode (OperatorPerformance.get_trip_counts), join (performance_for_all_regions)
+
+Each pipeline runs in a fresh process, so its peak RSS isn't inflated by the ones before it. The stages are
+recorded with metrics.stage, so each has the counters in metrics as well as its records/s. The peak RSS is
+read after each stage, so a stage's figure is the peak of the pipeline so far. Peaks of worker processes are
+reported separately. The timetable cache starts empty, so the join includes reading the timetables.
+
+The operator pipeline imports OperatorPerformance as scripts.python.OperatorPerformance, so run this from
+the root of the repository with PYTHONPATH=. to include it. A pipeline that fails is recorded with its error,
+and the others still run.
+"""
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+import pyarrow as pa
+from colorama import Fore, Style
+try:
+    from scripts.python.gtfs_realtime_utils import get_gtfs_entities_from_directory, iter_gtfsrt_batches
+    from scripts.python.gtfsrt_to_parquet import GTFSRT2Parquet
+    from scripts.python.synthetic_archive import SyntheticArchive, get_manifest
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    from gtfs_realtime_utils import get_gtfs_entities_from_directory, iter_gtfsrt_batches
+    from gtfsrt_to_parquet import GTFSRT2Parquet
+    from synthetic_archive import SyntheticArchive, get_manifest
+    import metrics
+from gtfsrt_to_csv import entities_to_dataframe, batches_to_dataframe, remove_duplicate_reports
+
+PIPELINES = ["entities", "csv", "parquet", "wire", "operator"]
+DATE = "20250529"
+
+def run_csv(manifest:dict, root:Path, workdir:Path, entities=False):
+    """
+    The CSV pipeline of gtfsrt_to_csv, from the gtfsrt_pb2 entities (entities=True) or record batches. Both read
+    the day's directory of snapshot zips, as gtfsrt_to_csv does.
+    """
+    day_dir = root / "gtfsrt" / DATE[0:4] / DATE[4:6] / DATE[6:8]
+    with metrics.stage("decode") as stage:
+        if entities:
+            data = get_gtfs_entities_from_directory(str(day_dir))
+            stage.set(records=len(data))
+        else:
+            data = list(iter_gtfsrt_batches(str(day_dir)))
+            stage.set(records=sum(batch.num_rows for batch in data))
+    with metrics.stage("frame") as stage:
+        df = entities_to_dataframe(data) if entities else batches_to_dataframe(data)
+        del data
+        stage.set(records=len(df))
+    with metrics.stage("dedupe") as stage:
+        stage.set(records=len(df))
+        df = remove_duplicate_reports(df)
+    with metrics.stage("write") as stage:
+        df.to_csv(workdir / f"csv-{DATE}.csv.zip", index=False)
+        stage.set(records=len(df))
+
+def run_parquet(manifest:dict, root:Path, workdir:Path, workers=None, decoder="pb2"):
+    """GTFSRT2Parquet.run, split into its stages. The output is written in workdir, not the archive."""
+    converter = GTFSRT2Parquet()
+    converter.set_date(datetime.strptime(DATE, "%Y%m%d").date().isoformat())
+    zip_path = converter.given_day_data_dir / f"gtfsrt-{DATE}.zip"
+    converter.given_day_data_dir = workdir
+    with metrics.stage("decode") as stage:
+        stream = converter.stream_gtfsrt(zip_path=zip_path, workers=workers, decoder=decoder)
+        converter.write_dataset(stream=stream, temp_dir=workdir / "tmp")
+        stage.set(records=manifest["reports"])
+    with metrics.stage("dedupe") as stage:
+        converter.read_and_combine(deduplicate=True)
+        stage.set(records=manifest["reports"])
+    converter.clean_up()
+
+def run_operator(manifest:dict, root:Path, workdir:Path):
+    """OperatorPerformance's polars engine, reading the bulk downloads in place."""
+    from scripts.python.OperatorPerformance import OperatorPerformance
+    temp = workdir / "temp"
+    temp.mkdir(exist_ok=True)
+    for format in ("gtfsrt", "timetables"):
+        link = temp / f"{format}-{DATE}.zip"
+        if not link.exists():
+            link.symlink_to(root / "bulk" / link.name)
+    op = OperatorPerformance(args=argparse.Namespace(date=DATE, unzip=False, engine="polars"))
+    op.set_dates(DATE)
+    with metrics.stage("decode") as stage:
+        trip_counts = op.get_trip_counts()
+        stage.set(records=manifest["reports"])
+    with metrics.stage("join") as stage:
+        op.performance_for_all_regions(manifest["settings"]["regions"], DATE, trip_counts)
+        stage.set(records=manifest["timetable_trips"])
+
+def run_pipeline(pipeline:str, root:str, workdir:str, workers=None, verbose=False) -> dict:
+    """
+    Run one pipeline over a synthetic archive. This runs in its own process.
+
+    :param pipeline: One of PIPELINES.
+    :param root: The synthetic archive.
+    :param workdir: An empty directory for the pipeline's temporary and output files.
+    :param workers: Processes for the wire pipeline.
+    :param verbose: Show what the pipeline prints.
+    :return: The pipeline's total time and its stages.
+    """
+    root, workdir = Path(root), Path(workdir)
+    manifest = get_manifest(root, DATE)
+    # The pipelines read from ${BODSARCHIVE}, write their temporary files in the current directory, and
+    # cache timetables in ${BODSCACHE}
+    os.environ["BODSARCHIVE"] = str(root)
+    os.environ["BODSCACHE"] = str(workdir / "cache")
+    os.chdir(workdir)
+    run = metrics.start_run(f"benchmark_{pipeline}")
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        if pipeline in ("entities", "csv"):
+            run_csv(manifest, root, workdir, entities=pipeline == "entities")
+        elif pipeline in ("parquet", "wire"):
+            run_parquet(manifest, root, workdir, workers=workers if pipeline == "wire" else None,
+                        decoder="wire" if pipeline == "wire" else "pb2")
+        else:
+            run_operator(manifest, root, workdir)
+    summary = metrics.finish_run()
+    for stage in run.stages:
+        stage["records_per_s"] = round(stage["records"] / stage["seconds"]) if stage["seconds"] else None
+    return {"seconds": summary["seconds"], "peak_rss_bytes": summary["peak_rss_bytes"], "stages": run.stages}
+
+def parse_scale(scale:str) -> tuple:
+    """'VEHICLESxSNAPSHOTS', e.g. '1000x120', as (vehicles, snapshots)."""
+    vehicles, snapshots = scale.lower().split("x")
+    return int(vehicles), int(snapshots)
+
+def get_archive(data_dir:Path, scale:str, duplicate_rate:float, seed=0) -> Path:
+    """Write the synthetic archive for a scale, unless one with the same settings is already there."""
+    vehicles, snapshots = parse_scale(scale)
+    archive = SyntheticArchive(vehicles=vehicles, snapshots=snapshots, duplicate_rate=duplicate_rate, seed=seed)
+    root = data_dir / f"{scale}-{duplicate_rate}-{seed}"
+    if get_manifest(root, DATE).get("settings") != archive.get_settings():
+        if root.exists():
+            shutil.rmtree(root)
+        archive.write(root, DATE)
+    return root
+
+def get_git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results:list, baseline:list):
+    """Print how long each stage took relative to the same pipeline, scale and stage in a baseline run."""
+    before = {(r["pipeline"], r["scale"], s["stage"]): s["seconds"] for r in baseline for s in r.get("stages", [])}
+    for result in results:
+        for stage in result.get("stages", []):
+            old = before.get((result["pipeline"], result["scale"], stage["stage"]))
+            if old:
+                ratio = stage["seconds"] / old
+                colour = Fore.GREEN if ratio < 0.95 else Fore.RED if ratio > 1.05 else ""
+                print(f"{result['pipeline']:>9} {result['scale']:>11} {stage['stage']:>7}: {old:8.3f}s -> {stage['seconds']:8.3f}s {colour}{ratio:6.2f}x{Style.RESET_ALL}")
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Time the pipelines on synthetic archives.")
+    parser.add_argument("-s", "--scales", nargs="+", default=["200x120", "1000x240"], help="Scales as VEHICLESxSNAPSHOTS. Defaults to 200x120 1000x240. A busy real day is about 25000x2880.")
+    parser.add_argument("-p", "--pipelines", nargs="+", default=PIPELINES, choices=PIPELINES, help="Pipelines to run. Defaults to all of them.")
+    parser.add_argument("--duplicate-rate", type=float, default=0.6, help="Chance a vehicle's report is repeated in the next snapshot. Defaults to 0.6.")
+    parser.add_argument("-r", "--repeat", type=int, default=1, help="Times to run each pipeline at each scale")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Processes for the wire pipeline. Defaults to the number of CPUs.")
+    parser.add_argument("--data", default="benchmark-data", help="Where to keep the synthetic archives. They are reused while their settings are the same.")
+    parser.add_argument("-o", "--output", help="JSON file for the results. Defaults to benchmark-YYYYmmddTHHMMSS.json.")
+    parser.add_argument("-c", "--compare", help="An earlier results file to compare against")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show what the pipelines print")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    started = datetime.now()
+    data_dir = Path(args.data).resolve()
+    results = []
+    for scale in args.scales:
+        root = get_archive(data_dir, scale, args.duplicate_rate)
+        manifest = get_manifest(root, DATE)
+        for pipeline in args.pipelines:
+            for run in range(args.repeat):
+                workdir = data_dir / "runs" / f"{scale}-{pipeline}-{run}"
+                shutil.rmtree(workdir, ignore_errors=True)
+                workdir.mkdir(parents=True)
+                result = {"pipeline": pipeline, "scale": scale, "run": run, "reports": manifest["reports"],
+                          "distinct_reports": manifest["distinct_reports"], "gtfsrt_bytes": manifest["gtfsrt_bytes"]}
+                try:
+                    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as ex:
+                        result.update(ex.submit(run_pipeline, pipeline, str(root), str(workdir), args.workers, args.verbose).result())
+                except Exception as e:
+                    # Keep going, so one broken pipeline doesn't lose the results of the rest
+                    result["error"] = f"{type(e).__name__}: {e}"
+                    results.append(result)
+                    print(f"{Fore.CYAN}{pipeline}{Style.RESET_ALL} at {scale}: {Fore.RED}failed{Style.RESET_ALL} with {result['error']}")
+                    continue
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+                results.append(result)
+                stages = ", ".join(f"{s['stage']} {s['seconds']:.2f}s" for s in result["stages"])
+                print(f"{Fore.CYAN}{pipeline}{Style.RESET_ALL} at {scale}: {Fore.YELLOW}{result['seconds']:.2f}s{Style.RESET_ALL}, {manifest['reports'] / result['seconds']:,.0f} reports/s, peak {result['peak_rss_bytes'] / 1e6:.0f} MB ({stages})")
+
+    output = Path(args.output or f"benchmark-{started.strftime('%Y%m%dT%H%M%S')}.json")
+    output.write_text(json.dumps({
+        "started": started.isoformat(timespec="seconds"),
+        "commit": get_git_commit(),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "pyarrow": pa.__version__,
+        "duplicate_rate": args.duplicate_rate,
+        "workers": args.workers,
+        "results": results,
+    }, indent=1))
+    print(f"Saved the results to {Fore.MAGENTA}{output}{Style.RESET_ALL}")
+    if args.compare:
+        compare(results, json.loads(Path(args.compare).read_text())["results"])
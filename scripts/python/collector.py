@@ -0,0 +1,209 @@
+import argparse
+import asyncio
+import os
+import shlex
+import signal
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from colorama import Fore, Style
+from dotenv import load_dotenv
+try:
+    from scripts.python.download_utils import make_session
+except ModuleNotFoundError:
+    from download_utils import make_session
+
+FEEDS = {
+    "gtfsrt": "https://data.bus-data.dft.gov.uk/avl/download/gtfsrt",
+    "sirivm": "https://data.bus-data.dft.gov.uk/avl/download/bulk_archive",
+}
+
+class FeedMetrics:
+    """Counters for one feed, exported by Collector.write_metrics."""
+    def __init__(self):
+        self.polls = {"changed": 0, "not_modified": 0, "error": 0}
+        self.missed_intervals = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.last_latency = 0.0
+        self.last_success = 0.0
+        self.bytes = 0
+
+class Collector:
+    """
+    Poll the live feeds on a fixed cadence and save each snapshot into the archive, as archive.sh does.
+
+    Each feed is polled by its own task, on a schedule kept against the event loop's clock, so slow
+    responses don't make the cadence drift. A poll that is still running when the next one is due makes
+    that one be skipped, and is counted as a missed interval. Requests are made on threads with one
+    requests.Session per feed, which keeps its connection open between polls. Each request is conditional
+    on the last response's ETag/Last-Modified, so an unchanged feed isn't downloaded or saved again.
+    """
+    def __init__(self, feeds=None, interval=30, archive_dir=None, ingest=None, metrics_path=None, timeout=60):
+        """
+        :param feeds: A dict of type (e.g. "gtfsrt") to URL. Defaults to FEEDS.
+        :param interval: Seconds between polls of each feed.
+        :param archive_dir: Where to save snapshots. Defaults to ${BODSARCHIVE}.
+        :param ingest: The gtfsrt_ingest.py command, e.g. "python gtfsrt_ingest.py", which is run as
+            `COMMAND ingest PATH` on each gtfsrt snapshot after it's saved, as archive.sh does. Defaults to
+            ${BODSINGEST}.
+        :param metrics_path: If given, a Prometheus textfile to write the metrics to after each poll.
+        :param timeout: Seconds to wait for a response. Polls that take longer than interval make the next
+            polls be skipped (and counted as missed), rather than failing.
+        """
+        load_dotenv()
+        self.feeds = feeds or FEEDS
+        self.interval = interval
+        self.timeout = timeout
+        self.archive_dir = Path(archive_dir or os.environ.get("BODSARCHIVE"))
+        self.ingest = ingest if ingest is not None else os.environ.get("BODSINGEST")
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        self.sessions = {name: make_session(pool_size=1, retries=0) for name in self.feeds}
+        self.validators = {name: {} for name in self.feeds}
+        self.metrics = {name: FeedMetrics() for name in self.feeds}
+        self.ingesting = set()
+
+    def fetch(self, name:str):
+        """Make a conditional request for a feed. Returns the response (status 304 if it hasn't changed)."""
+        r = self.sessions[name].get(self.feeds[name], headers=self.validators[name], timeout=self.timeout)
+        r.raise_for_status()
+        if r.status_code == 200:
+            self.validators[name] = {}
+            if r.headers.get("ETag"):
+                self.validators[name]["If-None-Match"] = r.headers["ETag"]
+            if r.headers.get("Last-Modified"):
+                self.validators[name]["If-Modified-Since"] = r.headers["Last-Modified"]
+        return r
+
+    def save(self, name:str, content:bytes, stamp:datetime) -> Path:
+        """Write a snapshot to ${BODSARCHIVE}/{type}/YYYY/MM/DD/{type}-YYYYmmddTHHMMSS.zip, atomically."""
+        day_dir = self.archive_dir / name / stamp.strftime("%Y/%m/%d")
+        if not day_dir.exists():
+            print(f"Making {Fore.CYAN}{day_dir}{Style.RESET_ALL}")
+            day_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+        path = day_dir / f"{name}-{stamp.strftime('%Y%m%dT%H%M%S')}.zip"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_bytes(content)
+        os.chmod(tmp, 0o755)
+        os.replace(tmp, path)
+        return path
+
+    async def poll(self, name:str):
+        """Fetch a feed once, save it if it changed, and start the ingest command on it."""
+        metrics = self.metrics[name]
+        stamp = datetime.now(timezone.utc)
+        t1 = perf_counter()
+        try:
+            r = await asyncio.to_thread(self.fetch, name)
+            path = None
+            if r.status_code == 304:
+                metrics.polls["not_modified"] += 1
+            else:
+                path = await asyncio.to_thread(self.save, name, r.content, stamp)
+                metrics.polls["changed"] += 1
+                metrics.bytes += len(r.content)
+            metrics.last_success = stamp.timestamp()
+        except Exception as e:
+            metrics.polls["error"] += 1
+            print(f"{Fore.RED}{name} poll failed: {e}{Style.RESET_ALL}")
+            return
+        finally:
+            latency = perf_counter() - t1
+            metrics.last_latency = latency
+            metrics.latency_sum += latency
+            metrics.latency_max = max(metrics.latency_max, latency)
+            self.write_metrics()
+
+        if path and self.ingest and name == "gtfsrt":
+            # run in the background, so a slow ingest doesn't hold up the next poll
+            task = asyncio.create_task(self.run_ingest(path))
+            self.ingesting.add(task)
+            task.add_done_callback(self.ingesting.discard)
+
+    async def run_ingest(self, path:Path):
+        """Append a snapshot to its day's ingest log, with `self.ingest ingest PATH` (see gtfsrt_ingest)."""
+        process = await asyncio.create_subprocess_exec(*shlex.split(self.ingest), "ingest", str(path))
+        if await process.wait():
+            print(f"{Fore.RED}{self.ingest} ingest {path} exited with {process.returncode}{Style.RESET_ALL}")
+
+    async def run_feed(self, name:str, polls=None):
+        """Poll a feed every self.interval seconds (polls times, or forever)."""
+        loop = asyncio.get_running_loop()
+        due = loop.time()
+        done = 0
+        while polls is None or done < polls:
+            late = loop.time() - due
+            if late >= self.interval:
+                missed = int(late // self.interval)
+                self.metrics[name].missed_intervals += missed
+                due += missed * self.interval
+                print(f"{Fore.YELLOW}{name}: missed {missed} interval(s){Style.RESET_ALL}")
+            await asyncio.sleep(max(0, due - loop.time()))
+            await self.poll(name)
+            done += 1
+            due += self.interval
+
+    async def run(self, polls=None):
+        """Poll every feed concurrently until stopped (SIGINT/SIGTERM), or for polls rounds."""
+        loop = asyncio.get_running_loop()
+        tasks = [asyncio.create_task(self.run_feed(name, polls)) for name in self.feeds]
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, lambda: [task.cancel() for task in tasks])
+        try:
+            await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            print("Stopping")
+        if self.ingesting:
+            await asyncio.wait(self.ingesting)
+
+    def write_metrics(self):
+        """Write the metrics in Prometheus' text format, atomically, for node_exporter's textfile collector."""
+        if not self.metrics_path:
+            return
+        families = [
+            ("bods_collector_polls_total", "counter", lambda m: m.polls.items()),
+            ("bods_collector_missed_intervals_total", "counter", lambda m: [(None, m.missed_intervals)]),
+            ("bods_collector_bytes_total", "counter", lambda m: [(None, m.bytes)]),
+            ("bods_collector_poll_latency_seconds", "gauge", lambda m: [(None, f"{m.last_latency:.6f}")]),
+            ("bods_collector_poll_latency_seconds_max", "gauge", lambda m: [(None, f"{m.latency_max:.6f}")]),
+            ("bods_collector_poll_latency_seconds_sum", "counter", lambda m: [(None, f"{m.latency_sum:.6f}")]),
+            ("bods_collector_last_success_timestamp_seconds", "gauge", lambda m: [(None, f"{m.last_success:.3f}")]),
+        ]
+        lines = []
+        for metric, kind, values in families:
+            lines.append(f"# TYPE {metric} {kind}")
+            for name, m in self.metrics.items():
+                for result, value in values(m):
+                    labels = f'feed="{name}"' + (f',result="{result}"' if result else "")
+                    lines.append(f"{metric}{{{labels}}} {value}")
+        tmp = self.metrics_path.with_suffix(".tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        os.replace(tmp, self.metrics_path)
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Poll the live gtfsrt and sirivm feeds and save each snapshot into ${BODSARCHIVE}.")
+    parser.add_argument("-i", "--interval", type=float, default=30, help="Seconds between polls of each feed. Defaults to 30.")
+    parser.add_argument("-t", "--types", nargs="+", default=list(FEEDS), choices=list(FEEDS), help="Feeds to poll. Defaults to both.")
+    parser.add_argument("--gtfsrt-url", default=FEEDS["gtfsrt"], help="URL of the gtfsrt feed")
+    parser.add_argument("--sirivm-url", default=FEEDS["sirivm"], help="URL of the sirivm feed")
+    parser.add_argument("--archive", help="Where to save snapshots. Defaults to ${BODSARCHIVE}")
+    parser.add_argument("--ingest", help="The gtfsrt_ingest.py command to run as 'COMMAND ingest PATH' on each gtfsrt snapshot. Defaults to ${BODSINGEST}")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a response. Defaults to 60.")
+    parser.add_argument("-m", "--metrics", help="Prometheus textfile to write metrics to")
+    parser.add_argument("-n", "--polls", type=int, help="Stop after this many polls of each feed")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    urls = {"gtfsrt": args.gtfsrt_url, "sirivm": args.sirivm_url}
+    collector = Collector(
+        feeds={name: urls[name] for name in args.types},
+        interval=args.interval,
+        archive_dir=args.archive,
+        ingest=args.ingest,
+        metrics_path=args.metrics,
+        timeout=args.timeout,
+    )
+    asyncio.run(collector.run(polls=args.polls))
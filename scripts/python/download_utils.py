@@ -0,0 +1,264 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+from time import monotonic, sleep
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    import metrics
+
+class RateLimiter:
+    """
+    A thread-safe token bucket. Each request takes a token, and tokens are added at `rate` per second up
+    to `burst`, so at most `rate` requests per second are made on average however many threads share it.
+    """
+    def __init__(self, rate=1.0, burst=1):
+        """
+        :param rate: Tokens added per second.
+        :param burst: The most tokens that can be saved up.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+def make_session(pool_size=8, retries=3) -> requests.Session:
+    """
+    A requests.Session that keeps up to pool_size connections open, so requests reuse connections
+    instead of opening a new TLS connection each time. Connection errors and 429/5xx responses are retried
+    with backoff.
+    """
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET", "HEAD"])
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def download_file(session:requests.Session, url:str, path:Path, limiter:RateLimiter=None, chunk_size=1 << 20, meta:dict=None, verify=None) -> bool:
+    """
+    Stream a file to disk. It is written to `path.part` and renamed to `path` once it is complete, so a file
+    at `path` is always whole. A `.part` left by an earlier, interrupted download is resumed with a Range
+    request where the server allows it.
+
+    :param session: The session to download with.
+    :param url: The URL of the file.
+    :param path: Where to save it.
+    :param limiter: If given, a token is taken before the request is made.
+    :param chunk_size: The number of bytes to read and write at a time.
+    :param meta: If given, the response's ETag and Last-Modified are stored in it.
+    :param verify: If given, a function that is called with the finished `.part` file and must return True
+        for it to be kept, e.g. verify_zip.
+    :return: True if the file was downloaded, False if it was already there.
+    :raises requests.HTTPError: If the response isn't ok, or the file doesn't verify.
+    """
+    path = Path(path)
+    if path.exists():
+        metrics.count(skipped=1)
+        return False
+
+    part = path.with_name(path.name + ".part")
+    offset = part.stat().st_size if part.exists() else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+    if limiter:
+        limiter.acquire()
+    with session.get(url, headers=headers, stream=True, timeout=60) as r:
+        if r.status_code == 416:
+            # the .part is already complete (or bigger than the file), so start again to be sure
+            offset = 0
+            part.unlink()
+            return download_file(session, url, path, limiter, chunk_size, meta, verify)
+        r.raise_for_status()
+        if r.status_code != 206:
+            offset = 0
+        expected = r.headers.get("Content-Length")
+        if meta is not None:
+            meta.update(etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"))
+        with open(part, "ab" if offset else "wb") as f:
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk)
+
+    if expected is not None and part.stat().st_size != offset + int(expected):
+        raise requests.HTTPError(f"{url} ended after {part.stat().st_size - offset} of {expected} bytes")
+    if verify and not verify(part):
+        part.unlink()
+        raise requests.HTTPError(f"{url} downloaded but didn't verify")
+    metrics.count(bytes_written=part.stat().st_size - offset)
+    os.replace(part, path)
+    return True
+
+def verify_zip(path:Path) -> bool:
+    """
+    Check a zip file is whole: its central directory can be read, and every member it lists lies inside the
+    file. This doesn't read the members, so it's quick even for multi-GB zips.
+    """
+    size = os.path.getsize(path)
+    # The end of central directory record must end the file. ZipFile alone would accept a truncated zip of
+    # zips, as it searches back for the record and can find one belonging to an inner zip.
+    with open(path, "rb") as f:
+        f.seek(max(0, size - 65557))
+        tail = f.read()
+    end = tail.rfind(b"PK\x05\x06")
+    if end < 0 or end + 22 + int.from_bytes(tail[end + 20:end + 22], "little") != len(tail):
+        return False
+    # The central directory must also end where the end record starts. An inner zip's end record gives
+    # offsets from the start of the inner zip, which ZipFile allows for (as it would for a self-extractor).
+    record = size - len(tail) + end
+    cd_size = int.from_bytes(tail[end + 12:end + 16], "little")
+    cd_offset = int.from_bytes(tail[end + 16:end + 20], "little")
+    if record >= 20:
+        with open(path, "rb") as f:
+            f.seek(record - 20)
+            locator = f.read(20)
+            if locator[:4] == b"PK\x06\x07":
+                # zip64: the central directory ends where the zip64 end record (which the locator points to) starts
+                record = int.from_bytes(locator[8:16], "little")
+                f.seek(record)
+                zip64 = f.read(56)
+                if zip64[:4] != b"PK\x06\x06" or len(zip64) < 56:
+                    return False
+                cd_size = int.from_bytes(zip64[40:48], "little")
+                cd_offset = int.from_bytes(zip64[48:56], "little")
+    if cd_offset + cd_size != record:
+        return False
+    try:
+        with ZipFile(path) as zf:
+            return all(info.header_offset + info.compress_size <= size for info in zf.infolist())
+    except (BadZipFile, OSError):
+        return False
+
+class RangeIgnored(requests.HTTPError):
+    """The server sent the whole file in answer to a Range request."""
+
+def download_ranged(session:requests.Session, url:str, path:Path, segments=8, limiter:RateLimiter=None, chunk_size=1 << 20) -> bool:
+    """
+    Download a large file in parallel HTTP Range segments, each written in place into a `.part` file that is
+    preallocated to the full size. Progress is saved to `.part.json`, so an interrupted download picks up
+    where each segment left off, as long as the file's size and ETag (or Last-Modified) haven't changed. The
+    result is checked against Content-Length (and, for zips, with verify_zip) before it's renamed to `path`.
+
+    Falls back to one stream with download_file, still checked with verify_zip, if the server doesn't support
+    ranges, doesn't give a Content-Length, or answers a segment's Range request with the whole file.
+
+    :param session: The session to download with. Its connection pool should have room for `segments`.
+    :param url: The URL of the file.
+    :param path: Where to save it.
+    :param segments: The number of segments to download at once.
+    :param limiter: If given, a token is taken before each request.
+    :param chunk_size: The number of bytes to read and write at a time.
+    :return: True if the file was downloaded, False if it was already there.
+    :raises requests.HTTPError: If a response isn't ok, or the download doesn't verify.
+    """
+    path = Path(path)
+    if path.exists():
+        if not path.suffix == ".zip" or verify_zip(path):
+            metrics.count(skipped=1)
+            return False
+        print(f"{path} is incomplete. Downloading it again.")
+        path.unlink()
+
+    if limiter:
+        limiter.acquire()
+    head = session.head(url, allow_redirects=True, timeout=60)
+    head.raise_for_status()
+    verify = verify_zip if path.suffix == ".zip" else None
+    size = head.headers.get("Content-Length")
+    etag = head.headers.get("ETag")
+    last_modified = head.headers.get("Last-Modified")
+    if head.headers.get("Accept-Ranges") != "bytes" or not size or size == "0":
+        return download_file(session, url, path, limiter, chunk_size, verify=verify)
+    size = int(size)
+    # If-Range can't use a weak ETag (RFC 7233), and servers answer it with the whole file every time
+    if_range = etag if etag and not etag.startswith("W/") else last_modified
+
+    part = path.with_name(path.name + ".part")
+    state_path = path.with_name(path.name + ".part.json")
+    state = json.loads(state_path.read_text()) if state_path.exists() and part.exists() else None
+    if not state or state["size"] != size or state["etag"] != etag or state.get("last_modified") != last_modified:
+        step = -(-size // segments)
+        state = {"url": url, "size": size, "etag": etag, "last_modified": last_modified, "segments": [[start, min(start + step, size), 0] for start in range(0, size, step)]}
+        with open(part, "wb") as f:
+            f.truncate(size)
+    resumed_from = sum(done for _, _, done in state["segments"])
+    lock = threading.Lock()
+    saved = [monotonic()]
+
+    def save_state(every=1.0):
+        """Save the progress, at most once every `every` seconds. Call with the lock held."""
+        if monotonic() - saved[0] < every:
+            return
+        tmp = state_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state))
+        os.replace(tmp, state_path)
+        saved[0] = monotonic()
+    save_state(every=0)
+
+    def fetch(segment):
+        start, end, done = segment
+        if start + done >= end:
+            return
+        headers = {"Range": f"bytes={start + done}-{end - 1}"}
+        if if_range:
+            headers["If-Range"] = if_range
+        if limiter:
+            limiter.acquire()
+        with session.get(url, headers=headers, stream=True, timeout=60) as r, open(part, "r+b") as f:
+            r.raise_for_status()
+            if r.status_code != 206:
+                raise RangeIgnored(f"{url} changed or ignored the Range request (status {r.status_code})")
+            f.seek(start + done)
+            for chunk in r.iter_content(chunk_size=chunk_size):
+                f.write(chunk[:end - start - segment[2]])
+                with lock:
+                    segment[2] = min(segment[2] + len(chunk), end - start)
+                    save_state()
+        if start + segment[2] < end:
+            raise requests.HTTPError(f"{url} segment {start}-{end} ended early")
+
+    ignored = None
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as pool:
+            for future in [pool.submit(fetch, segment) for segment in state["segments"]]:
+                try:
+                    future.result()
+                except RangeIgnored as e:
+                    ignored = e
+    finally:
+        with lock:
+            save_state(every=0)
+    if ignored:
+        print(f"{ignored}. Downloading it in one stream instead.")
+        part.unlink()
+        state_path.unlink()
+        return download_file(session, url, path, limiter, chunk_size, verify=verify)
+
+    if os.path.getsize(part) != size:
+        raise requests.HTTPError(f"{part} is {os.path.getsize(part)} bytes, expected {size}")
+    if verify and not verify(part):
+        state_path.unlink()
+        raise requests.HTTPError(f"{url} downloaded but isn't a complete zip file")
+    metrics.count(bytes_written=size - resumed_from)
+    os.replace(part, path)
+    state_path.unlink()
+    return True
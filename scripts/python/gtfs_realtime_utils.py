@@ -1,8 +1,42 @@
 import glob
+import os
+import re
+from operator import attrgetter
 from zipfile import ZipFile, BadZipFile
 from google.transit import gtfs_realtime_pb2
 from colorama import Fore, Style
 from time import time
+import pyarrow as pa
+try:
+    from scripts.python.gtfsrt_container import DayContainer, SUFFIX as CONTAINER_SUFFIX
+    from scripts.python.realtime_schema import compact
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    from gtfsrt_container import DayContainer, SUFFIX as CONTAINER_SUFFIX
+    from realtime_schema import compact
+    import metrics
+
+# Columns that can be read from a VehiclePosition entity, with the attribute path
+# used to get them and their Arrow type as read (see realtime_schema for the types they are stored as).
+VEHICLE_POSITION_FIELDS = {
+    "entity_id": ("id", pa.string()),
+    "trip_id": ("vehicle.trip.trip_id", pa.string()),
+    "route_id": ("vehicle.trip.route_id", pa.string()),
+    "start_date": ("vehicle.trip.start_date", pa.string()),
+    "start_time": ("vehicle.trip.start_time", pa.string()),
+    "schedule_relationship": ("vehicle.trip.schedule_relationship", pa.int64()),
+    "latitude": ("vehicle.position.latitude", pa.float64()),
+    "longitude": ("vehicle.position.longitude", pa.float64()),
+    "bearing": ("vehicle.position.bearing", pa.float64()),
+    "stop_sequence": ("vehicle.current_stop_sequence", pa.int64()),
+    "status": ("vehicle.current_status", pa.int64()),
+    "timestamp": ("vehicle.timestamp", pa.int64()),
+    "vehicle_id": ("vehicle.vehicle.id", pa.string()),
+}
+
+# Snapshot zips (e.g. gtfsrt-20250529T083000.zip) and day zips of them (gtfsrt-20250529.zip)
+SNAPSHOT_NAME = re.compile(r"-[0-9]{8}T[0-9]{6}\.zip$")
+DAY_ZIP_NAME = re.compile(r"-[0-9]{8}\.zip$")
 
 def log_num_files_parsed(i, total, t1):
     if i % 100 == 0:
@@ -17,11 +51,14 @@ def get_gtfs_from_binaries(paths: list):
     for i, path in enumerate(paths, 1):
         if path.endswith(".bin"):
             with open(path, 'rb') as f:
+                data = f.read()
                 feed = gtfs_realtime_pb2.FeedMessage()
-                feed.ParseFromString(f.read())
+                feed.ParseFromString(data)
                 entities.extend(feed.entity)
+                metrics.count(rows=len(feed.entity), bytes_read=len(data))
         else:
             print(f"{path} is not a binary file.")
+            metrics.count(skipped=1)
         log_num_files_parsed(i, total, t1)
     return entities
 
@@ -42,19 +79,24 @@ def get_gtfs_entities_from_zips(paths:list, bin_file='gtfsrt.bin'):
     for i, path in enumerate(paths, 1):
         if not path.endswith(".zip"):
             print(f"{path} is not a zip file.")
+            metrics.count(skipped=1)
             continue
         try:
             with ZipFile(path) as zf:
                 if bin_file in zf.namelist():
                     with zf.open(bin_file) as f:
+                        data = f.read()
                         feed = gtfs_realtime_pb2.FeedMessage()
-                        feed.ParseFromString(f.read())
+                        feed.ParseFromString(data)
                         entities.extend(feed.entity)
-                        del feed
+                        metrics.count(rows=len(feed.entity), bytes_read=len(data))
+                        del feed, data
                 else:
                     print(f'{bin_file} not in {path}. Skipping.')
+                    metrics.count(skipped=1)
         except BadZipFile:
             print(f"{path} is corrupted. Skipping.")
+            metrics.count(corrupt=1)
         log_num_files_parsed(i, len(paths), t1)
     return entities
 
@@ -68,3 +110,134 @@ def get_gtfs_entities_from_directory(DIR: str):
         path to directory containing zip files. May also include other, non-zip files (these are ignored).
     '''
     return get_gtfs_entities_from_zips(glob.glob(DIR + '/*.zip'))
+
+def iter_gtfsrt_binaries(source, bin_file='gtfsrt.bin'):
+    '''
+    Yield the raw GTFS-RT binaries, one snapshot at a time, without holding more than one in memory.
+
+    Params
+    ------
+    source: str | Path | list
+        Either a directory of snapshot zip files, a day zip (a zip of snapshot zips), a day container
+        (see gtfsrt_container), a single snapshot zip or a list of snapshot zip/.bin paths. A directory's
+        day zip is only read if it has no snapshot zips left.
+    bin_file: str
+        The name of the binary file you expect to find in each snapshot zip file.
+
+    Yields
+    ------
+    (name, data): tuple
+        The name of the snapshot and the bytes of its binary file. Their size is counted as bytes_read in
+        the current metrics stage, along with the files that are skipped or corrupt.
+    '''
+    if isinstance(source, (list, tuple)):
+        paths = [str(p) for p in source]
+    elif os.path.isdir(source):
+        paths = sorted(glob.glob(os.path.join(source, '*.zip')))
+        # The day zip (e.g. gtfsrt-YYYYmmdd.zip) is written next to the snapshots it holds, and they are kept
+        # for a while after, so only read it once they have gone
+        if any(SNAPSHOT_NAME.search(os.path.basename(p)) for p in paths):
+            paths = [p for p in paths if not DAY_ZIP_NAME.search(os.path.basename(p))]
+    else:
+        paths = [str(source)]
+    assert paths, "paths is empty."
+
+    t1 = time()
+    for i, path in enumerate(paths, 1):
+        if path.endswith(".bin"):
+            with open(path, 'rb') as f:
+                data = f.read()
+            metrics.count(bytes_read=len(data))
+            yield path, data
+        elif path.endswith(CONTAINER_SUFFIX):
+            with DayContainer(path) as container:
+                for name, data in container.iter_binaries():
+                    metrics.count(bytes_read=len(data))
+                    yield name, data
+        elif not path.endswith(".zip"):
+            print(f"{path} is not a zip file.")
+            metrics.count(skipped=1)
+        else:
+            try:
+                with ZipFile(path) as zf:
+                    namelist = zf.namelist()
+                    if bin_file in namelist:
+                        data = zf.read(bin_file)
+                        metrics.count(bytes_read=len(data))
+                        yield path, data
+                    elif any(name.endswith(".zip") for name in namelist):
+                        yield from _iter_day_zip(zf, bin_file)
+                    else:
+                        print(f'{bin_file} not in {path}. Skipping.')
+                        metrics.count(skipped=1)
+            except BadZipFile:
+                print(f"{path} is corrupted. Skipping.")
+                metrics.count(corrupt=1)
+        log_num_files_parsed(i, len(paths), t1)
+
+def _iter_day_zip(zf: ZipFile, bin_file='gtfsrt.bin'):
+    '''Yield the binaries from each snapshot zip inside an open day zip.'''
+    members = [info for info in zf.infolist() if info.filename.endswith(".zip")]
+    t1 = time()
+    for i, info in enumerate(members, 1):
+        try:
+            with zf.open(info) as member, ZipFile(member) as subzf:
+                data = subzf.read(bin_file)
+        except (BadZipFile, KeyError) as e:
+            print(f"Skipping {info.filename}: {e}")
+            metrics.count(corrupt=1)
+        else:
+            metrics.count(bytes_read=len(data))
+            yield info.filename, data
+        log_num_files_parsed(i, len(members), t1)
+
+def iter_gtfsrt_batches(source, batch_size=100_000, columns=None, bin_file='gtfsrt.bin'):
+    '''
+    Yield the vehicle positions in a GTFS-RT source as fixed-size Arrow record batches, with the compact
+    column types in realtime_schema.
+
+    Only one snapshot and one batch are held in memory at a time, so peak memory does not
+    depend on the number of snapshots in the source.
+
+    Params
+    ------
+    source: str | Path | list
+        Anything accepted by iter_gtfsrt_binaries.
+    batch_size: int
+        The number of rows in each batch (the last batch may be shorter).
+    columns: list
+        The columns to read, from VEHICLE_POSITION_FIELDS. Defaults to all of them.
+    bin_file: str
+        The name of the binary file you expect to find in each snapshot zip file.
+
+    Yields
+    ------
+    batch: pyarrow.RecordBatch
+    '''
+    columns = list(columns or VEHICLE_POSITION_FIELDS)
+    schema = pa.schema([(name, VEHICLE_POSITION_FIELDS[name][1]) for name in columns])
+    getters = [attrgetter(VEHICLE_POSITION_FIELDS[name][0]) for name in columns]
+    buffers = [[] for _ in columns]
+    rows = 0
+
+    for _, data in iter_gtfsrt_binaries(source, bin_file=bin_file):
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(data)
+        entities = [ent for ent in feed.entity if ent.HasField("vehicle")]
+        start = 0
+        while start < len(entities):
+            chunk = entities[start:start + batch_size - rows]
+            for buffer, getter in zip(buffers, getters):
+                buffer.extend(map(getter, chunk))
+            rows += len(chunk)
+            start += len(chunk)
+            if rows == batch_size:
+                metrics.count(rows=rows)
+                yield compact(pa.RecordBatch.from_arrays([pa.array(b, type=f.type) for b, f in zip(buffers, schema)], schema=schema))
+                buffers = [[] for _ in columns]
+                rows = 0
+        del feed, entities
+
+    if rows:
+        metrics.count(rows=rows)
+        yield compact(pa.RecordBatch.from_arrays([pa.array(b, type=f.type) for b, f in zip(buffers, schema)], schema=schema))
@@ -1,25 +1,280 @@
+import fcntl
+import io
+import os
+import json
+import hashlib
+import threading
+from collections.abc import Mapping
+from contextlib import contextmanager
+from pathlib import Path
 import pandas as pd
-from zipfile import ZipFile
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+from zipfile import ZipFile, ZIP_STORED
+
+# Declared types for the GTFS columns we know about, so they don't have to be inferred on every read.
+# Optional integer fields use pandas' nullable types as they are often blank.
+GTFS_DTYPES = {
+    'agency': {'agency_id': 'str', 'agency_name': 'str', 'agency_url': 'str', 'agency_timezone': 'str', 'agency_lang': 'str', 'agency_phone': 'str', 'agency_noc': 'str'},
+    'routes': {'route_id': 'str', 'agency_id': 'str', 'route_short_name': 'str', 'route_long_name': 'str', 'route_type': 'Int16'},
+    'trips': {'route_id': 'str', 'service_id': 'str', 'trip_id': 'str', 'trip_headsign': 'str', 'block_id': 'str', 'shape_id': 'str', 'direction_id': 'Int8', 'wheelchair_accessible': 'Int8', 'vehicle_journey_code': 'str'},
+    'calendar': {'service_id': 'str', 'monday': 'Int8', 'tuesday': 'Int8', 'wednesday': 'Int8', 'thursday': 'Int8', 'friday': 'Int8', 'saturday': 'Int8', 'sunday': 'Int8', 'start_date': 'Int32', 'end_date': 'Int32'},
+    'calendar_dates': {'service_id': 'str', 'date': 'Int32', 'exception_type': 'Int8'},
+    'stop_times': {'trip_id': 'str', 'arrival_time': 'str', 'departure_time': 'str', 'stop_id': 'str', 'stop_sequence': 'Int32', 'stop_headsign': 'str', 'pickup_type': 'Int8', 'drop_off_type': 'Int8', 'shape_dist_traveled': 'float64', 'timepoint': 'Int8'},
+    'stops': {'stop_id': 'str', 'stop_code': 'str', 'stop_name': 'str', 'stop_lat': 'float64', 'stop_lon': 'float64', 'location_type': 'Int8', 'parent_station': 'str', 'wheelchair_boarding': 'Int8', 'platform_code': 'str'},
+    'shapes': {'shape_id': 'str', 'shape_pt_lat': 'float64', 'shape_pt_lon': 'float64', 'shape_pt_sequence': 'Int32', 'shape_dist_traveled': 'float64'},
+    'frequencies': {'trip_id': 'str', 'start_time': 'str', 'end_time': 'str', 'headway_secs': 'Int32', 'exact_times': 'Int8'},
+    'feed_info': {'feed_publisher_name': 'str', 'feed_publisher_url': 'str', 'feed_lang': 'str', 'feed_start_date': 'Int32', 'feed_end_date': 'Int32', 'feed_version': 'str'},
+}
+
+# Arrow equivalents of the types in GTFS_DTYPES
+ARROW_TYPES = {'str': pa.string(), 'Int8': pa.int8(), 'Int16': pa.int16(), 'Int32': pa.int32(), 'float64': pa.float64()}
+
+def get_default_cache_dir() -> Path:
+    '''The default directory for cached timetable tables: ${BODSCACHE}/timetables, or ~/.cache/bods-archive/timetables.'''
+    return Path(os.environ.get("BODSCACHE", Path.home() / ".cache" / "bods-archive")) / "timetables"
+
+# Held (with a lock on index.lock, for other processes) while the cache's index.json is updated
+_index_lock = threading.Lock()
+
+@contextmanager
+def locked_index(index_path:Path):
+    '''Lock and load the cache's index of zips to hashes, saving it (atomically) on exit.'''
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    with _index_lock, open(index_path.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = json.loads(index_path.read_text()) if index_path.exists() else {}
+        yield index
+        tmp = index_path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(index))
+        os.replace(tmp, index_path)
 
 class GTFSTimetable:
     '''
     Load a GTFS zip file into a class for easy manipulation.
-    
+
+    Tables are only read when they are first accessed, with declared types (GTFS_DTYPES). Each one is
+    cached as parquet, keyed on the zip's contents, so reading the same timetable again is fast.
+
     Attributes
     ----------
     files: list
         a list of files in the Zip file.
-    dfs: dict     
+    dfs: dict
         a dictionary of pandas.DataFrame (s) where the key is the name of the file and the value is the dataframe.
+        Each dataframe is loaded on first access.
+    '''
+    def __init__(self, path, file_type=".txt", columns=None, cache_dir=None, cache_key=None):
+        '''
+        Params
+        ------
+        path: str | file | StoredTimetable
+            path to a GTFS zip file, an open (seekable) file, e.g. from open_zip_member, or an already open
+            zip, e.g. a StoredTimetable from timetable_store
+        file_type: str
+            the extension of the tables in the zip file
+        columns: dict
+            optionally, the columns to load for each table, e.g. {'trips': ['route_id', 'trip_id']}
+        cache_dir: str | Path | bool
+            where to cache tables. Defaults to get_default_cache_dir(). False to turn off caching.
+        cache_key: str
+            a key for the zip's contents, if already known (e.g. from the CRC of a zip member).
+            Otherwise the zip is identified by its size and mtime, then its hash.
+        '''
+        self.path = path
+        self.file_type = file_type
+        self.columns = columns or {}
+        self.cache_dir = None if cache_dir is False else Path(cache_dir or get_default_cache_dir())
+        self.cache_key = cache_key or getattr(path, "cache_key", None)
+
+        with self.open_zip() as zf:
+            # add a list of files
+            self.files = zf.namelist()
+
+        # a dictionary containing the data as dataframes indexed by the filename (extension removed)
+        self.dfs = LazyTables(self, [f.replace(file_type, "") for f in self.files if f.endswith(file_type)])
+
+    @contextmanager
+    def open_zip(self):
+        '''The timetable's zip, as a context manager. Only a zip opened here is closed on exit, not one passed in.'''
+        if hasattr(self.path, "namelist"):
+            yield self.path
+            return
+        if not isinstance(self.path, str) and hasattr(self.path, "seek"):
+            self.path.seek(0)
+        with ZipFile(self.path) as zf:
+            yield zf
+
+    def get_cache_key(self) -> str:
+        '''A key for the contents of the zip: its hash, looked up by path, size and mtime where possible.'''
+        if self.cache_key:
+            return self.cache_key
+
+        if isinstance(self.path, (str, Path)):
+            stat = os.stat(self.path)
+            lookup = f"{os.path.realpath(self.path)}|{stat.st_size}|{stat.st_mtime_ns}"
+            index_path = self.cache_dir / "index.json"
+            index = json.loads(index_path.read_text()) if index_path.exists() else {}
+            if lookup not in index:
+                # Hash outside the lock, so timetables being loaded at the same time aren't hashed one by one
+                with open(self.path, "rb") as f:
+                    digest = hashlib.file_digest(f, "sha256").hexdigest()
+                with locked_index(index_path) as index:
+                    index[lookup] = digest
+            self.cache_key = index[lookup]
+        else:
+            self.path.seek(0)
+            self.cache_key = hashlib.file_digest(self.path, "sha256").hexdigest()
+        return self.cache_key
+
+    def get_table_dir(self, name:str) -> Path:
+        '''
+        Where a table is cached. If the zip knows the hash of each member (a StoredTimetable), tables are cached by
+        their own contents, so a table that hasn't changed since an earlier timetable is already there.
+        '''
+        member_hash = getattr(self.path, "member_hash", None)
+        if member_hash:
+            return self.cache_dir / "tables" / member_hash(name + self.file_type)
+        return self.cache_dir / self.get_cache_key()
+
+    def read_table(self, name:str) -> pd.DataFrame:
+        '''Read a table from the cache if it's there, otherwise parse it from the zip and cache it.'''
+        columns = self.columns.get(name)
+        if self.cache_dir is None:
+            return self.parse_table(name, columns)
+        path, df = self.cache_table(name)
+        if df is None:
+            # A table cached with only the columns set for it has just those
+            df = pd.read_parquet(path, columns=columns if path.stem == name else None)
+        return df
+
+    def table_path(self, name:str) -> Path:
+        '''
+        The parquet file in the cache that has a table (with at least the columns set for it), parsing it from
+        the zip into the cache first if needed. This is for reading the table with something other than pandas,
+        e.g. DuckDB.
+        '''
+        if self.cache_dir is None:
+            raise ValueError("table_path needs a cache directory to keep the table in.")
+        return self.cache_table(name)[0]
+
+    def cache_table(self, name:str) -> tuple:
+        '''The path of a table in the cache, and the table if it wasn't there and had to be parsed.'''
+        columns = self.columns.get(name)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        table_dir = self.get_table_dir(name)
+        full = table_dir / f"{name}.parquet"
+        if full.exists():
+            return full, None
+
+        path = full
+        if columns:
+            path = table_dir / f"{name}-{hashlib.sha1(','.join(columns).encode()).hexdigest()[:12]}.parquet"
+            if path.exists():
+                return path, None
+
+        df = self.parse_table(name, columns)
+        table_dir.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path)
+        return path, df
+
+    def parse_table(self, name:str, columns=None) -> pd.DataFrame:
+        '''Parse a table from the CSV in the zip, with declared types.'''
+        with self.open_zip() as zf, zf.open(name + self.file_type) as f:
+            return pd.read_csv(f, usecols=columns, dtype=GTFS_DTYPES.get(name))
+
+    def stop_times_index(self):
+        '''
+        Get a StopTimesIndex for this timetable's stop_times, building it in the cache directory if needed.
+
+        stop_times is parsed with pyarrow's multithreaded CSV reader, sorted by trip_id and stop_sequence and
+        written to an uncompressed Arrow IPC file, along with the offset and length of each trip's rows.
+        '''
+        if self.cache_dir is None:
+            raise ValueError("stop_times_index needs a cache directory to store the index in.")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        table_dir = self.get_table_dir("stop_times")
+        data_path = table_dir / "stop_times.arrow"
+        index_path = table_dir / "stop_times.trips.arrow"
+        if not (data_path.exists() and index_path.exists()):
+            table_dir.mkdir(parents=True, exist_ok=True)
+            with self.open_zip() as zf, zf.open("stop_times" + self.file_type) as f:
+                column_types = {col: ARROW_TYPES[t] for col, t in GTFS_DTYPES['stop_times'].items()}
+                table = csv.read_csv(f, read_options=csv.ReadOptions(use_threads=True),
+                                     convert_options=csv.ConvertOptions(column_types=column_types))
+            table = table.sort_by([("trip_id", "ascending"), ("stop_sequence", "ascending")])
+
+            # each trip's rows are now one run, so the run ends are the index
+            runs = pc.run_end_encode(table["trip_id"].combine_chunks(), run_end_type=pa.int64())
+            index = pa.table({"trip_id": runs.values, "end": runs.run_ends})
+            _write_arrow(table, data_path)
+            _write_arrow(index, index_path)
+        return StopTimesIndex(data_path, index_path)
+
+class StopTimesIndex:
+    '''
+    stop_times, memory-mapped from an Arrow IPC file sorted by trip_id, with an index to fetch each trip's
+    stops in O(1) without copying them. Processes that open the same file share one copy in the page cache.
+    '''
+    def __init__(self, data_path:Path, index_path:Path):
+        self.table = pa.ipc.open_file(pa.memory_map(str(data_path))).read_all()
+        index = pa.ipc.open_file(pa.memory_map(str(index_path))).read_all()
+        ends = index["end"].to_numpy()
+        starts = ends.copy()
+        starts[1:] = ends[:-1]
+        if len(starts):
+            starts[0] = 0
+        self.index = dict(zip(index["trip_id"].to_pylist(), zip(starts.tolist(), (ends - starts).tolist())))
+
+    def __contains__(self, trip_id):
+        return trip_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def trip(self, trip_id:str) -> pa.Table:
+        '''The stop_times rows for a trip_id, in stop_sequence order, as a zero-copy slice.'''
+        offset, length = self.index[trip_id]
+        return self.table.slice(offset, length)
+
+def _write_arrow(table:pa.Table, path:Path):
+    '''Write a table to an (uncompressed, so it can be memory-mapped) Arrow IPC file, atomically.'''
+    tmp = path.with_suffix(f".{os.getpid()}-{threading.get_ident()}.tmp")
+    with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, path)
+
+class LazyTables(Mapping):
+    '''A read-only dict of a GTFSTimetable's tables, each read the first time it is accessed.'''
+    def __init__(self, timetable:GTFSTimetable, names:list):
+        self.timetable = timetable
+        self.names = names
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self.loaded:
+            self.loaded[name] = self.timetable.read_table(name)
+        return self.loaded[name]
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+
+def open_zip_member(zf:ZipFile, info):
+    '''
+    Open a member of a zip file, e.g. a zip inside a zip, as a seekable file without extracting it to disk.
+
+    Stored (uncompressed) members are read in place. Compressed members are decompressed into memory once,
+    as seeking backwards in them would mean decompressing from the start again.
     '''
-    def __init__(self, path:str, file_type=".txt"):
-        if path.endswith(".zip"):
-            with ZipFile(path) as zf:
-                # create a dictionary containing the data as dataframes
-                # indexed by the filename (extension removed)
-                self.dfs = {text_file.filename.replace(file_type, ""): pd.read_csv(zf.open(text_file.filename))
-                            for text_file in zf.infolist()
-                            if text_file.filename.endswith(file_type)}
-                
-                # add a list of files
-                self.files = zf.namelist()
+    if info.compress_type == ZIP_STORED:
+        return zf.open(info)
+    return io.BytesIO(zf.read(info))
@@ -0,0 +1,190 @@
+import argparse
+import os
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from colorama import Fore, Style
+from dotenv import load_dotenv
+
+# Rows are sorted by these columns within each file, so the row group min/max statistics on them are tight.
+SORT_BY = ["route_id", "vehicle_id", "timestamp"]
+
+def get_archive_dir() -> Path:
+    """The default root of the partitioned archive, ${BODSARCHIVE}/gtfsrt-parquet."""
+    load_dotenv()
+    return Path(os.environ.get("BODSARCHIVE")) / "gtfsrt-parquet"
+
+def clear_run(root:Path, run_id:str):
+    """
+    Remove the files written by an earlier write_partitioned call with the same run_id, so a day can be
+    converted again without leaving stale rows behind.
+    """
+    for f in Path(root).glob(f"**/part-{run_id}-*.parquet"):
+        f.unlink()
+
+def write_partitioned(table:pa.Table, root:Path, run_id:str, route_prefix_length=None, row_group_size=128_000):
+    """
+    Add rows to the partitioned archive, as `date=YYYY-mm-dd/hour=HH/` (and optionally `route=PREFIX/`)
+    directories of parquet files, sorted by route_id, vehicle_id and timestamp.
+
+    :param table: The rows to write. Needs at least the route_id, vehicle_id and timestamp columns.
+    :param root: The root directory of the archive.
+    :param run_id: Used in the file names, e.g. the date of the day zip the rows came from. Files from
+        other runs that fall in the same partitions are kept.
+    :param route_prefix_length: If given, also partition by the first this-many characters of route_id.
+        Use the same length for everything written to an archive, as query() reads the partitions of every
+        file the same way.
+    :param row_group_size: The number of rows in each row group.
+    """
+    # pyarrow can't sort by dictionary-encoded columns, so sort with polars
+    table = pl.from_arrow(table).sort(SORT_BY).to_arrow()
+    times = pc.cast(pc.cast(table["timestamp"], pa.int64()), pa.timestamp("s", tz="UTC"))
+    table = table.append_column("date", pc.strftime(times, format="%Y-%m-%d"))
+    table = table.append_column("hour", pc.cast(pc.hour(times), pa.int8()))
+    partitions = [("date", pa.string()), ("hour", pa.int8())]
+    if route_prefix_length:
+        table = table.append_column("route", pc.utf8_slice_codeunits(pc.cast(table["route_id"], pa.string()), 0, route_prefix_length))
+        partitions.append(("route", pa.string()))
+
+    ds.write_dataset(
+        table,
+        root,
+        format="parquet",
+        partitioning=ds.partitioning(pa.schema(partitions), flavor="hive"),
+        basename_template=f"part-{run_id}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        min_rows_per_group=row_group_size,
+        max_rows_per_group=row_group_size,
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd", write_statistics=True),
+    )
+    print(f"Wrote {Fore.YELLOW}{table.num_rows}{Style.RESET_ALL} rows to {Fore.MAGENTA}{root}{Style.RESET_ALL}")
+
+def merge_partitions(staging:Path, root:Path, run_id:str, row_group_size=128_000):
+    """
+    Move the partitions of a staging archive written in pieces (e.g. one write_partitioned call per
+    deduplication bucket) into the archive at root, merging each partition's files into one sorted file.
+    Only one partition is held in memory at a time.
+
+    :param staging: The root of the staging archive. Its files are removed as they are merged.
+    :param root: The root directory of the archive.
+    :param run_id: Used in the file names, as in write_partitioned.
+    :param row_group_size: The number of rows in each row group.
+    """
+    staging = Path(staging)
+    partitions = sorted({f.parent for f in staging.glob("**/*.parquet")})
+    rows = 0
+    for partition in partitions:
+        files = sorted(partition.glob("*.parquet"))
+        table = pa.concat_tables([pq.ParquetFile(f).read() for f in files])
+        table = pl.from_arrow(table).sort(SORT_BY).to_arrow()
+        outdir = Path(root) / partition.relative_to(staging)
+        outdir.mkdir(parents=True, exist_ok=True)
+        pq.write_table(table, outdir / f"part-{run_id}-0.parquet", row_group_size=row_group_size, compression="zstd", write_statistics=True)
+        rows += table.num_rows
+        for f in files:
+            f.unlink()
+    print(f"Merged {Fore.YELLOW}{rows}{Style.RESET_ALL} rows in {Fore.YELLOW}{len(partitions)}{Style.RESET_ALL} partitions into {Fore.MAGENTA}{root}{Style.RESET_ALL}")
+
+def _partition_filter(start:datetime, end:datetime):
+    """A filter on the date and hour partition columns covering the hours from start to end (inclusive)."""
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    days = {}
+    while hour <= end:
+        days.setdefault(hour.strftime("%Y-%m-%d"), []).append(hour.hour)
+        hour += timedelta(hours=1)
+    expr = pl.lit(False)
+    for date, hours in days.items():
+        expr = expr | ((pl.col("date") == date) & pl.col("hour").is_between(min(hours), max(hours)))
+    return expr
+
+def query(start=None, end=None, bbox=None, route_id=None, vehicle_id=None, columns=None, root=None) -> pl.DataFrame:
+    """
+    Read rows from the partitioned archive. Only the partitions in the time window (and, if the archive is
+    partitioned by route, those of the route_ids) are opened, and row groups whose min/max statistics rule
+    them out are skipped.
+
+    :param start: Earliest report time (inclusive), as a datetime or iso format string, in UTC.
+    :param end: Latest report time (inclusive), as a datetime or iso format string, in UTC.
+    :param bbox: (min_lon, min_lat, max_lon, max_lat).
+    :param route_id: A route_id, or list of route_ids.
+    :param vehicle_id: A vehicle_id, or list of vehicle_ids.
+    :param columns: The columns to return. Defaults to all.
+    :param root: The root directory of the archive. Defaults to get_archive_dir().
+    :return: A polars.DataFrame.
+    """
+    root = Path(root or get_archive_dir())
+    lf = pl.scan_parquet(
+        root / "**" / "*.parquet",
+        hive_partitioning=True,
+        hive_schema={"date": pl.String, "hour": pl.Int8, "route": pl.String},
+    )
+
+    if start or end:
+        start = _as_utc(start) if start else None
+        end = _as_utc(end) if end else None
+        if start and end:
+            lf = lf.filter(_partition_filter(start, end))
+        if start:
+            lf = lf.filter(pl.col("timestamp") >= int(start.timestamp()))
+        if end:
+            lf = lf.filter(pl.col("timestamp") <= int(end.timestamp()))
+    if bbox:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        lf = lf.filter(pl.col("lon").is_between(min_lon, max_lon) & pl.col("lat").is_between(min_lat, max_lat))
+    if route_id:
+        route_ids = _as_list(route_id)
+        if "route" in lf.collect_schema().names():
+            # The route partitions are prefixes of route_id, of whatever length the archive was written with
+            lf = lf.filter(pl.any_horizontal([pl.lit(r).str.starts_with(pl.col("route")) for r in route_ids]))
+        lf = lf.filter(pl.col("route_id").is_in(route_ids))
+    if vehicle_id:
+        lf = lf.filter(pl.col("vehicle_id").is_in(_as_list(vehicle_id)))
+    if columns:
+        lf = lf.select(columns)
+    return lf.collect()
+
+def _as_utc(value) -> datetime:
+    """Parse an iso format string (or take a datetime), treating naive times as UTC."""
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Query the partitioned gtfsrt parquet archive.")
+    parser.add_argument("-s", "--start", help="Earliest report time, iso format in UTC e.g. '2025-05-29T07:00'")
+    parser.add_argument("-e", "--end", help="Latest report time, iso format in UTC e.g. '2025-05-29T09:00'")
+    parser.add_argument("-r", "--route", action="append", help="route_id to keep. Can be given more than once.")
+    parser.add_argument("-v", "--vehicle", action="append", help="vehicle_id to keep. Can be given more than once.")
+    parser.add_argument("-b", "--bbox", help="Bounding box 'min_lon,min_lat,max_lon,max_lat'")
+    parser.add_argument("-c", "--columns", help="Comma separated list of columns to return")
+    parser.add_argument("--root", help="Root of the archive. Defaults to ${BODSARCHIVE}/gtfsrt-parquet")
+    parser.add_argument("-o", "--output", help="Save the rows to this .csv or .parquet file instead of printing them")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    df = query(
+        start=args.start,
+        end=args.end,
+        bbox=[float(x) for x in args.bbox.split(",")] if args.bbox else None,
+        route_id=args.route,
+        vehicle_id=args.vehicle,
+        columns=args.columns.split(",") if args.columns else None,
+        root=args.root,
+    )
+    if not args.output:
+        print(df)
+    elif args.output.endswith(".parquet"):
+        df.write_parquet(args.output)
+    else:
+        df.write_csv(args.output)
+    print(f"{Fore.YELLOW}{len(df)}{Style.RESET_ALL} rows")
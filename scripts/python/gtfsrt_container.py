@@ -0,0 +1,268 @@
+"""
+A day's gtfsrt snapshots in one seekable, zstd-compressed file, instead of a zip of snapshot zips.
+
+The raw protobuf payloads are compressed in frames of a few consecutive snapshots, which compress far
+better together than each one does alone, as consecutive snapshots are mostly the same vehicles. An
+index at the end of the file gives the timestamp of each snapshot and where it is, so any time window
+can be read by decompressing only the frames it covers.
+
+Layout::
+
+    MAGIC
+    frame 0, frame 1, ...          zstd-compressed, each the payloads of up to per_frame snapshots
+    index                          an Arrow IPC stream, one row per snapshot, sorted by timestamp
+    index offset, index length     little-endian uint64s
+    MAGIC
+"""
+import argparse
+import os
+import re
+from datetime import datetime, timezone
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from colorama import Fore, Style
+
+MAGIC = b"BODSRTZ1"
+SUFFIX = ".gtfsrtz"
+TIMESTAMP_PATTERN = re.compile(r"([0-9]{8}T[0-9]{6})")
+
+INDEX_SCHEMA = pa.schema([
+    ("name", pa.string()),
+    ("timestamp", pa.int64()),
+    ("frame_offset", pa.int64()),
+    ("frame_length", pa.int64()),
+    ("frame_size", pa.int64()),
+    ("offset", pa.int64()),
+    ("length", pa.int64()),
+])
+
+def timestamp_from_name(name:str):
+    """The UTC epoch seconds in a snapshot name like gtfsrt-YYYYmmddTHHMMSS.zip, or None."""
+    match = TIMESTAMP_PATTERN.search(os.path.basename(name))
+    if not match:
+        return None
+    return int(datetime.strptime(match.group(1), "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc).timestamp())
+
+def to_epoch(value) -> int:
+    """Epoch seconds from a datetime, an iso format string or a number. Naive times are taken as UTC."""
+    if isinstance(value, (int, float, np.integer)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if not value.tzinfo:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+class ContainerWriter:
+    """
+    Write snapshots to a container. Add them in time order, e.g.
+
+        with ContainerWriter("gtfsrt-20250529.gtfsrtz") as writer:
+            for name, data in snapshots:
+                writer.add(name, data)
+
+    The file is written to a temporary path and renamed on close, so it is never seen half-written.
+    """
+    def __init__(self, path, per_frame=16, level=9):
+        """
+        :param path: The container to write.
+        :param per_frame: The number of snapshots to compress together. More compress better, fewer
+            mean less is decompressed to read one snapshot.
+        :param level: The zstd compression level.
+        """
+        self.path = Path(path)
+        self.tmp = self.path.with_name(self.path.name + ".tmp")
+        self.per_frame = per_frame
+        self.codec = pa.Codec("zstd", compression_level=level)
+        self.file = open(self.tmp, "wb")
+        self.file.write(MAGIC)
+        self.pending = []
+        self.rows = {name: [] for name in INDEX_SCHEMA.names}
+
+    def add(self, name:str, data:bytes, timestamp=None):
+        """
+        :param name: The snapshot's name, e.g. gtfsrt-20250529T073000.zip.
+        :param data: Its raw protobuf payload.
+        :param timestamp: When it was taken. Defaults to the time in its name.
+        """
+        timestamp = to_epoch(timestamp) if timestamp is not None else timestamp_from_name(name)
+        if timestamp is None:
+            raise ValueError(f"{name} doesn't have a timestamp in its name")
+        self.pending.append((os.path.basename(name), timestamp, data))
+        if len(self.pending) >= self.per_frame:
+            self.flush()
+
+    def flush(self):
+        """Compress the pending snapshots into a frame."""
+        if not self.pending:
+            return
+        raw = b"".join(data for _, _, data in self.pending)
+        compressed = self.codec.compress(raw, asbytes=True)
+        frame_offset = self.file.tell()
+        self.file.write(compressed)
+        offset = 0
+        for name, timestamp, data in self.pending:
+            for column, value in zip(INDEX_SCHEMA.names, (name, timestamp, frame_offset, len(compressed), len(raw), offset, len(data))):
+                self.rows[column].append(value)
+            offset += len(data)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        index = pa.table(self.rows, schema=INDEX_SCHEMA).sort_by("timestamp")
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, INDEX_SCHEMA, options=pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+            writer.write_table(index)
+        index_bytes = sink.getvalue().to_pybytes()
+        index_offset = self.file.tell()
+        self.file.write(index_bytes)
+        self.file.write(index_offset.to_bytes(8, "little") + len(index_bytes).to_bytes(8, "little") + MAGIC)
+        self.file.close()
+        os.replace(self.tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            self.tmp.unlink()
+
+class DayContainer:
+    """
+    Read a container written by ContainerWriter. Only the index is read when it's opened. Snapshots are
+    read by seeking to their frame, and each frame is decompressed once however many of its snapshots are
+    read in a row.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.file = open(self.path, "rb")
+        self.file.seek(-(16 + len(MAGIC)), os.SEEK_END)
+        footer = self.file.read()
+        if footer[16:] != MAGIC:
+            raise ValueError(f"{path} is not a gtfsrt container")
+        index_offset = int.from_bytes(footer[:8], "little")
+        index_length = int.from_bytes(footer[8:16], "little")
+        self.file.seek(index_offset)
+        self.index = pa.ipc.open_stream(self.file.read(index_length)).read_all()
+        self.timestamps = self.index["timestamp"].to_numpy()
+        self.codec = pa.Codec("zstd")
+        self._frame = (None, None)
+
+    def __len__(self):
+        return self.index.num_rows
+
+    @property
+    def names(self) -> list:
+        return self.index["name"].to_pylist()
+
+    def window(self, start=None, end=None) -> np.ndarray:
+        """The index rows of the snapshots taken from start to end (inclusive), in time order."""
+        lo = 0 if start is None else np.searchsorted(self.timestamps, to_epoch(start), side="left")
+        hi = len(self) if end is None else np.searchsorted(self.timestamps, to_epoch(end), side="right")
+        return np.arange(lo, hi)
+
+    def read_frame(self, frame_offset:int, frame_length:int, frame_size:int) -> bytes:
+        if self._frame[0] != frame_offset:
+            self.file.seek(frame_offset)
+            self._frame = (frame_offset, self.codec.decompress(self.file.read(frame_length), decompressed_size=frame_size, asbytes=True))
+        return self._frame[1]
+
+    def iter_binaries(self, start=None, end=None):
+        """
+        Yield (name, data) for each snapshot from start to end (inclusive), in time order.
+
+        :param start: A datetime, iso format string or epoch seconds, in UTC. Defaults to the first snapshot.
+        :param end: As start. Defaults to the last snapshot.
+        """
+        yield from self.iter_rows(self.window(start, end))
+
+    def iter_rows(self, rows):
+        """Yield (name, data) for the snapshots at the given (sorted) rows of the index."""
+        rows = np.asarray(rows)
+        if rows.size == 0:
+            return
+        index = self.index.take(pa.array(rows)).to_pydict()
+        for i in range(rows.size):
+            frame = self.read_frame(index["frame_offset"][i], index["frame_length"][i], index["frame_size"][i])
+            offset = index["offset"][i]
+            yield index["name"][i], frame[offset:offset + index["length"][i]]
+
+    def read(self, name:str) -> bytes:
+        """The payload of one snapshot, by name."""
+        matches = self.index.filter(pc.equal(self.index["name"], os.path.basename(name))).to_pylist()
+        if not matches:
+            raise KeyError(name)
+        row = matches[0]
+        frame = self.read_frame(row["frame_offset"], row["frame_length"], row["frame_size"])
+        return frame[row["offset"]:row["offset"] + row["length"]]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def convert_day_zip(day_zip, out_path=None, per_frame=16, level=9, bin_file="gtfsrt.bin") -> Path:
+    """
+    Repack a day zip (a zip of snapshot zips) as a container.
+
+    :param day_zip: Path to a gtfsrt-YYYYmmdd.zip.
+    :param out_path: The container to write. Defaults to the same path with the SUFFIX extension.
+    :param per_frame: See ContainerWriter.
+    :param level: See ContainerWriter.
+    :param bin_file: The name of the binary file in each snapshot zip.
+    :return: The path of the container.
+    """
+    day_zip = Path(day_zip)
+    out_path = Path(out_path) if out_path else day_zip.with_suffix(SUFFIX)
+    skipped = 0
+    with ZipFile(day_zip) as zf, ContainerWriter(out_path, per_frame=per_frame, level=level) as writer:
+        members = sorted((info for info in zf.infolist() if timestamp_from_name(info.filename) is not None), key=lambda info: os.path.basename(info.filename))
+        for info in members:
+            try:
+                with zf.open(info) as member, ZipFile(member) as subzf:
+                    data = subzf.read(bin_file)
+            except (BadZipFile, KeyError) as e:
+                print(f"Skipping {info.filename}: {e}")
+                skipped += 1
+                continue
+            writer.add(info.filename, data)
+
+    before, after = os.path.getsize(day_zip), os.path.getsize(out_path)
+    print(f"Repacked {Fore.YELLOW}{len(members) - skipped}{Style.RESET_ALL} snapshots from {Fore.CYAN}{day_zip}{Style.RESET_ALL} into {Fore.MAGENTA}{out_path}{Style.RESET_ALL}: {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB ({after / before:.0%})")
+    return out_path
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Repack gtfsrt day zips as seekable zstd containers, and read them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser("convert", help="Repack day zips as containers")
+    convert.add_argument("paths", nargs="+", help="Paths to gtfsrt-YYYYmmdd.zip files")
+    convert.add_argument("-f", "--per-frame", type=int, default=16, help="Snapshots to compress together. Defaults to 16.")
+    convert.add_argument("-l", "--level", type=int, default=9, help="zstd compression level. Defaults to 9.")
+    convert.add_argument("--delete", action="store_true", help="Delete each day zip once it's been repacked")
+    info = subparsers.add_parser("info", help="List the snapshots in a container")
+    info.add_argument("path", help="Path to a container")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    if args.command == "convert":
+        for path in args.paths:
+            convert_day_zip(path, per_frame=args.per_frame, level=args.level)
+            if args.delete:
+                os.remove(path)
+    else:
+        with DayContainer(args.path) as container:
+            print(container.index.select(["name", "timestamp", "length"]).to_pandas().to_string())
+            print(f"{Fore.YELLOW}{len(container)}{Style.RESET_ALL} snapshots")
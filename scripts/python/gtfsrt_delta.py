@@ -0,0 +1,112 @@
+"""
+Store vehicle positions as per-vehicle trajectories, without the reports that repeat.
+
+A bus that hasn't reported again appears unchanged in every snapshot until it does, so much of a day's
+rows are copies. ChangeFilter keeps the latest state of each vehicle while the day is streamed and only
+lets a row through when its trip_id, timestamp or position has changed.
+
+The rows that are left are written sorted by vehicle_id and timestamp, so each vehicle's trajectory is
+one contiguous stream. Coordinates are stored as integers in units of 1e-5 degrees, and timestamps and
+coordinates use parquet's DELTA_BINARY_PACKED encoding, so each is stored as the (small) difference from
+the row before. read_trajectories turns them back into the usual columns.
+"""
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from colorama import Fore, Style
+
+COORDINATES = ["lat", "lon"]
+COORDINATE_SCALE = 10 ** 5
+
+class ChangeFilter:
+    """
+    Drop rows that repeat the last row seen for the same vehicle. Call it on each DataFrame of a stream in
+    turn; the state of each vehicle is carried over from one DataFrame to the next.
+    """
+    def __init__(self, by="vehicle_id", key=("trip_id", "timestamp", "lat", "lon"), coordinates=COORDINATES, round=5):
+        """
+        :param by: The column identifying a vehicle.
+        :param key: The columns that, if any have changed, make a row new.
+        :param coordinates: Float columns in key that are compared after rounding.
+        :param round: The number of dp to round coordinates to before comparing them.
+        """
+        self.by = by
+        self.key = list(key)
+        self.compare = [pl.col(c).round(round).alias(c) if c in coordinates else pl.col(c) for c in self.key]
+        self.last = None
+        self.rows_in = 0
+        self.rows_out = 0
+
+    def __call__(self, df:pl.DataFrame) -> pl.DataFrame:
+        current = df.select(pl.col(self.by), *self.compare).with_row_index("_row").with_columns(pl.col("_row").cast(pl.Int64))
+        combined = current if self.last is None else pl.concat([self.last, current])
+        combined = combined.sort([self.by, "_row"])
+
+        changed = pl.col(self.by).is_first_distinct()
+        for c in self.key:
+            changed = changed | pl.col(c).ne_missing(pl.col(c).shift(1).over(self.by))
+        keep = combined.filter(changed & (pl.col("_row") >= 0))["_row"]
+
+        # the last row of each vehicle is the state the next DataFrame is compared with
+        self.last = combined.group_by(self.by, maintain_order=True).last().with_columns(pl.lit(-1, pl.Int64).alias("_row")).select(current.columns)
+        out = df.with_row_index("_row").filter(pl.col("_row").cast(pl.Int64).is_in(keep.implode())).drop("_row")
+        self.rows_in += len(df)
+        self.rows_out += len(out)
+        return out
+
+    def report(self):
+        dropped = 1 - self.rows_out / self.rows_in if self.rows_in else 0
+        print(f"Kept {Fore.YELLOW}{self.rows_out}{Style.RESET_ALL} of {Fore.YELLOW}{self.rows_in}{Style.RESET_ALL} rows. Unchanged reports dropped: {Fore.YELLOW}{dropped:.2%}{Style.RESET_ALL}")
+
+def drop_unchanged(stream, **kwargs):
+    """Pass a stream of polars DataFrames through a ChangeFilter (kwargs are passed to it)."""
+    change_filter = ChangeFilter(**kwargs)
+    for df in stream:
+        yield change_filter(df)
+    change_filter.report()
+
+def to_trajectories(table:pa.Table) -> pa.Table:
+    """Sort rows into per-vehicle trajectories and store coordinates as int32s of 1e-5 degrees."""
+    # pyarrow can't sort by dictionary-encoded columns, so sort with polars
+    table = pl.from_arrow(table).sort(["vehicle_id", "timestamp"]).to_arrow()
+    for name in COORDINATES:
+        scaled = pc.cast(pc.round(pc.multiply(pc.cast(table[name], pa.float64()), COORDINATE_SCALE)), pa.int32())
+        table = table.set_column(table.schema.get_field_index(name), name, scaled)
+    return table
+
+def trajectory_writer(path, schema:pa.Schema) -> pq.ParquetWriter:
+    """
+    A ParquetWriter for tables from to_trajectories, with timestamps and coordinates delta-encoded and
+    dictionary encoding for the rest.
+    """
+    delta = [name for name in ["timestamp"] + COORDINATES if name in schema.names]
+    return pq.ParquetWriter(
+        path,
+        schema,
+        compression="zstd",
+        use_dictionary=[name for name in schema.names if name not in delta],
+        column_encoding={name: "DELTA_BINARY_PACKED" for name in delta},
+    )
+
+def write_trajectories(table:pa.Table, path):
+    """Write vehicle positions (with lat/lon columns) as a trajectory file."""
+    table = to_trajectories(table)
+    with trajectory_writer(path, table.schema) as writer:
+        writer.write_table(table)
+
+def read_trajectories(path, columns=None) -> pl.DataFrame:
+    """
+    Read a trajectory file back into the usual vehicle position columns, with the compact types of
+    realtime_schema (float32 coordinates), so it reads the same as the other parquet outputs.
+
+    :param path: The file (or a glob of files) to read.
+    :param columns: The columns to read. Defaults to all.
+    """
+    df = pl.scan_parquet(path)
+    if columns:
+        df = df.select(columns)
+    names = df.collect_schema().names()
+    return df.with_columns(
+        (pl.col(name).cast(pl.Float64) / COORDINATE_SCALE).round(5).cast(pl.Float32) for name in COORDINATES if name in names
+    ).collect()
@@ -0,0 +1,162 @@
+import argparse
+import fcntl
+import json
+import os
+import re
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+from zipfile import ZipFile, BadZipFile
+import polars as pl
+import pyarrow as pa
+from colorama import Fore, Style
+from dotenv import load_dotenv
+try:
+    from scripts.python.gtfsrt_to_parquet import GTFSRT2Parquet, ARROW_SCHEMA, rows_to_table
+except ModuleNotFoundError:
+    from gtfsrt_to_parquet import GTFSRT2Parquet, ARROW_SCHEMA, rows_to_table
+
+SNAPSHOT_PATTERN = re.compile(r"gtfsrt-([0-9]{8})T([0-9]{6})\.zip$")
+
+class GTFSRTIngest:
+    '''
+    Decode gtfsrt snapshots as they arrive into an append-only log for each day, so the nightly
+    conversion to parquet only has to compact and deduplicate.
+
+    Each snapshot is written as its own Arrow IPC stream segment in
+    `${BODSARCHIVE}/gtfsrt/YYYY/MM/DD/ingest/`, and `manifest.json` in the same directory records which
+    snapshots have been ingested.
+    '''
+    def __init__(self):
+        load_dotenv()
+        self.BODS_ARCHIVE_DIR = Path(os.environ.get("BODSARCHIVE"))
+
+    def get_ingest_dir(self, date:str) -> Path:
+        '''The ingest directory for a date string in 'YYYYmmdd' format.'''
+        return self.BODS_ARCHIVE_DIR / "gtfsrt" / date[0:4] / date[4:6] / date[6:8] / "ingest"
+
+    @contextmanager
+    def locked_manifest(self, ingest_dir:Path):
+        '''Lock and load the manifest for a day, saving it (atomically) on exit.'''
+        ingest_dir.mkdir(parents=True, exist_ok=True)
+        with open(ingest_dir / "manifest.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            path = ingest_dir / "manifest.json"
+            manifest = json.loads(path.read_text()) if path.exists() else {"snapshots": {}}
+            yield manifest
+            tmp = path.with_suffix(".json.tmp")
+            tmp.write_text(json.dumps(manifest, indent=1))
+            os.replace(tmp, path)
+
+    def ingest(self, snapshot_path):
+        '''
+        Decode one snapshot zip and append it to its day's log, unless it has already been ingested.
+
+        Params
+        ------
+        snapshot_path: str | Path
+            path to a `gtfsrt-YYYYmmddTHHMMSS.zip` snapshot
+
+        Returns
+        -------
+        rows: int
+            The number of vehicle positions appended (0 if it was already ingested or couldn't be read).
+        '''
+        snapshot_path = Path(snapshot_path)
+        match = SNAPSHOT_PATTERN.search(snapshot_path.name)
+        if not match:
+            print(f"{snapshot_path} is not a gtfsrt snapshot. Skipping.")
+            return 0
+        date, time = match.groups()
+        ingest_dir = self.get_ingest_dir(date)
+
+        with self.locked_manifest(ingest_dir) as manifest:
+            if snapshot_path.name in manifest["snapshots"]:
+                return 0
+            try:
+                with ZipFile(snapshot_path) as zf:
+                    table = rows_to_table(GTFSRT2Parquet.parse_member(zf.read("gtfsrt.bin")))
+            except (BadZipFile, KeyError) as e:
+                print(f"{snapshot_path} can't be read ({e}). Skipping.")
+                return 0
+
+            segment = ingest_dir / f"segment-{date}T{time}.arrows"
+            tmp = segment.with_suffix(".tmp")
+            with pa.OSFile(str(tmp), "wb") as sink, pa.ipc.new_stream(sink, ARROW_SCHEMA) as writer:
+                writer.write_table(table)
+            os.replace(tmp, segment)
+
+            manifest["snapshots"][snapshot_path.name] = {"segment": segment.name, "rows": table.num_rows}
+        print(f"Ingested {Fore.YELLOW}{table.num_rows}{Style.RESET_ALL} rows from {Fore.CYAN}{snapshot_path.name}{Style.RESET_ALL}")
+        return table.num_rows
+
+    def stream_segments(self, ingest_dir:Path, batch_size=100_000):
+        '''Yield a day's ingested segments as polars DataFrames of at least batch_size rows (bar the last).'''
+        manifest = json.loads((ingest_dir / "manifest.json").read_text())
+        tables, rows = [], 0
+        for name in sorted(manifest["snapshots"]):
+            with pa.OSFile(str(ingest_dir / manifest["snapshots"][name]["segment"])) as source:
+                tables.append(pa.ipc.open_stream(source).read_all())
+            rows += tables[-1].num_rows
+            if rows >= batch_size:
+                yield pl.from_arrow(pa.concat_tables(tables))
+                tables, rows = [], 0
+        if tables:
+            yield pl.from_arrow(pa.concat_tables(tables))
+
+    def compact(self, date=None, deduplicate=True, buckets=None, keep_segments=False, output="file"):
+        '''
+        Turn a day's ingested segments into the day's deduplicated parquet file, the same output as
+        GTFSRT2Parquet.run. Any snapshots in the day's directory that were missed are ingested first.
+
+        Params
+        ------
+        date: str
+            A date string in iso format. Defaults to yesterday.
+        deduplicate: bool
+            Whether or not to deduplicate the rows.
+        buckets: int
+            If given, deduplicate in this many hash buckets (see GTFSRT2Parquet.write_dataset).
+        keep_segments: bool
+            Keep the ingest directory after compacting.
+        output: str
+            "file" or "partitioned" (see GTFSRT2Parquet.read_and_combine).
+        '''
+        converter = GTFSRT2Parquet()
+        converter.set_date(date)
+        for snapshot in sorted(converter.given_day_data_dir.glob("gtfsrt-*T*.zip")):
+            self.ingest(snapshot)
+
+        ingest_dir = self.get_ingest_dir(converter.zip_file_date)
+        if not (ingest_dir / "manifest.json").exists():
+            print(f"{Fore.RED}Nothing has been ingested for {converter.zip_file_date}{Style.RESET_ALL}")
+            return
+
+        converter.write_dataset(self.stream_segments(ingest_dir), temp_dir=converter.ROOT / "tmp", buckets=buckets)
+        converter.read_and_combine(deduplicate=deduplicate, output=output)
+        converter.clean_up()
+        if not keep_segments:
+            shutil.rmtree(ingest_dir)
+
+def set_args():
+    '''Set the arguments given in the command line'''
+    parser = argparse.ArgumentParser(description="Incrementally ingest gtfsrt snapshots and compact them into a day's parquet file.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    ingest = subparsers.add_parser("ingest", help="Append snapshot zips to their day's log")
+    ingest.add_argument("paths", nargs="+", help="Paths to gtfsrt-YYYYmmddTHHMMSS.zip files")
+    compact = subparsers.add_parser("compact", help="Compact a day's log into its deduplicated parquet file")
+    compact.add_argument("-d", "--date", help="Date string in iso format 'YYYY-mm-dd'. Defaults to yesterday.")
+    compact.add_argument("-b", "--buckets", type=int, help="Deduplicate out-of-core in this many hash buckets.")
+    compact.add_argument("--keep-segments", action="store_true", help="Keep the day's log after compacting.")
+    compact.add_argument("-o", "--output", choices=["file", "partitioned"], default="file", help="Write one parquet file for the day, or add the day to the partitioned archive.")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    if args.command == "ingest":
+        ingest = GTFSRTIngest()
+        for path in args.paths:
+            ingest.ingest(path)
+    else:
+        GTFSRTIngest().compact(date=args.date, buckets=args.buckets, keep_segments=args.keep_segments, output=args.output)
@@ -1,9 +1,16 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import os
 from colorama import Fore, Back, Style
 import argparse
 from datetime import datetime, timedelta
-from gtfs_realtime_utils import get_gtfs_entities_from_directory
+import polars as pl
+from gtfs_realtime_utils import iter_gtfsrt_batches, VEHICLE_POSITION_FIELDS
+from gtfsrt_delta import ChangeFilter
+from sirivm import iter_sirivm_batches
+from realtime_schema import compact_schema, expand
+import metrics
 
 def entities_to_dataframe(entities, round=5):
     '''
@@ -52,6 +59,52 @@ def entities_to_dataframe(entities, round=5):
 
     return df
 
+def batches_to_dataframe(batches, round=5):
+    '''
+    Converts a stream of Arrow record batches (see gtfs_realtime_utils.iter_gtfsrt_batches) into a dataframe
+
+    Params
+    ------
+    batches: iterable
+        record batches of vehicle positions
+
+    round: int
+        number of dp to round coordinates
+
+    Returns
+    -------
+    df: pandas.DataFrame
+        The resulting dataframe, with the same columns as entities_to_dataframe. The columns keep the compact
+        types in realtime_schema, with the ids, start_date and start_time as categories. If there are no
+        batches (e.g. every snapshot of the day was corrupt) it has no rows.
+    '''
+    columns = ["trip_id", "start_time", "start_date", "schedule_relationship", "route_id", "latitude",
+               "longitude", "bearing", "stop_sequence", "status", "timestamp", "vehicle_id"]
+    batches = list(batches)
+    if batches:
+        table = pa.Table.from_batches(batches)
+    else:
+        table = compact_schema(pa.schema([(name, VEHICLE_POSITION_FIELDS[name][1]) for name in columns])).empty_table()
+
+    print(f"There are {Fore.YELLOW}{table.num_rows}{Style.RESET_ALL} entities (bus location reports).")
+
+    # Write the dates and times out as GTFS strings again, but keep them dictionary-encoded as they repeat as much as the ids
+    table = expand(table.select(columns))
+    for name in ("start_time", "start_date"):
+        table = table.set_column(table.schema.get_field_index(name), name, pc.dictionary_encode(table[name]))
+    df = table.to_pandas()
+    # Put the categories in order, so sorting by them is the same as sorting the strings
+    for col in df.select_dtypes("category"):
+        df[col] = df[col].cat.reorder_categories(df[col].cat.categories.sort_values())
+    df['bearing'] = df['bearing'].astype(int)
+
+    # Optionally round coordinates (in float64, as float32 can't hold every 5 dp value exactly)
+    if round:
+        df['longitude'] = df['longitude'].astype('float64').round(round)
+        df['latitude'] = df['latitude'].astype('float64').round(round)
+
+    return df
+
 def remove_duplicate_reports(df, subset=['timestamp', 'vehicle_id', 'trip_id', 'longitude', 'latitude'], sortby=['timestamp', 'vehicle_id', 'trip_id']):
     '''
     Removes duplicate data and sorts the resulting dataframe. Prints the fraction of data that was duplicated.
@@ -77,24 +130,94 @@ def remove_duplicate_reports(df, subset=['timestamp', 'vehicle_id', 'trip_id', '
     
     without_duplicates = len(df) # Count the length of the de-duplicated dataframe
     
-    fraction_duplicated = round((1 - without_duplicates/with_duplicates)*100, 4)
+    fraction_duplicated = round((1 - without_duplicates/with_duplicates)*100, 4) if with_duplicates else 0
     
     print(f"Fraction of data that was duplicated in 'longitude', 'latitude', 'timestamp', 'vehicle_id', 'trip_id':{Fore.YELLOW}{fraction_duplicated}%{Style.RESET_ALL}")
 
     df.sort_values(by=sortby, ascending=True, inplace=True)
     return df
 
+def drop_unchanged_batches(batches, round=5):
+    '''
+    Drop rows that repeat the last report of the same vehicle as batches are read (see gtfsrt_delta.ChangeFilter),
+    so the repeats are never held in memory.
+
+    Params
+    ------
+    batches: iterable
+        record batches of vehicle positions
+
+    round: int
+        number of dp coordinates are rounded to before comparing them
+
+    Yields
+    ------
+    batch: pyarrow.RecordBatch
+    '''
+    change_filter = ChangeFilter(key=("trip_id", "timestamp", "latitude", "longitude"), coordinates=["latitude", "longitude"], round=round)
+    for batch in batches:
+        yield from change_filter(pl.from_arrow(batch)).to_arrow().to_batches()
+    change_filter.report()
+
 def set_args():
     '''Set the arguments given in the command line'''
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--date", help="Date string format 'YYYY/mm/dd'")
     parser.add_argument("-f", "--force", action='store_true')
+    parser.add_argument("--delta", action='store_true', help="Drop reports that repeat the vehicle's last one while reading, rather than all at the end")
+    parser.add_argument("--feed", choices=["gtfsrt", "sirivm"], default="gtfsrt", help="Convert the day's gtfsrt or SIRI-VM snapshots. Defaults to gtfsrt.")
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes to decode SIRI-VM with. Defaults to the number of CPUs.")
+    metrics.add_arguments(parser)
     args = parser.parse_args()
     return args
 
-def main():
+def get_output_path(datestring, feed="gtfsrt", archive=None):
+    '''The path of a day's CSV, ${BODSARCHIVE}/csv/YYYY/csv-YYYYmmdd.csv.zip (or sirivm-csv-YYYYmmdd.csv.zip), for a datestring 'YYYY/mm/dd'. archive is used instead of ${BODSARCHIVE} if given.'''
+    prefix = "csv-" if feed == "gtfsrt" else "sirivm-csv-"
+    return os.path.join(archive or os.environ['BODSARCHIVE'], 'csv', datestring[0:4], prefix + datestring.replace("/", "") + '.csv.zip')
+
+def convert(datestring, outpath, feed="gtfsrt", delta=False, workers=None):
+    '''
+    Convert a day's snapshots into a de-duplicated CSV
+
+    Params
+    ------
+    datestring: str
+        the day, as 'YYYY/mm/dd'
+
+    outpath: str
+        where to save the CSV
+
+    feed: str
+        "gtfsrt" or "sirivm"
+
+    delta: bool
+        drop reports that repeat the vehicle's last one while reading (see drop_unchanged_batches)
+
+    workers: int
+        number of processes to decode SIRI-VM with
+    '''
     BODSARCHIVE = os.environ['BODSARCHIVE']
-    
+    os.makedirs(os.path.dirname(outpath), exist_ok=True) # ensure directory exists
+    with metrics.stage("decode", feed=feed):
+        if feed == "sirivm":
+            batches = iter_sirivm_batches(os.path.join(BODSARCHIVE, 'sirivm', datestring), workers=workers)
+        else:
+            batches = iter_gtfsrt_batches(os.path.join(BODSARCHIVE, 'gtfsrt', datestring))
+        if delta:
+            batches = drop_unchanged_batches(batches)
+        df = batches_to_dataframe(batches, round=5)
+    print(f"{Fore.GREEN}Entities loaded into DataFrame{Style.RESET_ALL}")
+    with metrics.stage("dedupe") as stage:
+        stage.count(rows=len(df))
+        clean_df = remove_duplicate_reports(df)
+    print(f"{Fore.GREEN}Duplicates removed{Style.RESET_ALL}")
+    with metrics.stage("write") as stage:
+        clean_df.to_csv(outpath, index=False)
+        stage.count(rows=len(clean_df), bytes_written=os.path.getsize(outpath))
+    print(f"File successfully saved to {Fore.MAGENTA}{outpath}{Style.RESET_ALL}")
+
+def main():
     args = set_args()
 
     if not args.date: # if no date argument, create datestring for previous day
@@ -103,23 +226,15 @@ def main():
     else:
         datestring = args.date # get the command line variable if supplied
 
-    OUTDIR = os.path.join(BODSARCHIVE, 'csv', datestring[0:4])
-    os.makedirs(OUTDIR, exist_ok=True) # ensure directory exists
-    OUTPATH = os.path.join(OUTDIR, "csv-" + datestring.replace("/", "") + '.csv.zip')
+    OUTPATH = get_output_path(datestring, feed=args.feed)
 
     # If not forced, but OUTPATH is already a file.
     if not args.force and os.path.isfile(OUTPATH):
             print('Already a file.')
 
     else: 
-        entities = get_gtfs_entities_from_directory(os.path.join(BODSARCHIVE, 'gtfsrt', datestring))
-        print(f"{Fore.GREEN}Entities loaded from binaries{Style.RESET_ALL}")
-        df = entities_to_dataframe(entities, round=5)
-        print(f"{Fore.GREEN}Entities loaded into DataFrame{Style.RESET_ALL}")
-        clean_df = remove_duplicate_reports(df)
-        print(f"{Fore.GREEN}Duplicates removed{Style.RESET_ALL}")
-        clean_df.to_csv(OUTPATH, index=False)
-        print(f"File successfully saved to {Fore.MAGENTA}{OUTPATH}{Style.RESET_ALL}")
+        with metrics.from_args("gtfsrt_to_csv", args):
+            convert(datestring, OUTPATH, feed=args.feed, delta=args.delta, workers=args.workers)
 
 if __name__ == "__main__":
     main()
@@ -1,12 +1,83 @@
 from zipfile import ZipFile
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from google.transit import gtfs_realtime_pb2
 import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
 import gc
+import shutil
 from pathlib import Path
 import os
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
+try:
+    from scripts.python.gtfsrt_wire import decode_vehicle_positions, WireFormatError
+    from scripts.python.realtime_schema import ARROW_SCHEMA, PLAIN_SCHEMA, compact
+    from scripts.python import gtfsrt_archive, gtfsrt_delta, sirivm, metrics
+except ModuleNotFoundError:
+    from gtfsrt_wire import decode_vehicle_positions, WireFormatError
+    from realtime_schema import ARROW_SCHEMA, PLAIN_SCHEMA, compact
+    import gtfsrt_archive
+    import gtfsrt_delta
+    import sirivm
+    import metrics
+
+# Day zips opened by this (worker) process, so each worker only reads the central directory once.
+_open_zips = {}
+
+def decode_members(zip_path, names, decoder="pb2"):
+    """
+    Decode a group of snapshot zips from inside a day zip. This runs in a worker process.
+
+    :param zip_path: The path to the day zip.
+    :param names: The names of the snapshot zips (members of the day zip) to decode.
+    :param decoder: "pb2" to decode with gtfs_realtime_pb2 or "wire" to use the wire-format fast path
+        in gtfsrt_wire, falling back to gtfs_realtime_pb2 if it can't decode the snapshots. "siri" for a
+        day zip of sirivm snapshots (see sirivm).
+    :return: A pyarrow.Table with the columns in ARROW_SCHEMA.
+    """
+    zf = _open_zips.get(zip_path)
+    if zf is None:
+        zf = _open_zips[zip_path] = ZipFile(zip_path)
+
+    bin_file = sirivm.BIN_FILE if decoder == "siri" else "gtfsrt.bin"
+    payloads = []
+    for name in names:
+        try:
+            with zf.open(name) as subzip_bytes, ZipFile(subzip_bytes) as subzf:
+                payloads.append(subzf.read(bin_file))
+        except Exception as e:
+            print(f"Failed with exception: {e}")
+            print(f"Skipping: {name}")
+
+    return decode_payloads(payloads, decoder)
+
+def decode_payloads(payloads, decoder="pb2"):
+    """
+    Decode raw gtfsrt binaries (or SIRI-VM documents) into one table.
+
+    :param payloads: A list of serialised FeedMessages, as bytes, or of siri.xml documents for "siri".
+    :param decoder: "pb2", "wire" or "siri" (see decode_members).
+    :return: A pyarrow.Table with the columns in ARROW_SCHEMA.
+    """
+    if decoder == "siri":
+        return sirivm.parse_siri_payloads(payloads)
+    if decoder == "wire":
+        try:
+            return compact(decode_vehicle_positions(b"".join(payloads)))
+        except WireFormatError as e:
+            print(f"Wire-format decoder failed ({e}). Falling back to gtfs_realtime_pb2.")
+
+    rows = []
+    for data in payloads:
+        rows.extend(GTFSRT2Parquet.parse_member(data))
+    return rows_to_table(rows)
+
+def rows_to_table(rows):
+    """Convert rows from GTFSRT2Parquet.parse_member to a pyarrow.Table with the (compact) columns in ARROW_SCHEMA."""
+    columns = list(zip(*rows)) if rows else [[] for _ in PLAIN_SCHEMA]
+    return compact(pa.Table.from_arrays([pa.array(col, type=field.type) for col, field in zip(columns, PLAIN_SCHEMA)], schema=PLAIN_SCHEMA))
 
 class GTFSRT2Parquet:
     def __init__(self):
@@ -36,7 +107,8 @@ class GTFSRT2Parquet:
         ]
         return SCHEMA
     
-    def parse_member(self, member_bytes):
+    @staticmethod
+    def parse_member(member_bytes):
         """parse an individual gtsfrt binary file"""
         feed = gtfs_realtime_pb2.FeedMessage()
         feed.ParseFromString(member_bytes)
@@ -63,7 +135,40 @@ class GTFSRT2Parquet:
             ))
         return out
 
-    def stream_gtfsrt(self, zip_path, batch_size=10000):
+    def set_date(self, date=None, feed="gtfsrt"):
+        """
+        Set the day to convert and the directory its data is in.
+
+        :param date: A string for a specific date in iso format. Defaults to yesterday.
+        :param feed: "gtfsrt" or "sirivm".
+        """
+        if not date:
+            self.zip_file_date = self.setup_yesterday()
+            self.year = self.yesterday.year
+            self.month = self.yesterday.month
+            self.day = self.yesterday.day
+        else:
+            dt = datetime.fromisoformat(date)
+            self.zip_file_date = dt.strftime("%Y%m%d")
+            self.year = dt.year
+            self.month = dt.month
+            self.day = dt.day
+        print(f"Zipfile date: {self.zip_file_date}")
+        self.given_day_data_dir = self.BODS_ARCHIVE_DIR / f"{feed}/{self.year}/{str(self.month).zfill(2)}/{str(self.day).zfill(2)}"
+
+    def stream_gtfsrt(self, zip_path, batch_size=10000, workers=None, decoder="pb2"):
+        """
+        Stream a day zip of gtfsrt snapshots as polars DataFrames.
+
+        :param zip_path: The path to the day zip.
+        :param batch_size: The minimum number of rows in each DataFrame (thread mode only).
+        :param workers: If given, decode in this many worker processes instead of threads (see stream_gtfsrt_processes).
+        :param decoder: "pb2" or "wire" (see decode_members). Only used with workers.
+        """
+        if workers:
+            yield from self.stream_gtfsrt_processes(zip_path, workers=workers, decoder=decoder)
+            return
+
         print(f"Reading {zip_path}")
         batch = []
         futures = []
@@ -77,7 +182,9 @@ class GTFSRT2Parquet:
                     except Exception as e:
                         print(f"Failed with exception: {e}")
                         print(f"Skipping: {subzip_bytes}")
+                        metrics.count(corrupt=1)
                         continue
+                metrics.count(bytes_read=len(data))
 
                 futures.append(ex.submit(self.parse_member, data))
 
@@ -87,7 +194,7 @@ class GTFSRT2Parquet:
                     futures.clear()
 
                 if len(batch) >= batch_size:
-                    yield pl.DataFrame(batch, schema=self.gtfsrt_schema, orient="row")
+                    yield pl.from_arrow(rows_to_table(batch))
                     batch.clear()
                     gc.collect()
 
@@ -96,18 +203,108 @@ class GTFSRT2Parquet:
                 batch.extend(fut.result())
 
             if batch:
-                yield pl.DataFrame(batch, orient="row", schema=self.gtfsrt_schema)
+                yield pl.from_arrow(rows_to_table(batch))
+
+    def stream_gtfsrt_processes(self, zip_path, workers, members_per_task=16, tasks_per_worker=2, decoder="pb2"):
+        """
+        Stream a day zip of gtfsrt snapshots as polars DataFrames, decoding in a pool of processes.
+
+        Only the central directory of the day zip is read here. Each worker is handed the names of a
+        group of snapshot zips, reads and decodes them itself and returns an Arrow table, so reading
+        and decoding run in parallel while the caller writes the previous results. At most
+        workers * tasks_per_worker groups are in flight at once, which bounds memory if the writer
+        falls behind.
+
+        :param zip_path: The path to the day zip.
+        :param workers: The number of worker processes.
+        :param members_per_task: The number of snapshot zips handed to a worker at a time.
+        :param tasks_per_worker: The number of groups queued per worker.
+        :param decoder: "pb2" or "wire" (see decode_members).
+        """
+        print(f"Reading {zip_path} with {workers} worker processes")
+        zip_path = str(zip_path)
+        with ZipFile(zip_path) as zf:
+            names = [info.filename for info in zf.infolist() if not info.is_dir()]
+        groups = [names[i:i + members_per_task] for i in range(0, len(names), members_per_task)]
+
+        max_in_flight = workers * tasks_per_worker
+        pending = set()
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            for group in groups:
+                if len(pending) >= max_in_flight:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        yield pl.from_arrow(fut.result())
+                pending.add(ex.submit(decode_members, zip_path, group, decoder))
 
-    def write_dataset(self, stream:pl.DataFrame, temp_dir:Path):
+            # flush
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    yield pl.from_arrow(fut.result())
+
+    def get_dedupe_columns(self):
+        """The columns that must all match for two rows to be duplicates."""
+        return [col for col in self.gtfsrt_schema if col not in ("entity_id", "bearing")]
+
+    def write_dataset(self, stream:pl.DataFrame, temp_dir:Path, buckets=None, bucket_by=("vehicle_id", "timestamp")):
+        """
+        Write a stream of DataFrames to temporary parquet part files.
+
+        :param stream: The DataFrames to write.
+        :param temp_dir: The directory to write them to.
+        :param buckets: If given, hash-partition the rows by bucket_by into this many bucket directories, so
+        duplicates always land in the same bucket and each can be deduplicated on its own. A 64-bit hash of the
+        deduplication columns is stored alongside in a "_key" column.
+        :param bucket_by: The columns to hash into buckets, a subset of the deduplication columns. Bucket by
+        vehicle_id alone to keep each vehicle's rows (e.g. its trajectory) in one bucket.
+        """
         self.temp_dir = temp_dir
         self.temp_dir.mkdir(exist_ok=True, parents=True)
+        self.buckets = buckets
         print(f"Saving to {self.temp_dir}")
         for i, df in enumerate(stream):
-            pth = f"{self.temp_dir}/part-{i:06d}.parquet"
-            df.write_parquet(pth)
-            print(f"Wrote to {pth}")
-    
-    def read_and_combine(self, deduplicate):
+            metrics.count(rows=df.height)
+            if not buckets:
+                pth = f"{self.temp_dir}/part-{i:06d}.parquet"
+                df.write_parquet(pth)
+                print(f"Wrote to {pth}")
+                continue
+
+            df = df.with_columns(
+                pl.col("lat").round(5).alias("lat"),
+                pl.col("lon").round(5).alias("lon")
+            ).with_columns(
+                pl.struct(self.get_dedupe_columns()).hash(seed=0).alias("_key"),
+                (pl.struct(*bucket_by).hash(seed=1) % buckets).alias("_bucket"),
+            )
+            for (bucket,), part in df.partition_by("_bucket", as_dict=True, include_key=False).items():
+                bucket_dir = self.temp_dir / f"bucket-{bucket:04d}"
+                bucket_dir.mkdir(exist_ok=True)
+                part.write_parquet(bucket_dir / f"part-{i:06d}.parquet")
+            print(f"Wrote part {i} to {buckets} buckets in {self.temp_dir}")
+
+    def read_and_combine(self, deduplicate, parallel=4, output="file"):
+        """
+        Combine the temporary part files into one parquet file for the day.
+
+        :param deduplicate: Whether or not to deduplicate the rows.
+        :param parallel: How many buckets to deduplicate at once, if write_dataset was given buckets.
+        :param output: "file" to write the day's all_bus_locations_deduplicated_YYYYMMDD.parquet,
+        "partitioned" to add the rows to the date/hour partitioned archive (see gtfsrt_archive) or
+        "trajectories" to write bus_trajectories_YYYYMMDD.parquet (see gtfsrt_delta).
+        """
+        outpath = self.given_day_data_dir / f"all_bus_locations_deduplicated_{self.zip_file_date}.parquet"
+        if output == "trajectories":
+            outpath = self.given_day_data_dir / f"bus_trajectories_{self.zip_file_date}.parquet"
+        if output == "partitioned":
+            outpath = gtfsrt_archive.get_archive_dir()
+            gtfsrt_archive.clear_run(outpath, self.zip_file_date)
+        if getattr(self, "buckets", None):
+            self.combine_buckets(outpath, deduplicate=deduplicate, parallel=parallel, output=output)
+            self.passing = True
+            return
+
         df = pl.scan_parquet(self.temp_dir / "*.parquet")
 
         colnames = df.collect_schema().names()
@@ -119,42 +316,120 @@ class GTFSRT2Parquet:
             df = df.unique(subset=[col for col in colnames if col not in ("entity_id", "bearing")])
         
         df = df.collect()
-        outpath = self.given_day_data_dir / f"all_bus_locations_deduplicated_{self.zip_file_date}.parquet"
         print(f"Writing to {outpath}")
-        df.write_parquet(outpath)
+        metrics.count(rows=df.height)
+        if output == "partitioned":
+            gtfsrt_archive.write_partitioned(df.to_arrow(), outpath, run_id=self.zip_file_date, route_prefix_length=getattr(self, "route_prefix", None))
+        elif output == "trajectories":
+            gtfsrt_delta.write_trajectories(df.to_arrow(), outpath)
+        else:
+            df.write_parquet(outpath)
+        if output != "partitioned":
+            metrics.count(bytes_written=os.path.getsize(outpath))
         self.passing = True
 
+    def read_bucket(self, bucket_dir:Path, deduplicate:bool) -> pa.Table:
+        """Read one bucket of part files, deduplicating on the "_key" hash column."""
+        df = pl.scan_parquet(bucket_dir / "*.parquet")
+        if deduplicate:
+            df = df.unique(subset=["_key"])
+        return df.drop("_key").collect().to_arrow()
+
+    def combine_buckets(self, outpath:Path, deduplicate=True, parallel=4, output="file"):
+        """
+        Deduplicate each bucket written by write_dataset on its own, `parallel` at a time, and write each
+        one as row groups of the output file. Peak memory is set by the size of a bucket, not of the day.
+        If output is "partitioned", each bucket is written to a staging archive in temp_dir instead, and then
+        each partition's buckets are merged into one file in the partitioned archive at outpath.
+        If it is "trajectories", each bucket's rows are sorted into trajectories in their row groups.
+        """
+        bucket_dirs = sorted(self.temp_dir.glob("bucket-*"))
+        print(f"Combining {len(bucket_dirs)} buckets into {outpath}")
+        staging = self.temp_dir / "partitioned"
+        writer = None
+        pending = {}
+        with ThreadPoolExecutor(max_workers=parallel) as ex:
+            for bucket_dir in bucket_dirs + [None]:
+                if bucket_dir is not None:
+                    pending[ex.submit(self.read_bucket, bucket_dir, deduplicate)] = bucket_dir.name
+                # Write finished buckets once the pool is full (or everything has been submitted)
+                while pending and (len(pending) >= parallel or bucket_dir is None):
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        table = fut.result()
+                        bucket = pending.pop(fut)
+                        metrics.count(rows=table.num_rows)
+                        if output == "partitioned":
+                            gtfsrt_archive.write_partitioned(table, staging, run_id=bucket, route_prefix_length=getattr(self, "route_prefix", None))
+                            continue
+                        if output == "trajectories":
+                            table = gtfsrt_delta.to_trajectories(table)
+                        if writer is None:
+                            writer = gtfsrt_delta.trajectory_writer(outpath, table.schema) if output == "trajectories" else pq.ParquetWriter(outpath, table.schema)
+                        writer.write_table(table)
+        if output == "partitioned":
+            gtfsrt_archive.merge_partitions(staging, outpath, run_id=self.zip_file_date)
+        if writer is not None:
+            writer.close()
+            metrics.count(bytes_written=os.path.getsize(outpath))
+
     def clean_up(self):
         if self.passing:
-            for f in self.temp_dir.glob("*.parquet"):
-                f.unlink()
-            self.temp_dir.rmdir()
+            shutil.rmtree(self.temp_dir)
 
-    def run(self, date=None, deduplicate=True):
+    def run(self, date=None, deduplicate=True, workers=None, decoder="pb2", buckets=None, output="file", feed="gtfsrt", route_prefix=None):
         """
         Convert a day's worth of GTFSRT files from the BODS Archive to parquet.
 
         :param date: A string for a specific date in iso format.
         :param deduplicate: Whether or not to deduplicate the bus data on the columns:
         "trip_id", "route_id", "start_date", "start_time", "lat", "lon", "timestamp", "vehicle_id".
+        :param workers: The number of processes to decode with. If not given, decode in threads.
+        :param decoder: "pb2" to decode with gtfs_realtime_pb2 or "wire" to use the faster wire-format decoder. Only used with workers.
+        :param buckets: If given, deduplicate out-of-core by hash-partitioning the rows into this many buckets, so peak memory is set by the bucket size rather than the day.
+        :param output: "file" for one parquet file in the day's directory, "partitioned" to add the day to the date/hour partitioned archive in ${BODSARCHIVE}/gtfsrt-parquet, or "trajectories" to drop unchanged reports while streaming and write per-vehicle, delta-encoded trajectories (read them with gtfsrt_delta.read_trajectories).
+        :param feed: "gtfsrt", or "sirivm" to convert the day's SIRI-VM snapshots to the same columns (see sirivm). SIRI-VM is always decoded in processes, by default one per CPU.
+        :param route_prefix: With output "partitioned", also partition by the first this-many characters of route_id (see gtfsrt_archive.write_partitioned).
         """
-        if not date:
-            self.zip_file_date = self.setup_yesterday()
-            self.year = self.yesterday.year
-            self.month = self.yesterday.month
-            self.day = self.yesterday.day
-        else:
-            dt = datetime.fromisoformat(date)
-            self.zip_file_date = dt.strftime("%Y%m%d")
-            self.year = dt.year
-            self.month = dt.month
-            self.day = dt.day
-        print(f"Zipfile date: {self.zip_file_date}")
-        self.given_day_data_dir = self.BODS_ARCHIVE_DIR / f"gtfsrt/{self.year}/{str(self.month).zfill(2)}/{str(self.day).zfill(2)}"
-        stream = self.stream_gtfsrt(zip_path=self.given_day_data_dir / f"gtfsrt-{self.zip_file_date}.zip")
-        self.write_dataset(stream=stream, temp_dir=self.ROOT / "tmp")
-        self.read_and_combine(deduplicate=deduplicate)
+        if feed == "sirivm":
+            if output == "partitioned":
+                raise ValueError("The partitioned archive is only for gtfsrt.")
+            workers = workers or os.cpu_count()
+            decoder = "siri"
+        self.route_prefix = route_prefix
+        self.set_date(date, feed=feed)
+        with metrics.stage("decode", feed=feed, decoder=decoder):
+            stream = self.stream_gtfsrt(zip_path=self.given_day_data_dir / f"{feed}-{self.zip_file_date}.zip", workers=workers, decoder=decoder)
+            if output == "trajectories":
+                stream = gtfsrt_delta.drop_unchanged(stream)
+            # A vehicle's trajectory must be in one bucket, or it's split into pieces in the file
+            bucket_by = ["vehicle_id"] if output == "trajectories" else ["vehicle_id", "timestamp"]
+            self.write_dataset(stream=stream, temp_dir=self.ROOT / "tmp", buckets=buckets, bucket_by=bucket_by)
+        with metrics.stage("combine", output=output):
+            self.read_and_combine(deduplicate=deduplicate, output=output)
         self.clean_up()
 
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--date", help="Date string in iso format 'YYYY-mm-dd'. Defaults to yesterday.")
+    parser.add_argument("-w", "--workers", type=int, help="Number of processes to decode with. Defaults to decoding in threads.")
+    parser.add_argument("--decoder", choices=["pb2", "wire"], default="pb2", help="Decode with gtfs_realtime_pb2 or the faster wire-format decoder (needs --workers).")
+    parser.add_argument("-b", "--buckets", type=int, help="Deduplicate out-of-core in this many hash buckets, to bound memory use.")
+    parser.add_argument("-o", "--output", choices=["file", "partitioned", "trajectories"], default="file", help="Write one parquet file for the day, add the day to the partitioned archive, or write per-vehicle trajectories without unchanged reports.")
+    parser.add_argument("--feed", choices=["gtfsrt", "sirivm"], default="gtfsrt", help="Convert the day's gtfsrt or SIRI-VM snapshots. Defaults to gtfsrt.")
+    parser.add_argument("--route-prefix", type=int, help="With --output partitioned, also partition by the first this-many characters of route_id. Use the same length for every day in the archive.")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+    if args.decoder == "wire" and not args.workers:
+        parser.error("--decoder wire needs --workers")
+    if args.feed == "sirivm" and args.output == "partitioned":
+        parser.error("--output partitioned is only for gtfsrt")
+    if args.route_prefix and args.output != "partitioned":
+        parser.error("--route-prefix needs --output partitioned")
+    return args
+
 if __name__ == "__main__":
-    GTFSRT2Parquet().run(date=None)
\ No newline at end of file
+    args = set_args()
+    with metrics.from_args("gtfsrt_to_parquet", args):
+        GTFSRT2Parquet().run(date=args.date, workers=args.workers, decoder=args.decoder, buckets=args.buckets, output=args.output, feed=args.feed, route_prefix=args.route_prefix)
\ No newline at end of file
@@ -0,0 +1,126 @@
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from zipfile import ZipFile
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+from colorama import Fore, Style
+try:
+    from scripts.python.gtfsrt_to_parquet import ARROW_SCHEMA, decode_members, decode_payloads
+    from scripts.python.gtfsrt_container import DayContainer, SUFFIX as CONTAINER_SUFFIX, timestamp_from_name, to_epoch
+except ModuleNotFoundError:
+    from gtfsrt_to_parquet import ARROW_SCHEMA, decode_members, decode_payloads
+    from gtfsrt_container import DayContainer, SUFFIX as CONTAINER_SUFFIX, timestamp_from_name, to_epoch
+
+# Containers opened by this (worker) process, so each worker only reads the index once.
+_open_containers = {}
+
+def select_members(zip_path, start=None, end=None) -> list:
+    """
+    The names of the snapshot zips in a day zip that were taken from start to end (inclusive), in time
+    order. Only the central directory is read: the times come from the member names.
+
+    :param zip_path: The path to a day zip.
+    :param start: A datetime, iso format string or epoch seconds, in UTC.
+    :param end: As start.
+    """
+    start = to_epoch(start) if start is not None else None
+    end = to_epoch(end) if end is not None else None
+    selected = []
+    with ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            timestamp = timestamp_from_name(info.filename)
+            if timestamp is None or (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            selected.append((timestamp, info.filename))
+    return [name for _, name in sorted(selected)]
+
+def filter_table(table:pa.Table, route_ids=None, vehicle_ids=None) -> pa.Table:
+    """Keep the rows of a decoded table with one of the route_ids and one of the vehicle_ids."""
+    mask = None
+    for column, values in (("route_id", route_ids), ("vehicle_id", vehicle_ids)):
+        if values:
+            keep = pc.is_in(table[column], value_set=pa.array(values, type=pa.string()))
+            mask = keep if mask is None else pc.and_(mask, keep)
+    return table if mask is None else table.filter(mask)
+
+def decode_group(path:str, group, decoder="pb2", route_ids=None, vehicle_ids=None) -> pa.Table:
+    """
+    Decode and filter a group of snapshots. This runs in a worker process, so only the rows that pass the
+    filters are sent back.
+
+    :param path: A day zip or container.
+    :param group: Member names for a day zip, or index rows for a container.
+    """
+    if path.endswith(CONTAINER_SUFFIX):
+        container = _open_containers.get(path)
+        if container is None:
+            container = _open_containers[path] = DayContainer(path)
+        table = decode_payloads([data for _, data in container.iter_rows(group)], decoder)
+    else:
+        table = decode_members(path, group, decoder)
+    return filter_table(table, route_ids, vehicle_ids)
+
+def read_window(path, start=None, end=None, route_id=None, vehicle_id=None, workers=None, decoder="pb2", members_per_task=16) -> pl.DataFrame:
+    """
+    Decode only the snapshots of a day taken in a time window, optionally keeping only some routes or
+    vehicles. The snapshots are picked by the times in their names, so the rest of the day is never read.
+
+    :param path: A day zip (a zip of snapshot zips) or a day container (see gtfsrt_container).
+    :param start: Earliest snapshot time (inclusive), as a datetime, iso format string or epoch seconds, in UTC.
+    :param end: Latest snapshot time (inclusive), as start.
+    :param route_id: A route_id, or list of route_ids, to keep.
+    :param vehicle_id: A vehicle_id, or list of vehicle_ids, to keep.
+    :param workers: The number of worker processes to decode in. Defaults to the number of CPUs. 1 decodes
+        in this process.
+    :param decoder: "pb2" or "wire" (see gtfsrt_to_parquet.decode_members).
+    :param members_per_task: The number of snapshots handed to a worker at a time.
+    :return: A polars.DataFrame with the columns in gtfsrt_to_parquet.ARROW_SCHEMA, not deduplicated.
+    """
+    path = str(path)
+    route_ids = [route_id] if isinstance(route_id, str) else route_id
+    vehicle_ids = [vehicle_id] if isinstance(vehicle_id, str) else vehicle_id
+
+    if path.endswith(CONTAINER_SUFFIX):
+        with DayContainer(path) as container:
+            selected = container.window(start, end).tolist()
+    else:
+        selected = select_members(path, start, end)
+    print(f"Decoding {Fore.YELLOW}{len(selected)}{Style.RESET_ALL} snapshots from {Fore.CYAN}{path}{Style.RESET_ALL}")
+
+    groups = [selected[i:i + members_per_task] for i in range(0, len(selected), members_per_task)]
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(groups) <= 1:
+        tables = [decode_group(path, group, decoder, route_ids, vehicle_ids) for group in groups]
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(groups))) as ex:
+            tables = list(ex.map(decode_group, [path] * len(groups), groups, [decoder] * len(groups), [route_ids] * len(groups), [vehicle_ids] * len(groups)))
+    return pl.from_arrow(pa.concat_tables(tables) if tables else ARROW_SCHEMA.empty_table())
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Decode a time window of a gtfsrt day zip or container.")
+    parser.add_argument("path", help="Path to a gtfsrt-YYYYmmdd.zip or .gtfsrtz")
+    parser.add_argument("-s", "--start", help="Earliest snapshot time, iso format in UTC e.g. '2025-05-29T07:00'")
+    parser.add_argument("-e", "--end", help="Latest snapshot time, iso format in UTC e.g. '2025-05-29T09:00'")
+    parser.add_argument("-r", "--route", action="append", help="route_id to keep. Can be given more than once.")
+    parser.add_argument("-v", "--vehicle", action="append", help="vehicle_id to keep. Can be given more than once.")
+    parser.add_argument("-w", "--workers", type=int, help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument("--decoder", choices=["pb2", "wire"], default="pb2", help="Decode with gtfs_realtime_pb2 or the wire-format fast path")
+    parser.add_argument("-o", "--output", help="Save the rows to this .csv or .parquet file instead of printing them")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    t1 = perf_counter()
+    df = read_window(args.path, start=args.start, end=args.end, route_id=args.route, vehicle_id=args.vehicle, workers=args.workers, decoder=args.decoder)
+    if not args.output:
+        print(df)
+    elif args.output.endswith(".parquet"):
+        df.write_parquet(args.output)
+    else:
+        df.write_csv(args.output)
+    print(f"{Fore.YELLOW}{len(df)}{Style.RESET_ALL} rows in {perf_counter() - t1:.2f} seconds")
@@ -0,0 +1,240 @@
+"""
+Record how long each stage of a pipeline takes and what it handles, so a slow or failing night can be
+traced to a stage from the logs, without running it again.
+
+A run is started with start_run, or from_args for the command line scripts. Each stage in it is timed with
+the stage() context manager, which records:
+
+    seconds, cpu_seconds        wall and CPU time (CPU time includes child processes that have finished)
+    rows                        rows handled
+    bytes_read, bytes_written   bytes of input read (after decompression) and of output written
+    skipped, corrupt            files or members that were skipped, or couldn't be read
+    peak_rss_bytes              peak resident memory of the process so far, and of its largest finished child
+
+Code anywhere under a stage adds to these with count(), e.g. count(corrupt=1), without being passed the
+stage. Counts go to the innermost stage open in the same thread or, from a thread that hasn't opened one
+(e.g. a download's worker threads), to the stage opened last. count() does nothing outside a stage, and
+counts made in worker processes aren't seen.
+
+Each stage is appended as a line of JSON to the run's metrics file (--metrics or ${BODSMETRICS}) as it
+finishes, followed by a line for the run. When the run finishes, bods_JOB.prom is written to the Prometheus
+textfile directory (--prom or ${BODSPROM}) for node_exporter's textfile collector.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import resource
+import socket
+import sys
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter, time
+from colorama import Fore, Style
+
+COUNTERS = ("rows", "bytes_read", "bytes_written", "skipped", "corrupt")
+
+_lock = threading.Lock()
+_local = threading.local()
+_open = []
+_run = None
+
+def peak_rss_bytes(who=resource.RUSAGE_SELF) -> int:
+    """Peak resident memory of this process, or (with RUSAGE_CHILDREN) of its largest finished child."""
+    peak = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, KB everywhere else
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def cpu_seconds() -> float:
+    """CPU time of this process and its finished children."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+class Stage:
+    """The counters of a stage that is running. See stage()."""
+    def __init__(self, name:str, labels:dict):
+        self.name = name
+        self.labels = labels
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.fields = {}
+
+    def count(self, **counts):
+        """Add to the stage's counters, e.g. count(rows=100, bytes_read=4096)."""
+        with _lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+    def set(self, **fields):
+        """Record other values with the stage."""
+        self.fields.update(fields)
+
+class Run:
+    """The stages of one run of a job, and where to write them."""
+    def __init__(self, job:str, metrics_path=None, prom_dir=None):
+        """
+        :param job: The name of the job, e.g. gtfsrt_to_csv.
+        :param metrics_path: A file to append the JSON lines to. Defaults to ${BODSMETRICS}, if set.
+        :param prom_dir: A directory to write bods_JOB.prom to. Defaults to ${BODSPROM}, if set.
+        """
+        self.job = job
+        metrics_path = metrics_path or os.environ.get("BODSMETRICS")
+        prom_dir = prom_dir or os.environ.get("BODSPROM")
+        self.metrics_path = Path(metrics_path) if metrics_path else None
+        self.prom_dir = Path(prom_dir) if prom_dir else None
+        self.stages = []
+        self.started = time()
+        self.t1 = perf_counter()
+        self.c1 = cpu_seconds()
+
+    def record(self, record:dict):
+        """Append a record to the metrics file."""
+        if not self.metrics_path:
+            return
+        line = json.dumps({"job": self.job, "host": socket.gethostname(), "pid": os.getpid(), **record})
+        with _lock:
+            self.metrics_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.metrics_path, "a") as f:
+                f.write(line + "\n")
+
+    def add_stage(self, record:dict):
+        self.stages.append(record)
+        self.record({"type": "stage", **record})
+
+    def finish(self, status="ok") -> dict:
+        """Record the run as a whole and write the Prometheus textfile."""
+        summary = {
+            "type": "run",
+            "status": status,
+            "started": datetime.fromtimestamp(self.started, timezone.utc).isoformat(timespec="seconds"),
+            "seconds": round(perf_counter() - self.t1, 4),
+            "cpu_seconds": round(cpu_seconds() - self.c1, 4),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "children_peak_rss_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN),
+        }
+        # rows aren't added up, as the same rows usually pass through several stages
+        for name in COUNTERS[1:]:
+            summary[name] = sum(stage[name] for stage in self.stages)
+        self.record(summary)
+        self.write_prom(summary)
+        return summary
+
+    def write_prom(self, summary:dict):
+        """Write the run's metrics in Prometheus' text format, atomically, for node_exporter's textfile collector."""
+        if not self.prom_dir:
+            return
+        # Stages that ran more than once with the same labels (e.g. once per file) are added together
+        totals = {}
+        for stage in self.stages:
+            labels = tuple(sorted({"stage": stage["stage"], **stage["labels"]}.items()))
+            total = totals.setdefault(labels, dict.fromkeys(("seconds", "cpu_seconds") + COUNTERS, 0))
+            for name in total:
+                total[name] += stage[name]
+            total["peak_rss_bytes"] = max(total.get("peak_rss_bytes", 0), stage["peak_rss_bytes"])
+
+        lines = []
+        for name in ("seconds", "cpu_seconds") + COUNTERS + ("peak_rss_bytes",):
+            lines.append(f"# TYPE bods_stage_{name} gauge")
+            for labels, total in totals.items():
+                label_text = ",".join([f'job="{self.job}"'] + [f'{key}="{value}"' for key, value in labels])
+                lines.append(f"bods_stage_{name}{{{label_text}}} {total[name]}")
+        job = f'job="{self.job}"'
+        for name, value in (("seconds", summary["seconds"]), ("cpu_seconds", summary["cpu_seconds"]),
+                            ("peak_rss_bytes", summary["peak_rss_bytes"]), ("success", int(summary["status"] == "ok")),
+                            ("finished_timestamp_seconds", round(time(), 3))):
+            lines.append(f"# TYPE bods_run_{name} gauge")
+            lines.append(f"bods_run_{name}{{{job}}} {value}")
+
+        self.prom_dir.mkdir(parents=True, exist_ok=True)
+        path = self.prom_dir / f"bods_{self.job}.prom"
+        tmp = path.with_suffix(".tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        os.replace(tmp, path)
+
+def start_run(job:str, metrics_path=None, prom_dir=None) -> Run:
+    """Start recording the stages of a run (see Run)."""
+    global _run
+    _run = Run(job, metrics_path=metrics_path, prom_dir=prom_dir)
+    return _run
+
+def finish_run(status="ok") -> dict:
+    """Finish the current run, if there is one, and return its summary."""
+    global _run
+    run, _run = _run, None
+    return run.finish(status) if run else None
+
+def current_run() -> Run:
+    return _run
+
+@contextlib.contextmanager
+def stage(name:str, **labels):
+    """
+    Time a stage of the current run, e.g. with stage("decode", region="yorkshire") as s: ...
+    Stages can be used without a run, in which case they aren't recorded anywhere.
+    """
+    s = Stage(name, labels)
+    stack = _local.__dict__.setdefault("stack", [])
+    with _lock:
+        stack.append(s)
+        _open.append(s)
+    t1, c1 = perf_counter(), cpu_seconds()
+    try:
+        yield s
+    finally:
+        seconds, cpu = perf_counter() - t1, cpu_seconds() - c1
+        with _lock:
+            stack.remove(s)
+            _open.remove(s)
+        record = {"stage": name, "labels": labels, "seconds": round(seconds, 4), "cpu_seconds": round(cpu, 4),
+                  **s.counts, "peak_rss_bytes": peak_rss_bytes(),
+                  "children_peak_rss_bytes": peak_rss_bytes(resource.RUSAGE_CHILDREN), **s.fields}
+        if sys.exc_info()[0] is not None:
+            record["error"] = repr(sys.exc_info()[1])
+        if _run:
+            _run.add_stage(record)
+
+def count(**counts):
+    """Add to the counters of the innermost open stage (see the module docstring)."""
+    stack = getattr(_local, "stack", None)
+    s = stack[-1] if stack else _open[-1] if _open else None
+    if s is not None:
+        s.count(**counts)
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """
+    Run the block under cProfile, if given a path. The stats are saved to path, to be read with pstats or
+    e.g. snakeviz, and the 40 slowest functions by cumulative time are written to path.txt.
+    """
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        with open(f"{path}.txt", "w") as f:
+            pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(40)
+        print(f"Saved the profile to {Fore.MAGENTA}{path}{Style.RESET_ALL}")
+
+def add_arguments(parser):
+    """Add --metrics, --prom and --profile to a script's argument parser."""
+    parser.add_argument("--metrics", help="Append per-stage metrics as JSON lines to this file. Defaults to ${BODSMETRICS}.")
+    parser.add_argument("--prom", help="Write bods_JOB.prom to this Prometheus textfile collector directory. Defaults to ${BODSPROM}.")
+    parser.add_argument("--profile", help="Run under cProfile and save the stats to this file")
+
+@contextlib.contextmanager
+def from_args(job:str, args):
+    """Record a run of a command line script, and profile it, as set by the arguments from add_arguments."""
+    run = start_run(job, getattr(args, "metrics", None), getattr(args, "prom", None))
+    try:
+        with profiled(getattr(args, "profile", None)):
+            yield run
+    except BaseException:
+        finish_run("error")
+        raise
+    finish_run("ok")
@@ -0,0 +1,186 @@
+"""
+Operator performance over a range of days, in one DuckDB query over files that are already in the archive:
+each day's deduplicated parquet file (from gtfsrt_to_parquet) and the tables of each day's timetables, as
+cached by GTFSTimetable. Nothing is downloaded, unzipped or decoded again.
+
+For each day, region and agency it gives the same figures as OperatorPerformance does for one day: the
+number of trips in the timetable, and how many of them had 1-10, 11-20, 21-50 and 51-1000 distinct realtime
+reports (see COUNT_RANGES). A trip is in a day's timetable if its service runs that day by calendar
+(between start_date and end_date, on that weekday), or is added that day by calendar_dates, and isn't
+removed that day by calendar_dates.
+
+Days without a deduplicated parquet file or without timetables are left out, with a message.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pathlib import Path
+import duckdb
+import polars as pl
+from scripts.python.utils import Fore, Style
+from scripts.python.gtfs_utils import GTFSTimetable
+from scripts.python.OperatorPerformance import TIMETABLE_COLUMNS, COUNT_RANGES
+from scripts.python import metrics
+
+# The tables each day's timetable needs, with calendar_dates for the days services are added or removed
+RANGE_COLUMNS = {**TIMETABLE_COLUMNS, 'calendar_dates': ['service_id', 'date', 'exception_type']}
+WEEKDAYS = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']
+
+def get_days(start:str, end:str) -> list:
+    """The days from start to end, as 'YYYYmmdd'."""
+    day, last = datetime.strptime(start, "%Y%m%d"), datetime.strptime(end, "%Y%m%d")
+    days = []
+    while day <= last:
+        days.append(day.strftime("%Y%m%d"))
+        day += timedelta(days=1)
+    return days
+
+def day_dir(archive:Path, feed:str, day:str) -> Path:
+    return archive / feed / day[0:4] / day[4:6] / day[6:8]
+
+def get_realtime_files(archive:Path, days:list) -> dict:
+    """Each day's all_bus_locations_deduplicated_YYYYmmdd.parquet, by day, for the days that have one."""
+    files = {}
+    for day in days:
+        path = day_dir(archive, "gtfsrt", day) / f"all_bus_locations_deduplicated_{day}.parquet"
+        if path.exists():
+            files[day] = path
+        else:
+            print(f"No deduplicated parquet for {Fore.YELLOW}{day}{Style.RESET_ALL}. Run gtfsrt_to_parquet.py (or backfill.py) for it first.")
+    return files
+
+def get_timetable_files(archive:Path, regions:list, days:list, workers=8) -> dict:
+    """
+    The cached parquet file of each of the tables in RANGE_COLUMNS, for each region's timetable on each day,
+    as {table: [(day, region, path)]}. Timetables that aren't in the cache yet are read into it, in threads.
+    A timetable that is the same as one on another day has the same files.
+    """
+    zips = [(day, region, day_dir(archive, "timetables", day) / f"itm_{region}_gtfs_{day}.zip") for day in days for region in regions]
+    for day in days:
+        if not any(path.exists() for d, _, path in zips if d == day):
+            print(f"No timetables for {Fore.YELLOW}{day}{Style.RESET_ALL}")
+
+    def cache(day, region, path):
+        timetable = GTFSTimetable(str(path), columns=RANGE_COLUMNS)
+        return [(name, day, region, timetable.table_path(name)) for name in RANGE_COLUMNS if name in timetable.dfs]
+
+    files = {name: [] for name in RANGE_COLUMNS}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for tables in ex.map(lambda z: cache(*z), [z for z in zips if z[2].exists()]):
+            for name, day, region, path in tables:
+                files[name].append((day, region, str(path)))
+    return files
+
+def sql_list(paths) -> str:
+    """A list of paths as a DuckDB list literal."""
+    return "[" + ", ".join("'" + str(path).replace("'", "''") + "'" for path in paths) + "]"
+
+def register_tables(con, timetable_files:dict, realtime_files:dict):
+    """
+    Make a view of each timetable table over its cached files, with the day and region of each row. Files
+    are only read once, however many days they are for. A table that no timetable has (e.g. calendar_dates)
+    is an empty view.
+    """
+    for name, columns in RANGE_COLUMNS.items():
+        entries = timetable_files[name]
+        if not entries:
+            con.execute(f"CREATE OR REPLACE TEMP VIEW {name} AS SELECT NULL::INTEGER AS day, NULL::VARCHAR AS region, " +
+                        ", ".join(f"NULL::{'INTEGER' if column in ('date', 'exception_type') else 'VARCHAR'} AS {column}" for column in columns) + " WHERE false")
+            continue
+        sources = pl.DataFrame({"day": [int(day) for day, _, _ in entries], "region": [region for _, region, _ in entries],
+                                "filename": [path for _, _, path in entries]})
+        con.register(f"{name}_sources", sources)
+        files = sorted(set(sources["filename"]))
+        con.execute(f"""
+            CREATE OR REPLACE TEMP VIEW {name} AS
+            SELECT s.day, s.region, {', '.join(f't.{column}' for column in columns)}
+            FROM read_parquet({sql_list(files)}, filename = true, union_by_name = true) t
+            JOIN {name}_sources s USING (filename)
+        """)
+
+    sources = pl.DataFrame({"day": [int(day) for day in realtime_files], "filename": [str(path) for path in realtime_files.values()]})
+    con.register("realtime_sources", sources)
+    con.execute(f"""
+        CREATE OR REPLACE TEMP VIEW realtime AS
+        SELECT s.day, t.trip_id::VARCHAR AS trip_id, t.lat, t.lon, t."timestamp"
+        FROM read_parquet({sql_list(sorted(sources['filename']))}, filename = true) t
+        JOIN realtime_sources s USING (filename)
+    """)
+
+def get_query() -> str:
+    """The query for the performance of each agency on each day (see the module docstring)."""
+    weekday = "CASE dayofweek(strptime(c.day::VARCHAR, '%Y%m%d')) " + " ".join(f"WHEN {i} THEN c.{name}" for i, name in enumerate(WEEKDAYS)) + " END"
+    bins, lower = [], 0
+    for upper, label in COUNT_RANGES:
+        bins.append(f'COUNT(*) FILTER (WHERE count > {lower} AND count <= {upper}) AS "{label}"')
+        lower = upper
+    return f"""
+        WITH active AS (
+            SELECT c.day, c.region, c.service_id FROM calendar c
+            WHERE c.start_date <= c.day AND c.end_date >= c.day AND {weekday} = 1
+            UNION
+            SELECT day, region, service_id FROM calendar_dates WHERE date = day AND exception_type = 1
+            EXCEPT
+            SELECT day, region, service_id FROM calendar_dates WHERE date = day AND exception_type = 2
+        ),
+        timetable AS (
+            SELECT t.day, t.region, a.agency_name, a.agency_id, t.trip_id
+            FROM trips t
+            JOIN active s ON s.day = t.day AND s.region = t.region AND s.service_id = t.service_id
+            JOIN routes r ON r.day = t.day AND r.region = t.region AND r.route_id = t.route_id
+            JOIN agency a ON a.day = r.day AND a.region = r.region AND a.agency_id = r.agency_id
+        ),
+        timetable_counts AS (
+            SELECT day, region, agency_name, agency_id, COUNT(*) AS timetable FROM timetable GROUP BY ALL
+        ),
+        -- The number of distinct reports (same bus, location and time) of each trip on each day
+        trip_counts AS (
+            SELECT day, trip_id, COUNT(*) AS count
+            FROM (SELECT DISTINCT day, trip_id, lat, lon, "timestamp" FROM realtime)
+            GROUP BY ALL
+        ),
+        real_counts AS (
+            SELECT t.day, t.region, t.agency_id, t.trip_id, SUM(c.count) AS count
+            FROM timetable t JOIN trip_counts c ON c.day = t.day AND c.trip_id = t.trip_id
+            GROUP BY ALL
+        ),
+        binned AS (
+            SELECT day, region, agency_id, {', '.join(bins)}
+            FROM real_counts WHERE count <= {COUNT_RANGES[-1][0]}
+            GROUP BY ALL
+        )
+        SELECT t.day::VARCHAR AS date, t.region, t.agency_name, t.agency_id, t.timetable,
+               {', '.join(f'b."{label}"' for _, label in COUNT_RANGES)}
+        FROM timetable_counts t JOIN binned b ON b.day = t.day AND b.region = t.region AND b.agency_id = t.agency_id
+        ORDER BY date, t.region, t.agency_name, t.agency_id
+    """
+
+def performance_for_range(archive:Path, regions:list, start:str, end:str, threads=None) -> pl.DataFrame:
+    """
+    The performance of each agency in each region on each day from start to end (see the module docstring).
+
+    :param archive: The archive (${BODSARCHIVE}).
+    :param regions: The regions to include.
+    :param start: The first day, as 'YYYYmmdd'.
+    :param end: The last day, as 'YYYYmmdd'.
+    :param threads: Threads for DuckDB to use. Defaults to all of them.
+    :return: A row for each day, region and agency, with the columns of OperatorPerformance's CSVs after
+        date and region.
+    """
+    days = get_days(start, end)
+    with metrics.stage("timetables") as stage:
+        timetable_files = get_timetable_files(archive, regions, days)
+        stage.count(rows=len({(day, region) for day, region, _ in timetable_files["trips"]}))
+    realtime_files = get_realtime_files(archive, days)
+    labels = [label for _, label in COUNT_RANGES]
+    if not realtime_files or not timetable_files["trips"]:
+        return pl.DataFrame(schema={"date": pl.String, "region": pl.String, "agency_name": pl.String, "agency_id": pl.String,
+                                    "timetable": pl.Int64, **{label: pl.Int64 for label in labels}})
+
+    with metrics.stage("query") as stage, duckdb.connect() as con:
+        if threads:
+            con.execute(f"SET threads = {int(threads)}")
+        register_tables(con, timetable_files, realtime_files)
+        result = con.execute(get_query()).pl()
+        stage.count(rows=len(result), bytes_read=sum(path.stat().st_size for path in realtime_files.values()))
+    print(f"Found the performance of {Fore.YELLOW}{result['agency_id'].n_unique() if len(result) else 0}{Style.RESET_ALL} agencies on {Fore.YELLOW}{result['date'].n_unique() if len(result) else 0}{Style.RESET_ALL} days")
+    return result
@@ -0,0 +1,126 @@
+"""
+Compact column types for vehicle positions, shared by the realtime converters.
+
+The decoders (gtfs_realtime_pb2, gtfsrt_wire and sirivm) produce plain columns: Python strings, float64s and
+int64s. Most of those values repeat millions of times a day, so compact() converts them to:
+
+    trip_id, route_id, vehicle_id   dictionary-encoded strings (polars Categorical, pandas category)
+    start_date                      date32, from YYYYmmdd
+    start_time                      int32 seconds after midnight, from HH:MM:SS (may be past 24:00:00)
+    lat, lon, bearing               float32. Coordinates are rounded to 5 dp first, and float32 keeps 5 dp
+                                    for anything under 128 degrees, which is every latitude and UK longitude.
+    timestamp                       uint32 epoch seconds
+    schedule_relationship, status   int8
+    stop_sequence                   uint32
+
+Empty start_date and start_time strings (what gtfs_realtime_pb2 gives for missing fields) become nulls, as
+do malformed ones, so one bad value from a feed doesn't stop a day's conversion.
+expand() turns the dates and times back into the GTFS strings for outputs that need them, e.g. the CSV.
+"""
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# The dictionary type polars uses for Categorical columns, so tables keep the same schema after a trip
+# through polars.
+DICTIONARY = pa.dictionary(pa.uint32(), pa.large_string())
+
+# The columns produced by the decoders, in the same order as GTFSRT2Parquet.get_schema.
+PLAIN_SCHEMA = pa.schema([
+    ("entity_id", pa.string()),
+    ("trip_id", pa.string()),
+    ("route_id", pa.string()),
+    ("start_date", pa.string()),
+    ("start_time", pa.string()),
+    ("lat", pa.float64()),
+    ("lon", pa.float64()),
+    ("bearing", pa.float64()),
+    ("timestamp", pa.int64()),
+    ("vehicle_id", pa.string()),
+])
+
+# The compact type of each vehicle position column, including the extra columns the CSV is made from
+# (see gtfs_realtime_utils.VEHICLE_POSITION_FIELDS).
+COMPACT_TYPES = {
+    "entity_id": pa.large_string(),
+    "trip_id": DICTIONARY,
+    "route_id": DICTIONARY,
+    "vehicle_id": DICTIONARY,
+    "start_date": pa.date32(),
+    "start_time": pa.int32(),
+    "lat": pa.float32(),
+    "lon": pa.float32(),
+    "latitude": pa.float32(),
+    "longitude": pa.float32(),
+    "bearing": pa.float32(),
+    "timestamp": pa.uint32(),
+    "schedule_relationship": pa.int8(),
+    "status": pa.int8(),
+    "stop_sequence": pa.uint32(),
+}
+
+# The columns in PLAIN_SCHEMA with their compact types, as written by the parquet converters.
+ARROW_SCHEMA = pa.schema([(field.name, COMPACT_TYPES[field.name]) for field in PLAIN_SCHEMA])
+
+def compact_schema(schema:pa.Schema) -> pa.Schema:
+    """The schema of a table of plain columns after compact()."""
+    return pa.schema([(field.name, COMPACT_TYPES.get(field.name, field.type)) for field in schema])
+
+# HH:MM:SS, where the hours can be past 24 but not so many that the seconds overflow an int32
+START_TIME_PATTERN = r"^\d{1,5}:\d\d:\d\d$"
+
+def parse_start_date(column) -> pa.Array:
+    """YYYYmmdd strings as date32s, with nulls for blank or malformed dates."""
+    if pa.types.is_date(column.type):
+        return column
+    times = pc.strptime(column, format="%Y%m%d", unit="s", error_is_null=True)
+    return pc.cast(times, pa.date32())
+
+def parse_start_time(column) -> pa.Array:
+    """HH:MM:SS strings as int32 seconds after midnight, with nulls for blank or malformed times."""
+    if pa.types.is_integer(column.type):
+        return pc.cast(column, pa.int32())
+    valid = pc.match_substring_regex(column, START_TIME_PATTERN)
+    parts = pc.split_pattern(pc.if_else(valid, column, pa.scalar(None, column.type)), ":")
+    seconds = [pc.cast(pc.list_element(parts, i), pa.int32()) for i in range(3)]
+    return pc.add(pc.add(pc.multiply(seconds[0], 3600), pc.multiply(seconds[1], 60)), seconds[2])
+
+def format_start_date(column) -> pa.Array:
+    """date32s as YYYYmmdd strings, with nulls as empty strings."""
+    return pc.fill_null(pc.strftime(column, format="%Y%m%d"), "")
+
+def format_start_time(column) -> pa.Array:
+    """Seconds after midnight as HH:MM:SS strings, with nulls as empty strings."""
+    # integer division truncates, and the times are never negative
+    hours = pc.divide(column, 3600)
+    minutes = pc.divide(pc.subtract(column, pc.multiply(hours, 3600)), 60)
+    seconds = pc.subtract(column, pc.multiply(pc.divide(column, 60), 60))
+    padded = [pc.utf8_lpad(pc.cast(part, pa.string()), 2, "0") for part in (hours, minutes, seconds)]
+    return pc.fill_null(pc.binary_join_element_wise(*padded, ":"), "")
+
+def compact(table:pa.Table) -> pa.Table:
+    """
+    Convert the vehicle position columns of a table (or record batch) to their compact types. Columns that
+    are already compact, or that aren't vehicle position columns, are left as they are.
+    """
+    arrays = []
+    for name, column in zip(table.column_names, table.columns):
+        target = COMPACT_TYPES.get(name)
+        if target is None or column.type == target:
+            arrays.append(column)
+        elif name == "start_date":
+            arrays.append(parse_start_date(column))
+        elif name == "start_time":
+            arrays.append(parse_start_time(column))
+        elif pa.types.is_dictionary(target):
+            arrays.append(pc.cast(pc.dictionary_encode(column), target))
+        else:
+            arrays.append(pc.cast(column, target))
+    cls = pa.RecordBatch if isinstance(table, pa.RecordBatch) else pa.Table
+    return cls.from_arrays(arrays, schema=compact_schema(table.schema))
+
+def expand(table:pa.Table) -> pa.Table:
+    """Turn start_date and start_time back into GTFS strings (YYYYmmdd and HH:MM:SS)."""
+    for name, format in (("start_date", format_start_date), ("start_time", format_start_time)):
+        if name in table.column_names and not pa.types.is_string(table.schema.field(name).type):
+            table = table.set_column(table.schema.get_field_index(name), name, format(table[name]))
+    return table
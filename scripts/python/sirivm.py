@@ -0,0 +1,168 @@
+"""
+Decode SIRI-VM snapshots (the sirivm-*.zip files, each holding a siri.xml) into the same columns as the
+gtfsrt converters, so both feeds can go through the same CSV and parquet pipelines.
+
+The XML is read with an incremental iterparse. Only the elements that are kept are looked at, and each
+VehicleActivity is cleared as soon as its values have been taken, so the tree is never built. The values
+are collected as strings and converted a column at a time with polars afterwards, rather than per vehicle.
+
+Each VehicleActivity becomes one row:
+
+    entity_id       ItemIdentifier
+    trip_id         FramedVehicleJourneyRef/DatedVehicleJourneyRef
+    route_id        LineRef
+    start_date      FramedVehicleJourneyRef/DataFrameRef, as YYYYmmdd
+    start_time      OriginAimedDepartureTime, as HH:MM:SS in UK time
+    lat, lon        VehicleLocation/Latitude, VehicleLocation/Longitude
+    bearing         Bearing
+    timestamp       RecordedAtTime, as epoch seconds
+    vehicle_id      VehicleRef
+
+trip_id and route_id are SIRI's own references, not the ids in the GTFS timetables. The columns have the
+compact types in realtime_schema. Missing values get the same values gtfs_realtime_pb2 gives missing fields
+after realtime_schema.compact (empty strings, 0, and null dates and times).
+"""
+import argparse
+import io
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+import xml.etree.ElementTree as ET
+import polars as pl
+import pyarrow as pa
+from colorama import Fore, Style
+try:
+    from scripts.python.gtfs_realtime_utils import iter_gtfsrt_binaries, VEHICLE_POSITION_FIELDS
+    from scripts.python.realtime_schema import ARROW_SCHEMA, COMPACT_TYPES
+    from scripts.python import metrics
+except ModuleNotFoundError:
+    from gtfs_realtime_utils import iter_gtfsrt_binaries, VEHICLE_POSITION_FIELDS
+    from realtime_schema import ARROW_SCHEMA, COMPACT_TYPES
+    import metrics
+
+NAMESPACE = "{http://www.siri.org.uk/siri}"
+BIN_FILE = "siri.xml"
+
+# The element each column is read from. None of these names are used anywhere else in a VehicleActivity.
+ELEMENTS = {
+    "entity_id": "ItemIdentifier",
+    "trip_id": "DatedVehicleJourneyRef",
+    "route_id": "LineRef",
+    "start_date": "DataFrameRef",
+    "start_time": "OriginAimedDepartureTime",
+    "lat": "Latitude",
+    "lon": "Longitude",
+    "bearing": "Bearing",
+    "timestamp": "RecordedAtTime",
+    "vehicle_id": "VehicleRef",
+}
+_TAGS = {NAMESPACE + element: i for i, element in enumerate(ELEMENTS[name] for name in ARROW_SCHEMA.names)}
+_VEHICLE_ACTIVITY = NAMESPACE + "VehicleActivity"
+
+def parse_siri(source, round=5) -> pa.Table:
+    """
+    Read the vehicle positions in a SIRI-VM document.
+
+    :param source: The XML, as bytes or an open file.
+    :param round: The number of dp to round coordinates to.
+    :return: A pyarrow.Table with the columns in realtime_schema.ARROW_SCHEMA.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    values = [[] for _ in ARROW_SCHEMA]
+    row = [None] * len(ARROW_SCHEMA)
+    for _, elem in ET.iterparse(source, events=("end",)):
+        i = _TAGS.get(elem.tag)
+        if i is not None:
+            row[i] = elem.text
+        elif elem.tag == _VEHICLE_ACTIVITY:
+            for column, value in zip(values, row):
+                column.append(value)
+            row = [None] * len(ARROW_SCHEMA)
+            elem.clear()
+
+    df = pl.DataFrame(dict(zip(ARROW_SCHEMA.names, values)), schema={name: pl.String for name in ARROW_SCHEMA.names})
+    departure = pl.col("start_time").str.to_datetime(time_zone="UTC", strict=False).dt.convert_time_zone("Europe/London")
+    df = df.select(
+        pl.col("entity_id").fill_null(""),
+        pl.col("trip_id").fill_null("").cast(pl.Categorical),
+        pl.col("route_id").fill_null("").cast(pl.Categorical),
+        pl.col("start_date").str.to_date("%Y-%m-%d", strict=False),
+        (departure.dt.hour().cast(pl.Int32) * 3600 + departure.dt.minute().cast(pl.Int32) * 60 + departure.dt.second().cast(pl.Int32)).alias("start_time"),
+        pl.col("lat").cast(pl.Float64, strict=False).round(round).cast(pl.Float32),
+        pl.col("lon").cast(pl.Float64, strict=False).round(round).cast(pl.Float32),
+        pl.col("bearing").cast(pl.Float32, strict=False).fill_null(0),
+        pl.col("timestamp").str.to_datetime(time_zone="UTC", strict=False).dt.epoch("s").fill_null(0).cast(pl.UInt32),
+        pl.col("vehicle_id").fill_null("").cast(pl.Categorical),
+    )
+    return df.to_arrow().cast(ARROW_SCHEMA)
+
+def parse_siri_payloads(payloads, round=5) -> pa.Table:
+    """Read a list of SIRI-VM documents into one table (see parse_siri)."""
+    tables = [parse_siri(data, round=round) for data in payloads]
+    return pa.concat_tables(tables) if tables else ARROW_SCHEMA.empty_table()
+
+def to_vehicle_position_fields(table:pa.Table) -> pa.Table:
+    """
+    Rename and add columns so a table from parse_siri has the columns the gtfsrt CSV is made from
+    (gtfs_realtime_utils.VEHICLE_POSITION_FIELDS). The fields SIRI-VM doesn't have are left null.
+    """
+    table = table.rename_columns(["latitude" if name == "lat" else "longitude" if name == "lon" else name for name in table.column_names])
+    arrays = []
+    for name in VEHICLE_POSITION_FIELDS:
+        arrays.append(table[name] if name in table.column_names else pa.nulls(table.num_rows, COMPACT_TYPES[name]))
+    return pa.Table.from_arrays(arrays, names=list(VEHICLE_POSITION_FIELDS))
+
+def iter_sirivm_batches(source, workers=None, tasks_per_worker=2, round=5):
+    """
+    Yield the vehicle positions in a SIRI-VM source as Arrow record batches, one or more per snapshot and in
+    snapshot order, with the columns of gtfs_realtime_utils.iter_gtfsrt_batches. Snapshots are parsed in a
+    pool of processes, with at most workers * tasks_per_worker waiting, which bounds memory.
+
+    :param source: Anything accepted by gtfs_realtime_utils.iter_gtfsrt_binaries, e.g. a day's directory of
+        sirivm-*.zip snapshots or a day zip.
+    :param workers: The number of worker processes. Defaults to the number of CPUs.
+    :param tasks_per_worker: The number of snapshots queued per worker.
+    :param round: The number of dp to round coordinates to.
+    """
+    workers = workers or os.cpu_count()
+    pending = deque()
+
+    def finished():
+        table = pending.popleft().result()
+        metrics.count(rows=table.num_rows)
+        return to_vehicle_position_fields(table).to_batches()
+
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        for _, data in iter_gtfsrt_binaries(source, bin_file=BIN_FILE):
+            if len(pending) >= workers * tasks_per_worker:
+                yield from finished()
+            pending.append(ex.submit(parse_siri, data, round))
+        while pending:
+            yield from finished()
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Decode a SIRI-VM snapshot or day of snapshots.")
+    parser.add_argument("path", help="Path to a siri.xml, a sirivm-*.zip snapshot, a day's directory of them or a day zip")
+    parser.add_argument("-w", "--workers", type=int, help="Number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument("-o", "--output", help="Save the rows to this .csv or .parquet file instead of printing them")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    t1 = perf_counter()
+    if args.path.endswith(".xml"):
+        with open(args.path, "rb") as f:
+            df = pl.from_arrow(parse_siri(f))
+    else:
+        df = pl.from_arrow(pa.Table.from_batches(iter_sirivm_batches(args.path, workers=args.workers)))
+    if not args.output:
+        print(df)
+    elif args.output.endswith(".parquet"):
+        df.write_parquet(args.output)
+    else:
+        df.write_csv(args.output)
+    print(f"{Fore.YELLOW}{len(df)}{Style.RESET_ALL} rows in {perf_counter() - t1:.2f} seconds")
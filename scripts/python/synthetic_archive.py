@@ -0,0 +1,297 @@
+"""
+Write synthetic archives, laid out like ${BODSARCHIVE} and the bulk downloads, so the pipelines can be run
+and timed offline at any scale (see benchmark.py).
+
+For each day, under root::
+
+    gtfsrt/YYYY/MM/DD/gtfsrt-YYYYmmddTHHMMSS.zip        one per snapshot, each holding a gtfsrt.bin
+    gtfsrt/YYYY/MM/DD/gtfsrt-YYYYmmdd.zip               the day zip of the snapshot zips
+    timetables/YYYY/MM/DD/itm_REGION_gtfs_YYYYmmdd.zip  one per region
+    bulk/gtfsrt-YYYYmmdd.zip, bulk/timetables-YYYYmmdd.zip   as BulkDownloader saves them
+    manifest-YYYYmmdd.json                              the settings and the number of rows written
+
+Each vehicle runs one route of one agency in one region, and works through that route's trips all day.
+In each snapshot a vehicle has sent a new report with probability 1 - duplicate_rate. Otherwise its last
+report is repeated unchanged, as buses that haven't reported again stay in every snapshot of the live feed.
+Every trip the vehicles run is in the timetable, along with some that never run (extra_trip_rate) on
+services that do and don't run that day, so the timetable and realtime counts differ as they do for real.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import perf_counter
+from zipfile import ZipFile, ZIP_DEFLATED, ZIP_STORED
+from google.transit import gtfs_realtime_pb2
+from colorama import Fore, Style
+
+REGIONS = ['north_east', 'north_west', 'yorkshire', 'east_anglia', 'east_midlands', 'west_midlands', 'south_east', 'south_west']
+
+# Roughly the middle of each region, as (lat, lon)
+CENTRES = {
+    'north_east': (54.97, -1.61), 'north_west': (53.48, -2.24), 'yorkshire': (53.80, -1.55),
+    'east_anglia': (52.63, 1.30), 'east_midlands': (52.95, -1.15), 'west_midlands': (52.49, -1.89),
+    'south_east': (51.27, 0.52), 'south_west': (50.72, -3.53),
+}
+
+# The services the timetables use. DAILY runs every day, NOTTODAY every day but the day's weekday, and
+# EXTRA only on the day, through calendar_dates.
+SERVICES = ['DAILY', 'NOTTODAY', 'EXTRA']
+
+def _varint(n:int) -> bytes:
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+def _field(tag:int, payload:bytes) -> bytes:
+    """A length-delimited protobuf field, for a tag that fits in one byte."""
+    return bytes([tag]) + _varint(len(payload)) + payload
+
+def _hms(seconds:int) -> str:
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+class SyntheticArchive:
+    """
+    A synthetic network of vehicles, routes and timetables, which can write a day's archive at a time.
+    The same settings and seed always write the same archive.
+    """
+    def __init__(self, vehicles=1000, snapshots=120, interval=30, duplicate_rate=0.6, regions=REGIONS,
+                 agencies_per_region=3, routes_per_agency=4, trip_minutes=60, stops_per_trip=10,
+                 extra_trip_rate=0.1, start="00:00:00", seed=0):
+        """
+        :param vehicles: The number of vehicles in each snapshot, shared between the regions.
+        :param snapshots: The number of snapshots in a day.
+        :param interval: Seconds between snapshots.
+        :param duplicate_rate: The chance a vehicle's report is repeated unchanged in the next snapshot.
+        :param regions: The timetable regions.
+        :param agencies_per_region: Agencies in each region.
+        :param routes_per_agency: Routes run by each agency.
+        :param trip_minutes: How long each trip takes.
+        :param stops_per_trip: The number of stop_times of each trip.
+        :param extra_trip_rate: Trips in the timetable that no vehicle runs, as a fraction of those that are run.
+        :param start: UTC time of the first snapshot, as HH:MM:SS.
+        :param seed: Seed for the random reports.
+        """
+        self.vehicles = vehicles
+        self.snapshots = snapshots
+        self.interval = interval
+        self.duplicate_rate = duplicate_rate
+        self.regions = list(regions)
+        self.agencies_per_region = agencies_per_region
+        self.routes_per_agency = routes_per_agency
+        self.trip_seconds = trip_minutes * 60
+        self.stops_per_trip = stops_per_trip
+        self.extra_trip_rate = extra_trip_rate
+        hours, minutes, seconds = (int(part) for part in start.split(":"))
+        self.start = hours * 3600 + minutes * 60 + seconds
+        self.seed = seed
+
+    def get_settings(self) -> dict:
+        return {"vehicles": self.vehicles, "snapshots": self.snapshots, "interval": self.interval,
+                "duplicate_rate": self.duplicate_rate, "regions": self.regions,
+                "agencies_per_region": self.agencies_per_region, "routes_per_agency": self.routes_per_agency,
+                "trip_minutes": self.trip_seconds // 60, "stops_per_trip": self.stops_per_trip,
+                "extra_trip_rate": self.extra_trip_rate, "start": _hms(self.start), "seed": self.seed}
+
+    def get_route(self, v:int) -> tuple:
+        """The (region index, agency index, route index) vehicle v runs."""
+        region = v % len(self.regions)
+        route = v // len(self.regions) % (self.agencies_per_region * self.routes_per_agency)
+        return region, route // self.routes_per_agency, route
+
+    def route_id(self, region:int, route:int) -> str:
+        return f"R{region}{route:03d}"
+
+    def agency_id(self, region:int, agency:int) -> str:
+        return f"OP{region}{agency:02d}"
+
+    def phase(self, v:int) -> int:
+        """When vehicle v's first trip of the day starts, in seconds after midnight."""
+        return v * 97 % self.trip_seconds
+
+    def trip_id(self, v:int, k:int) -> str:
+        return f"VJ{v}_{k}"
+
+    def report(self, v:int, timestamp:int, midnight:int, date:str, snapshot:int) -> bytes:
+        """A serialized FeedEntity for vehicle v reporting at timestamp (epoch seconds)."""
+        region, _, route = self.get_route(v)
+        since_first = timestamp - midnight - self.phase(v)
+        entity = gtfs_realtime_pb2.FeedEntity()
+        entity.id = f"{snapshot}-{v}"
+        vehicle = entity.vehicle
+        centre_lat, centre_lon = CENTRES.get(self.regions[region], (53.0, -1.5))
+        lat, lon = centre_lat + (v % 97 - 48) * 0.002, centre_lon + (v % 89 - 44) * 0.003
+        if since_first >= 0:
+            k, progress = divmod(since_first, self.trip_seconds)
+            vehicle.trip.trip_id = self.trip_id(v, k)
+            vehicle.trip.route_id = self.route_id(region, route)
+            vehicle.trip.start_date = date
+            vehicle.trip.start_time = _hms(self.phase(v) + k * self.trip_seconds)
+            # out along the route on even trips and back on odd ones
+            fraction = progress / self.trip_seconds
+            fraction = 1 - fraction if k % 2 else fraction
+            lat, lon = lat + 0.05 * fraction, lon + 0.08 * fraction
+            vehicle.current_stop_sequence = 1 + int(fraction * (self.stops_per_trip - 1))
+        vehicle.position.latitude = lat
+        vehicle.position.longitude = lon
+        vehicle.position.bearing = float(v * 7 % 360)
+        vehicle.timestamp = timestamp
+        vehicle.vehicle.id = f"V{v:05d}"
+        return _field(0x12, entity.SerializeToString())
+
+    def write_gtfsrt(self, root:Path, date:str, individual=True) -> dict:
+        """
+        Write a day's snapshots and its day zip.
+
+        :param individual: Also write each snapshot zip on its own, as the collector does.
+        :return: The day zip's path and the number of reports written.
+        """
+        rng = random.Random(f"{self.seed}-{date}")
+        day = datetime.strptime(date, "%Y%m%d").replace(tzinfo=timezone.utc)
+        midnight = int(day.timestamp())
+        day_dir = root / "gtfsrt" / day.strftime("%Y/%m/%d")
+        day_dir.mkdir(parents=True, exist_ok=True)
+        day_zip = day_dir / f"gtfsrt-{date}.zip"
+
+        last = [None] * self.vehicles
+        reports = distinct = 0
+        with ZipFile(day_zip, "w", compression=ZIP_STORED) as zf:
+            for s in range(self.snapshots):
+                now = midnight + self.start + s * self.interval
+                for v in range(self.vehicles):
+                    if last[v] is None or rng.random() >= self.duplicate_rate:
+                        last[v] = self.report(v, now - rng.randrange(self.interval), midnight, date, s)
+                        distinct += 1
+                header = gtfs_realtime_pb2.FeedHeader(gtfs_realtime_version="2.0", timestamp=now)
+                feed = _field(0x0a, header.SerializeToString()) + b"".join(last)
+                reports += self.vehicles
+
+                name = f"gtfsrt-{datetime.fromtimestamp(now, timezone.utc).strftime('%Y%m%dT%H%M%S')}.zip"
+                snapshot = io.BytesIO()
+                with ZipFile(snapshot, "w", compression=ZIP_DEFLATED) as inner:
+                    inner.writestr("gtfsrt.bin", feed)
+                zf.writestr(name, snapshot.getvalue())
+                if individual:
+                    (day_dir / name).write_bytes(snapshot.getvalue())
+        return {"path": str(day_zip), "reports": reports, "distinct_reports": distinct}
+
+    def timetable_files(self, region:int, date:str) -> dict:
+        """The text files of a region's GTFS timetable, by name."""
+        day = datetime.strptime(date, "%Y%m%d")
+        weekday = day.weekday()
+        first, last = (day - timedelta(days=90)).strftime("%Y%m%d"), (day + timedelta(days=90)).strftime("%Y%m%d")
+        rng = random.Random(f"{self.seed}-{region}")
+
+        agencies = [self.agency_id(region, a) for a in range(self.agencies_per_region)]
+        routes = {self.route_id(region, r): agencies[r // self.routes_per_agency]
+                  for r in range(self.agencies_per_region * self.routes_per_agency)}
+        # (trip_id, route_id, service_id, start in seconds after midnight)
+        trips = []
+        for v in range(region, self.vehicles, len(self.regions)):
+            _, _, route = self.get_route(v)
+            for k in range(-(-86400 // self.trip_seconds)):
+                trips.append((self.trip_id(v, k), self.route_id(region, route), "DAILY", self.phase(v) + k * self.trip_seconds))
+        for i in range(round(len(trips) * self.extra_trip_rate)):
+            route_id = rng.choice(list(routes))
+            trips.append((f"X{region}_{i}", route_id, SERVICES[i % len(SERVICES)], rng.randrange(5 * 3600, 23 * 3600)))
+
+        files = {}
+        files["agency.txt"] = "agency_id,agency_name,agency_url,agency_timezone,agency_noc\n" + "".join(
+            f"{a},Operator {a},https://example.com/{a},Europe/London,{a}\n" for a in agencies)
+        files["routes.txt"] = "route_id,agency_id,route_short_name,route_long_name,route_type\n" + "".join(
+            f"{route_id},{agency_id},{route_id[2:].lstrip('0') or '0'},,3\n" for route_id, agency_id in routes.items())
+        files["calendar.txt"] = "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n" + \
+            f"DAILY,1,1,1,1,1,1,1,{first},{last}\n" + \
+            "NOTTODAY," + ",".join("0" if i == weekday else "1" for i in range(7)) + f",{first},{last}\n"
+        files["calendar_dates.txt"] = f"service_id,date,exception_type\nEXTRA,{date},1\n"
+        files["trips.txt"] = "route_id,service_id,trip_id,direction_id\n" + "".join(
+            f"{route_id},{service_id},{trip_id},{i % 2}\n" for i, (trip_id, route_id, service_id, _) in enumerate(trips))
+        stops = {route_id: [f"ST{route_id}{n:02d}" for n in range(self.stops_per_trip)] for route_id in routes}
+        files["stops.txt"] = "stop_id,stop_name,stop_lat,stop_lon\n" + "".join(
+            f"{stop_id},Stop {stop_id},{CENTRES.get(self.regions[region], (53.0, -1.5))[0] + n * 0.005:.5f},{CENTRES.get(self.regions[region], (53.0, -1.5))[1] + n * 0.008:.5f}\n"
+            for route_stops in stops.values() for n, stop_id in enumerate(route_stops))
+        step = self.trip_seconds // max(self.stops_per_trip - 1, 1)
+        files["stop_times.txt"] = "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n" + "".join(
+            f"{trip_id},{_hms(start + n * step)},{_hms(start + n * step)},{stop_id},{n + 1}\n"
+            for trip_id, route_id, _, start in trips for n, stop_id in enumerate(stops[route_id]))
+        return files
+
+    def write_timetables(self, root:Path, date:str) -> dict:
+        """Write each region's timetable zip for a day, and the bulk timetables zip of them all."""
+        day_dir = root / "timetables" / date[0:4] / date[4:6] / date[6:8]
+        day_dir.mkdir(parents=True, exist_ok=True)
+        bulk = root / "bulk" / f"timetables-{date}.zip"
+        bulk.parent.mkdir(parents=True, exist_ok=True)
+        trips = 0
+        with ZipFile(bulk, "w", compression=ZIP_STORED) as bulk_zip:
+            for region, name in enumerate(self.regions):
+                path = day_dir / f"itm_{name}_gtfs_{date}.zip"
+                with ZipFile(path, "w", compression=ZIP_DEFLATED) as zf:
+                    for file_name, text in self.timetable_files(region, date).items():
+                        zf.writestr(file_name, text)
+                        if file_name == "trips.txt":
+                            trips += text.count("\n") - 1
+                bulk_zip.write(path, arcname=f"timetables/{date[0:4]}/{date[4:6]}/{date[6:8]}/{path.name}")
+        return {"path": str(bulk), "trips": trips}
+
+    def write(self, root, date:str, individual=True) -> dict:
+        """
+        Write a day's archive (see the module docstring).
+
+        :param root: The directory to write it in, which is then used as BODSARCHIVE.
+        :param date: The day, as 'YYYYmmdd'.
+        :param individual: Also write each snapshot zip on its own, not just the day zip.
+        :return: The manifest, which is also saved as manifest-YYYYmmdd.json.
+        """
+        root = Path(root)
+        t1 = perf_counter()
+        gtfsrt = self.write_gtfsrt(root, date, individual=individual)
+        timetables = self.write_timetables(root, date)
+        bulk = root / "bulk" / f"gtfsrt-{date}.zip"
+        bulk.unlink(missing_ok=True)
+        try:
+            os.link(gtfsrt["path"], bulk)
+        except OSError:
+            shutil.copyfile(gtfsrt["path"], bulk)
+
+        manifest = {"date": date, "settings": self.get_settings(), "reports": gtfsrt["reports"],
+                    "distinct_reports": gtfsrt["distinct_reports"], "timetable_trips": timetables["trips"],
+                    "gtfsrt_bytes": os.path.getsize(gtfsrt["path"]), "timetable_bytes": os.path.getsize(timetables["path"])}
+        (root / f"manifest-{date}.json").write_text(json.dumps(manifest, indent=1))
+        print(f"Wrote {Fore.YELLOW}{manifest['reports']}{Style.RESET_ALL} reports and {Fore.YELLOW}{manifest['timetable_trips']}{Style.RESET_ALL} timetabled trips for {date} to {Fore.MAGENTA}{root}{Style.RESET_ALL} in {perf_counter() - t1:.1f} seconds")
+        return manifest
+
+def get_manifest(root, date:str) -> dict:
+    """The manifest of a day written by SyntheticArchive.write, or {} if there isn't one."""
+    path = Path(root) / f"manifest-{date}.json"
+    return json.loads(path.read_text()) if path.exists() else {}
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Write a synthetic gtfsrt and timetable archive for benchmarking.")
+    parser.add_argument("root", help="Directory to write the archive in")
+    parser.add_argument("-d", "--date", default="20250529", help="First date, string format 'YYYYmmdd'. Defaults to 20250529.")
+    parser.add_argument("-n", "--days", type=int, default=1, help="Number of consecutive days to write. Defaults to 1.")
+    parser.add_argument("-v", "--vehicles", type=int, default=1000, help="Vehicles in each snapshot. Defaults to 1000.")
+    parser.add_argument("-s", "--snapshots", type=int, default=120, help="Snapshots a day. Defaults to 120 (an hour). A full day is 2880.")
+    parser.add_argument("-i", "--interval", type=int, default=30, help="Seconds between snapshots. Defaults to 30.")
+    parser.add_argument("--duplicate-rate", type=float, default=0.6, help="Chance a vehicle's report is repeated in the next snapshot. Defaults to 0.6.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--day-zip-only", action="store_true", help="Only write the day zips, not each snapshot zip as well")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    archive = SyntheticArchive(vehicles=args.vehicles, snapshots=args.snapshots, interval=args.interval,
+                               duplicate_rate=args.duplicate_rate, seed=args.seed)
+    first = datetime.strptime(args.date, "%Y%m%d")
+    for n in range(args.days):
+        archive.write(args.root, (first + timedelta(days=n)).strftime("%Y%m%d"), individual=not args.day_zip_only)
@@ -0,0 +1,207 @@
+import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from pathlib import Path
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED
+import pyarrow as pa
+from colorama import Fore, Style
+from dotenv import load_dotenv
+
+DATE_PATTERN = re.compile(r"_([0-9]{8})\.zip$")
+
+class StoredTimetable:
+    """
+    A read-only view of a timetable zip kept in a TimetableStore, with the parts of the ZipFile interface
+    that GTFSTimetable uses (namelist, open and use as a context manager). Members are decompressed as they
+    are read, so nothing is written to disk. cache_key is a hash of the timetable's contents, which
+    GTFSTimetable uses for its cache.
+    """
+    def __init__(self, store, entry:dict):
+        self.store = store
+        self.members = {member["name"]: member for member in entry["members"]}
+        self.cache_key = "store-" + hashlib.sha256("".join(sorted(m["sha256"] for m in entry["members"])).encode()).hexdigest()
+
+    def namelist(self) -> list:
+        return list(self.members)
+
+    def member_hash(self, name:str) -> str:
+        """The hash of a member's contents, so tables that haven't changed share a cache entry."""
+        return self.members[name]["sha256"]
+
+    def open(self, name:str, mode="r"):
+        """Open a member as a (streaming) file."""
+        if name not in self.members:
+            raise KeyError(name)
+        return pa.input_stream(str(self.store.object_path(self.members[name]["sha256"])), compression="zstd")
+
+    def read(self, name:str) -> bytes:
+        with self.open(name) as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        # nothing is held open, so GTFSTimetable can "close" this and open it again
+        pass
+
+class TimetableStore:
+    """
+    Store daily timetable zips by their members' contents. Each member is kept once, zstd-compressed under
+    the sha256 of its contents, so a table that is the same as yesterday's takes no more space. A manifest
+    for each day lists each zip's members and their hashes.
+
+    Layout, under ${BODSARCHIVE}/timetable-store by default::
+
+        objects/ab/abcdef....zst
+        manifests/YYYY/MM/DD.json
+    """
+    def __init__(self, root=None):
+        """
+        :param root: Where the store is. Defaults to ${BODSARCHIVE}/timetable-store.
+        """
+        load_dotenv()
+        self.root = Path(root or Path(os.environ.get("BODSARCHIVE")) / "timetable-store")
+        self.lock = threading.Lock()
+
+    def object_path(self, digest:str) -> Path:
+        return self.root / "objects" / digest[:2] / f"{digest}.zst"
+
+    def manifest_path(self, date:str) -> Path:
+        """The manifest for a date string in 'YYYYmmdd' format."""
+        return self.root / "manifests" / date[0:4] / date[4:6] / f"{date[6:8]}.json"
+
+    def get_manifest(self, date:str) -> dict:
+        path = self.manifest_path(date)
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def put_object(self, source) -> tuple:
+        """
+        Add the contents of an open file to the store, unless they're already there.
+
+        :return: (sha256 of the contents, their size, whether a new object was written)
+        """
+        tmp = self.root / "objects" / f"tmp-{os.getpid()}-{threading.get_ident()}.zst"
+        tmp.parent.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        with pa.output_stream(str(tmp), compression="zstd") as out:
+            while chunk := source.read(1 << 20):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+
+        path = self.object_path(digest)
+        if path.exists():
+            tmp.unlink()
+            return digest, size, False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, path)
+        return digest, size, True
+
+    def add_zip(self, path, date=None) -> dict:
+        """
+        Add a timetable zip to the store and its day's manifest.
+
+        :param path: Path to a zip, e.g. itm_yorkshire_gtfs_20250529.zip.
+        :param date: The day it's for, as 'YYYYmmdd'. Defaults to the date at the end of its name.
+        :return: Its manifest entry.
+        """
+        path = Path(path)
+        if date is None:
+            match = DATE_PATTERN.search(path.name)
+            if not match:
+                raise ValueError(f"Can't tell the date of {path.name}. Give it explicitly.")
+            date = match.group(1)
+
+        members = []
+        new_bytes = 0
+        with ZipFile(path) as zf:
+            for info in zf.infolist():
+                if info.is_dir():
+                    continue
+                with zf.open(info) as source:
+                    digest, size, added = self.put_object(source)
+                members.append({"name": info.filename, "sha256": digest, "size": size, "date_time": list(info.date_time)})
+                if added:
+                    new_bytes += os.path.getsize(self.object_path(digest))
+        entry = {"members": members, "size": os.path.getsize(path)}
+
+        with self.lock:
+            manifest = self.get_manifest(date)
+            manifest[path.name] = entry
+            manifest_path = self.manifest_path(date)
+            manifest_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = manifest_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(manifest, indent=1))
+            os.replace(tmp, manifest_path)
+        print(f"Stored {Fore.CYAN}{path.name}{Style.RESET_ALL}: {len(members)} members, {Fore.YELLOW}{new_bytes / 1e6:.1f} MB{Style.RESET_ALL} new of {entry['size'] / 1e6:.1f} MB")
+        return entry
+
+    def open(self, date:str, name:str) -> StoredTimetable:
+        """
+        Open a stored timetable zip, e.g. to pass to GTFSTimetable.
+
+        :param date: The day, as 'YYYYmmdd'.
+        :param name: The zip's file name, e.g. itm_yorkshire_gtfs_20250529.zip.
+        """
+        manifest = self.get_manifest(date)
+        if name not in manifest:
+            raise KeyError(f"{name} isn't in the store for {date}")
+        return StoredTimetable(self, manifest[name])
+
+    def rebuild_zip(self, date:str, name:str, out_path) -> Path:
+        """Write a stored timetable back out as a zip file with the same members."""
+        timetable = self.open(date, name)
+        out_path = Path(out_path)
+        with ZipFile(out_path, "w", compression=ZIP_DEFLATED) as zf:
+            for member in timetable.members.values():
+                with timetable.open(member["name"]) as source, zf.open(_zip_info(member), "w") as dest:
+                    shutil.copyfileobj(source, dest, 1 << 20)
+        return out_path
+
+def _zip_info(member:dict) -> ZipInfo:
+    info = ZipInfo(member["name"], date_time=tuple(member["date_time"]))
+    info.compress_type = ZIP_DEFLATED
+    info.file_size = member["size"]
+    return info
+
+def set_args():
+    """Set the arguments given in the command line"""
+    parser = argparse.ArgumentParser(description="Store daily timetable zips by their contents, and get them back.")
+    parser.add_argument("--root", help="Where the store is. Defaults to ${BODSARCHIVE}/timetable-store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    add = subparsers.add_parser("add", help="Add timetable zips to the store")
+    add.add_argument("paths", nargs="+", help="Paths to itm_REGION_gtfs_YYYYmmdd.zip files")
+    add.add_argument("--delete", action="store_true", help="Delete each zip once it's stored")
+    ls = subparsers.add_parser("ls", help="List the timetables stored for a day")
+    ls.add_argument("-d", "--date", required=True, help="Date string format 'YYYYmmdd'")
+    rebuild = subparsers.add_parser("rebuild", help="Write a stored timetable back out as a zip")
+    rebuild.add_argument("-d", "--date", required=True, help="Date string format 'YYYYmmdd'")
+    rebuild.add_argument("-n", "--name", required=True, help="The zip's file name, e.g. itm_yorkshire_gtfs_20250529.zip")
+    rebuild.add_argument("-o", "--output", help="Where to write it. Defaults to the name in the current directory.")
+    args = parser.parse_args()
+    return args
+
+if __name__ == "__main__":
+    args = set_args()
+    store = TimetableStore(args.root)
+    if args.command == "add":
+        for path in args.paths:
+            store.add_zip(path)
+            if args.delete:
+                os.remove(path)
+    elif args.command == "ls":
+        for name, entry in store.get_manifest(args.date).items():
+            print(f"{name}: {len(entry['members'])} members, {entry['size'] / 1e6:.1f} MB")
+    else:
+        out = store.rebuild_zip(args.date, args.name, args.output or args.name)
+        print(f"Wrote {Fore.MAGENTA}{out}{Style.RESET_ALL}")
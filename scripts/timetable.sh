@@ -26,6 +26,10 @@ for i in "${regions[@]}"; do
   else 
     curl "$url" -s --create-dirs -o "$file"
     chmod 0755 "$file"
+    # Optionally add it to the content-addressed timetable store
+    if [ -n "${BODSTIMETABLESTORE}" ] && [ -e "$file" ]; then
+      ${BODSTIMETABLESTORE} add "$file"
+    fi
   fi
 
 done
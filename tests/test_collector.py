@@ -0,0 +1,65 @@
+"""The collector against a stand-in feed server: snapshots are saved and passed to the ingest hook."""
+import asyncio
+import io
+import json
+import shlex
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from zipfile import ZipFile
+import pytest
+from google.transit import gtfs_realtime_pb2
+from scripts.python.collector import Collector
+from scripts.python.synthetic_archive import SyntheticArchive, _field
+
+INGEST = f"{shlex.quote(sys.executable)} {shlex.quote(str(Path(__file__).parents[1] / 'scripts' / 'python' / 'gtfsrt_ingest.py'))}"
+
+def snapshot(vehicles=20) -> bytes:
+    """A gtfsrt snapshot zip, as the feed serves it."""
+    archive = SyntheticArchive(vehicles=vehicles, regions=["yorkshire"])
+    header = gtfs_realtime_pb2.FeedHeader(gtfs_realtime_version="2.0", timestamp=1748736000)
+    feed = _field(0x0a, header.SerializeToString()) + b"".join(archive.report(v, 1748736000 + 3600, 1748736000, "20250601", 0) for v in range(vehicles))
+    out = io.BytesIO()
+    with ZipFile(out, "w") as zf:
+        zf.writestr("gtfsrt.bin", feed)
+    return out.getvalue()
+
+@pytest.fixture
+def feed_server():
+    body = snapshot()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.headers.get("If-None-Match") == '"1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("ETag", '"1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/gtfsrt"
+    server.shutdown()
+
+def test_ingest_hook_ingests_snapshots(feed_server, tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv("BODSARCHIVE", str(tmp_path))
+    monkeypatch.setenv("BODSINGEST", INGEST)
+    collector = Collector(feeds={"gtfsrt": feed_server}, interval=0.2, archive_dir=tmp_path, metrics_path=tmp_path / "collector.prom")
+    asyncio.run(collector.run(polls=2))
+
+    snapshots = list(tmp_path.glob("gtfsrt/*/*/*/gtfsrt-*.zip"))
+    assert len(snapshots) == 1, "the second poll is a 304 and isn't saved"
+    manifest = json.loads((snapshots[0].parent / "ingest" / "manifest.json").read_text())
+    assert manifest["snapshots"][snapshots[0].name]["rows"] == 20
+    assert "exited with" not in capsys.readouterr().out
+    prom = (tmp_path / "collector.prom").read_text()
+    assert 'bods_collector_polls_total{feed="gtfsrt",result="changed"} 1' in prom
+    assert 'bods_collector_polls_total{feed="gtfsrt",result="not_modified"} 1' in prom
@@ -0,0 +1,161 @@
+"""download_ranged and download_file against a stand-in server that supports Range requests (or doesn't)."""
+import io
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zipfile import ZipFile, ZIP_STORED
+import pytest
+import requests
+from scripts.python.download_utils import make_session, download_file, download_ranged, verify_zip
+
+LAST_MODIFIED = "Mon, 02 Jun 2025 00:00:00 GMT"
+
+def zip_bytes(size=1 << 20) -> bytes:
+    """A zip of incompressible data, so its size is about `size`."""
+    out = io.BytesIO()
+    with ZipFile(out, "w", compression=ZIP_STORED) as zf:
+        zf.writestr("timetable.bin", os.urandom(size))
+    return out.getvalue()
+
+class Server:
+    """
+    Serves `data`. mode is "strong" or "weak" (the kind of ETag sent), "ignore" to answer Range requests
+    with the whole file, "noranges" to not advertise ranges, or "cut" to close each response halfway through.
+    """
+    def __init__(self, data:bytes, mode="strong"):
+        self.data = data
+        self.mode = mode
+        self.requests = []
+        self.bytes_sent = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_validators(self):
+                if server.mode != "noranges":
+                    self.send_header("Accept-Ranges", "bytes")
+                self.send_header("ETag", 'W/"1"' if server.mode == "weak" else '"1"')
+                self.send_header("Last-Modified", LAST_MODIFIED)
+
+            def do_HEAD(self):
+                server.requests.append(("HEAD", None, None))
+                self.send_response(200)
+                self.send_validators()
+                self.send_header("Content-Length", str(len(server.data)))
+                self.end_headers()
+
+            def do_GET(self):
+                rng, if_range = self.headers.get("Range"), self.headers.get("If-Range")
+                server.requests.append(("GET", rng, if_range))
+                # A weak ETag in If-Range never matches (RFC 7233), so the whole file is sent
+                if rng and server.mode not in ("ignore", "noranges") and not (if_range and if_range.startswith("W/")):
+                    start, end = re.match(r"bytes=(\d+)-(\d*)", rng).groups()
+                    body = server.data[int(start):int(end or len(server.data) - 1) + 1]
+                    self.send_response(206)
+                else:
+                    body = server.data
+                    self.send_response(200)
+                self.send_validators()
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if server.mode == "cut":
+                    body = body[:len(body) // 2]
+                    self.close_connection = True
+                self.wfile.write(body)
+                server.bytes_sent += len(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/timetables.zip"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+@pytest.fixture
+def server():
+    srv = Server(zip_bytes())
+    yield srv
+    srv.httpd.shutdown()
+
+def test_resumes_interrupted_download(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    server.mode = "cut"
+    with pytest.raises(requests.RequestException):
+        download_ranged(make_session(), server.url, path, segments=4, chunk_size=1 << 14)
+    assert not path.exists()
+    assert (tmp_path / "timetables.zip.part.json").exists()
+
+    server.mode = "strong"
+    server.bytes_sent = 0
+    assert download_ranged(make_session(), server.url, path, segments=4, chunk_size=1 << 14)
+    assert path.read_bytes() == server.data
+    assert 0 < server.bytes_sent < len(server.data), "only the rest of each segment is fetched again"
+    assert not (tmp_path / "timetables.zip.part").exists()
+    assert not (tmp_path / "timetables.zip.part.json").exists()
+
+def test_resumes_part_with_download_file(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    (tmp_path / "timetables.zip.part").write_bytes(server.data[:1000])
+    assert download_file(make_session(), server.url, path, verify=verify_zip)
+    assert path.read_bytes() == server.data
+    assert server.requests == [("GET", "bytes=1000-", None)]
+
+def test_falls_back_when_range_is_ignored(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    server.mode = "ignore"
+    assert download_ranged(make_session(), server.url, path, segments=4)
+    assert path.read_bytes() == server.data
+    assert ("GET", None, None) in server.requests, "downloaded again in one stream"
+    assert not (tmp_path / "timetables.zip.part.json").exists()
+
+def test_weak_etag_uses_last_modified(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    server.mode = "weak"
+    assert download_ranged(make_session(), server.url, path, segments=4)
+    assert path.read_bytes() == server.data
+    gets = [r for r in server.requests if r[0] == "GET"]
+    assert len(gets) == 4
+    assert all(rng and if_range == LAST_MODIFIED for _, rng, if_range in gets)
+    assert server.bytes_sent == len(server.data)
+
+def test_skips_existing_file(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    path.write_bytes(server.data)
+    assert not download_ranged(make_session(), server.url, path)
+    assert not download_file(make_session(), server.url, path)
+    assert server.requests == []
+
+def test_downloads_incomplete_existing_zip_again(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    path.write_bytes(server.data[:-100])
+    assert download_ranged(make_session(), server.url, path, segments=4)
+    assert path.read_bytes() == server.data
+
+def test_truncated_zip_fails_verify(server, tmp_path):
+    path = tmp_path / "timetables.zip"
+    path.write_bytes(server.data[:-100])
+    assert not verify_zip(path)
+    path.write_bytes(server.data)
+    assert verify_zip(path)
+
+def test_truncated_zip_of_zips_fails_verify(tmp_path):
+    out = io.BytesIO()
+    with ZipFile(out, "w", compression=ZIP_STORED) as zf:
+        zf.writestr("inner.zip", zip_bytes(1000))
+    data = out.getvalue()
+    # Cut the outer zip off where its central directory starts, so the file ends with the inner zip's
+    path = tmp_path / "day.zip"
+    path.write_bytes(data[:int.from_bytes(data[-6:-2], "little")])
+    assert not verify_zip(path)
+
+def test_truncated_download_is_not_kept(tmp_path):
+    # The server only has a truncated copy, and doesn't support ranges, so it's downloaded in one stream
+    srv = Server(zip_bytes()[:-100], mode="noranges")
+    path = tmp_path / "timetables.zip"
+    try:
+        with pytest.raises(requests.HTTPError):
+            download_ranged(make_session(), srv.url, path)
+    finally:
+        srv.httpd.shutdown()
+    assert not path.exists()
+    assert not (tmp_path / "timetables.zip.part").exists()
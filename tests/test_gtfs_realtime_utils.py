@@ -0,0 +1,18 @@
+"""A day's directory holds the snapshot zips and, next to them, the day zip of the same snapshots."""
+import pyarrow as pa
+from scripts.python.gtfs_realtime_utils import iter_gtfsrt_batches
+from scripts.python.synthetic_archive import SyntheticArchive
+
+def test_day_directory_reads_each_snapshot_once(tmp_path):
+    written = SyntheticArchive(vehicles=50, snapshots=4, regions=["yorkshire"]).write_gtfsrt(tmp_path, "20250601", individual=True)
+    day_dir = tmp_path / "gtfsrt" / "2025" / "06" / "01"
+    assert (day_dir / "gtfsrt-20250601.zip").exists() and len(list(day_dir.glob("gtfsrt-*T*.zip"))) == 4
+
+    from_directory = pa.Table.from_batches(iter_gtfsrt_batches(day_dir))
+    assert from_directory.num_rows == written["reports"] == 200
+    assert from_directory.equals(pa.Table.from_batches(iter_gtfsrt_batches(written["path"])))
+
+    # Once the snapshots have been removed, the day zip is read instead
+    for path in day_dir.glob("gtfsrt-*T*.zip"):
+        path.unlink()
+    assert sum(batch.num_rows for batch in iter_gtfsrt_batches(day_dir)) == 200
@@ -0,0 +1,15 @@
+"""GTFSTimetable must leave a zip it was given open, so the caller can keep reading tables from it."""
+from zipfile import ZipFile
+from scripts.python.gtfs_utils import GTFSTimetable
+
+def test_open_zip_is_not_closed(tmp_path):
+    path = tmp_path / "gtfs.zip"
+    with ZipFile(path, "w") as zf:
+        zf.writestr("agency.txt", "agency_id,agency_name\nOP1,Operator One\nOP2,Operator Two\n")
+        zf.writestr("routes.txt", "route_id,agency_id,route_short_name\nR1,OP1,1\n")
+
+    with ZipFile(path) as zf:
+        timetable = GTFSTimetable(zf, cache_dir=False)
+        assert len(timetable.dfs["agency"]) == 2
+        assert len(timetable.dfs["routes"]) == 1
+        assert zf.read("routes.txt")
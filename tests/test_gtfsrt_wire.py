@@ -0,0 +1,98 @@
+"""The wire-format decoder must give exactly the rows GTFSRT2Parquet.parse_member does, or hand the snapshots back to gtfs_realtime_pb2."""
+from zipfile import ZipFile
+import pyarrow as pa
+import pytest
+from google.transit import gtfs_realtime_pb2
+from scripts.python.gtfsrt_to_parquet import GTFSRT2Parquet, decode_payloads
+from scripts.python.gtfsrt_wire import WireFormatError, decode_vehicle_positions
+from scripts.python.realtime_schema import PLAIN_SCHEMA
+from scripts.python.synthetic_archive import SyntheticArchive, _field
+
+DATE = "20250601"
+
+def read_payloads(day_zip):
+    with ZipFile(day_zip) as zf:
+        payloads = []
+        for info in zf.infolist():
+            with zf.open(info) as member, ZipFile(member) as subzf:
+                payloads.append(subzf.read("gtfsrt.bin"))
+    return payloads
+
+def pb2_table(payloads):
+    rows = [row for data in payloads for row in GTFSRT2Parquet.parse_member(data)]
+    return pa.Table.from_pylist([dict(zip(PLAIN_SCHEMA.names, row)) for row in rows], schema=PLAIN_SCHEMA)
+
+def feed(*entities):
+    header = gtfs_realtime_pb2.FeedHeader(gtfs_realtime_version="2.0", timestamp=1748736000)
+    return _field(0x0a, header.SerializeToString()) + b"".join(entities)
+
+def vehicle_position(trip_id="VJ1", latitude=53.8012345, longitude=-1.5498765):
+    vehicle = gtfs_realtime_pb2.VehiclePosition()
+    vehicle.trip.trip_id = trip_id
+    vehicle.trip.route_id = "R1"
+    vehicle.trip.start_date = DATE
+    vehicle.trip.start_time = "25:10:00"
+    vehicle.position.latitude = latitude
+    vehicle.position.longitude = longitude
+    vehicle.position.bearing = 271.5
+    vehicle.timestamp = 1748736001
+    vehicle.vehicle.id = "V1"
+    return vehicle.SerializeToString()
+
+def entity(entity_id, vehicle:bytes) -> bytes:
+    return _field(0x12, _field(0x0a, entity_id.encode()) + _field(0x22, vehicle))
+
+@pytest.fixture(scope="module")
+def day_payloads(tmp_path_factory):
+    archive = SyntheticArchive(vehicles=300, snapshots=6, regions=["yorkshire", "north_west"], seed=3)
+    written = archive.write_gtfsrt(tmp_path_factory.mktemp("archive"), DATE, individual=False)
+    return read_payloads(written["path"])
+
+def test_synthetic_day_matches_pb2(day_payloads):
+    table = decode_vehicle_positions(b"".join(day_payloads))
+    assert table.num_rows == 300 * 6
+    assert table.equals(pb2_table(day_payloads))
+    assert decode_payloads(day_payloads, "wire").equals(decode_payloads(day_payloads, "pb2"))
+
+def test_fields_the_decoder_skips_match_pb2():
+    # Vehicles before their first trip have no trip at all, so the defaults must match too
+    no_trip = gtfs_realtime_pb2.VehiclePosition(timestamp=1748736002)
+    no_trip.vehicle.id = "V2"
+    # Fields that aren't kept, which the decoder has to step over
+    extra = gtfs_realtime_pb2.VehiclePosition.FromString(vehicle_position("VJ3"))
+    extra.current_stop_sequence = 300
+    extra.occupancy_status = gtfs_realtime_pb2.VehiclePosition.FULL
+    extra.position.speed = 12.5
+    extra.vehicle.label = "Label"
+    extra.trip.schedule_relationship = gtfs_realtime_pb2.TripDescriptor.ADDED
+    # Entities without a vehicle are left out by both
+    trip_update = gtfs_realtime_pb2.FeedEntity(id="tu")
+    trip_update.trip_update.trip.trip_id = "VJ4"
+    payloads = [
+        feed(entity("1", vehicle_position()), entity("2", no_trip.SerializeToString()), entity("3", extra.SerializeToString()),
+             _field(0x12, trip_update.SerializeToString())),
+        # coordinates right on, and either side of, a rounding boundary at 5 dp
+        feed(*(entity(str(i), vehicle_position(latitude=lat, longitude=-lat)) for i, lat in enumerate((51.000005, 51.0000049, 51.0000051, 0.0, -0.000005)))),
+        feed(),
+    ]
+    table = decode_vehicle_positions(b"".join(payloads))
+    assert table.num_rows == 8
+    assert table.equals(pb2_table(payloads))
+    assert decode_payloads(payloads, "wire").equals(decode_payloads(payloads, "pb2"))
+
+@pytest.mark.parametrize("vehicle", [
+    # the trip sent twice, which protobuf merges into one
+    vehicle_position("VJ1") + _field(0x0a, gtfs_realtime_pb2.TripDescriptor(trip_id="VJ2").SerializeToString()),
+    # an unknown group (wire type 3) inside the VehiclePosition
+    vehicle_position() + b"\x7b\x7c",
+], ids=["repeated-message", "group"])
+def test_falls_back_to_pb2(vehicle, day_payloads, capsys):
+    payloads = day_payloads[:2] + [feed(entity("odd", vehicle))]
+    with pytest.raises(WireFormatError):
+        decode_vehicle_positions(b"".join(payloads))
+    assert decode_payloads(payloads, "wire").equals(decode_payloads(payloads, "pb2"))
+    assert "Falling back to gtfs_realtime_pb2" in capsys.readouterr().out
+
+def test_truncated_feed_raises(day_payloads):
+    with pytest.raises(WireFormatError):
+        decode_vehicle_positions(day_payloads[0][:-3])
@@ -0,0 +1,14 @@
+"""compact() must never fail on what a feed sends: blank and malformed dates and times become nulls."""
+import datetime
+import pyarrow as pa
+from scripts.python.realtime_schema import compact, expand
+
+def test_malformed_dates_and_times_are_null():
+    table = pa.table({
+        "start_date": ["20250529", "2025-05-29", "", None, "20251340"],
+        "start_time": ["08:00:00", "08:00", "25:10:05", "", "8:0a:00"],
+    })
+    compacted = compact(table)
+    assert compacted["start_date"].to_pylist() == [datetime.date(2025, 5, 29), None, None, None, None]
+    assert compacted["start_time"].to_pylist() == [8 * 3600, None, 25 * 3600 + 10 * 60 + 5, None, None]
+    assert expand(compacted).to_pylist()[2] == {"start_date": "", "start_time": "25:10:05"}